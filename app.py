@@ -1,22 +1,151 @@
+import hashlib
 import os
-from flask import Flask, request, abort, jsonify
-from flask_sqlalchemy import SQLAlchemy
-from database.models import setup_db, db_drop_and_create_all, Actor, Movie
+from functools import wraps
+from sqlalchemy import func
+from flask import Flask, request, abort, jsonify, Response, \
+    stream_with_context, make_response, g
+from database.models import setup_db, db, Actor, Movie, resolve_cast, \
+    resolve_casts, get_versions, parse_release_date
+from database.cache import configure_cache, entity_cache
+from database.routing import read_only
+from database.serializers import actor_serializer, movie_serializer, \
+    dumps, json_response
+from database.filters import actor_filters, movie_filters, \
+    ACTOR_SORTS, MOVIE_SORTS
+from database.queries import include_arg, fields_arg, list_query
+from database.pagination import page_args, keyset_page, keyset_after, \
+    keyset_order, encode_cursor, decode_cursor
+from database.search import search
+from database.graph import costars, shortest_path
 from flask_cors import CORS
 from auth.auth import AuthError, requires_auth
+from metrics import install_metrics
+from profiling import install_profiling
+
+GENDERS = ('f', 'm', 'female', 'male')
+
+
+'''
+    actor_fields(item, partial) method
+    @INPUTS
+        item: actor object from a request body
+        partial: whether missing fields are allowed (updates)
+
+    raises ValueError, with a message for the client, if a field is
+    missing or invalid
+    returns the validated actor columns
+'''
+
+
+def actor_fields(item, partial=False):
+    if not isinstance(item, dict):
+        raise ValueError('Item must be an object')
+
+    fields = {}
+    if not partial or 'name' in item:
+        name = item.get('name')
+        if not isinstance(name, str) or name == "":
+            raise ValueError('name must be a non-empty string')
+        fields['name'] = name
+
+    if not partial or 'age' in item:
+        age = item.get('age')
+        if not isinstance(age, int) or isinstance(age, bool) or age <= 0:
+            raise ValueError('age must be a positive integer')
+        fields['age'] = age
+
+    if not partial or 'gender' in item:
+        gender = item.get('gender')
+        if not isinstance(gender, str) or gender.lower() not in GENDERS:
+            raise ValueError('gender must be one of ' + ', '.join(GENDERS))
+        fields['gender'] = gender
+
+    if not fields:
+        raise ValueError('No fields to update')
+
+    return fields
+
+
+'''
+    movie_fields(item, partial) method
+    @INPUTS
+        item: movie object from a request body
+        partial: whether missing fields are allowed (updates)
+
+    raises ValueError, with a message for the client, if a field is
+    missing or invalid
+    release_date may be YYYY-MM-DD or the legacy DD-MM-YYYY
+    returns the validated movie columns, cast left unresolved
+'''
+
+
+def movie_fields(item, partial=False):
+    if not isinstance(item, dict):
+        raise ValueError('Item must be an object')
+
+    fields = {}
+    if not partial or 'title' in item:
+        title = item.get('title')
+        if not isinstance(title, str) or title == "":
+            raise ValueError('title must be a non-empty string')
+        fields['title'] = title
+
+    if not partial or 'release_date' in item:
+        fields['release_date'] = parse_release_date(item.get('release_date'))
+
+    if not partial or 'cast' in item:
+        cast = item.get('cast')
+        if not isinstance(cast, list) or (partial and not cast):
+            raise ValueError('cast must be a list of actor names or ids')
+        fields['cast'] = cast
+
+    if not fields:
+        raise ValueError('No fields to update')
+
+    return fields
 
 
 def create_app(test_config=None):
     
     # create and configure the app
     app = Flask(__name__)
+    app.config.from_mapping(
+        PAGE_SIZE=int(os.environ.get('PAGE_SIZE', 100)),
+        MAX_PAGE_SIZE=int(os.environ.get('MAX_PAGE_SIZE', 500)),
+        STREAM_BATCH_SIZE=int(os.environ.get('STREAM_BATCH_SIZE', 1000)),
+        CAST_CASE_INSENSITIVE=os.environ.get(
+            'CAST_CASE_INSENSITIVE', '').lower() in ('1', 'true'),
+        BULK_MAX_ITEMS=int(os.environ.get('BULK_MAX_ITEMS', 1000)),
+        CACHE_CONTROL=os.environ.get('CACHE_CONTROL', 'private, no-cache'),
+        ENTITY_CACHE=os.environ.get('ENTITY_CACHE', 'memory'),
+        ENTITY_CACHE_URL=os.environ.get('ENTITY_CACHE_URL'),
+        ENTITY_CACHE_TTL=int(os.environ.get('ENTITY_CACHE_TTL', 30)),
+        ENTITY_CACHE_SIZE=int(os.environ.get('ENTITY_CACHE_SIZE', 10000)),
+        SEARCH_MAX_QUERY=int(os.environ.get('SEARCH_MAX_QUERY', 100)),
+        SEARCH_MAX_RESULTS=int(os.environ.get('SEARCH_MAX_RESULTS', 1000)),
+        CAST_GRAPH=os.environ.get('CAST_GRAPH', 'memory'),
+        CAST_GRAPH_MAX_DEGREES=int(
+            os.environ.get('CAST_GRAPH_MAX_DEGREES', 6)),
+        STATS_TOP=int(os.environ.get('STATS_TOP', 10)),
+        METRICS_TOKEN=os.environ.get('METRICS_TOKEN'),
+        PROFILE_DIR=os.environ.get('PROFILE_DIR'),
+        PROFILE_TOP=int(os.environ.get('PROFILE_TOP', 50)),
+        PROFILE_REQUEST_INTERVAL=float(
+            os.environ.get('PROFILE_REQUEST_INTERVAL', 0.001)),
+        PROFILE_SAMPLE_INTERVAL=float(
+            os.environ.get('PROFILE_SAMPLE_INTERVAL', 0)),
+        PROFILE_FLUSH_INTERVAL=float(
+            os.environ.get('PROFILE_FLUSH_INTERVAL', 10))
+    )
+    if test_config is not None:
+        app.config.update(test_config)
+
+    configure_cache(app.config)
     setup_db(app)
 
     # Set up CORS. Allow '*' for origins.
     CORS(app, resources={'/': {'origins': '*'}})
 
-    # db_drop_and_create_all()
-
     @app.after_request
     def after_request(response):
         """ Set Access Control """
@@ -30,33 +159,324 @@ def create_app(test_config=None):
 
         return response
 
+    @app.after_request
+    def record_write(response):
+        """ Keeps the writer's reads on the primary for a while """
+
+        router = app.extensions.get('replica_router')
+        principal = g.get('principal')
+        if router is not None and principal is not None \
+                and request.method in ('POST', 'PATCH', 'DELETE') \
+                and response.status_code < 400:
+            router.record_write(principal.subject)
+
+        return response
+
     @app.route('/')
     def home():
         return jsonify({
             'success': True
         }), 200
 
+    def conditional(*tables, include=None, variant=None):
+        """
+        Adds a strong ETag, derived from the version counters of the
+        tables the endpoint reads, and answers a matching If-None-Match
+        with 304 before the handler, the ORM or the serializer run.
+        include maps ?include= values to the extra tables they read.
+        variant returns what else the body depends on, e.g. the
+        caller's permissions, which is hashed into the ETag too.
+        """
+
+        def conditional_decorator(f):
+            @wraps(f)
+            def wrapper(*args, **kwargs):
+                names = set(tables)
+                for name in request.args.get('include', '').split(','):
+                    names.update((include or {}).get(name, ()))
+
+                versions = get_versions(sorted(names))
+                # handlers that depend on a table version read it here
+                g.table_versions = versions
+                representation = request.accept_mimetypes.best_match(
+                    ['application/json', 'application/x-ndjson'])
+                parts = [
+                    repr(sorted(versions.items())),
+                    request.full_path,
+                    representation or ''
+                ]
+                if variant is not None:
+                    parts.append(repr(variant()))
+                etag = hashlib.sha1(
+                    '|'.join(parts).encode('utf-8')).hexdigest()
+
+                headers = {
+                    'Cache-Control': app.config['CACHE_CONTROL'],
+                    'Vary': 'Accept, Authorization'
+                }
+
+                if etag in request.if_none_match:
+                    response = Response(status=304, headers=headers)
+                    response.set_etag(etag)
+                    return response
+
+                response = make_response(f(*args, **kwargs))
+                if response.status_code == 200:
+                    response.set_etag(etag)
+                    response.headers.extend(headers)
+                return response
+            return wrapper
+        return conditional_decorator
+
+    def filtered_query(serializer, filters, sorts):
+        """ Applies the filter and ?sort= arguments to serializer's query """
+
+        try:
+            return list_query(serializer.query(), serializer, request.args,
+                              filters, sorts)
+        except ValueError:
+            abort(422)
+
+    def paginate(query, column, sort=None, descending=False):
+        try:
+            limit, after = page_args(request.args,
+                                     app.config['PAGE_SIZE'],
+                                     app.config['MAX_PAGE_SIZE'])
+            return keyset_page(query, column, limit, after, sort,
+                               descending)
+        except ValueError:
+            abort(422)
+
+    def offset_args():
+        """ Parses ?limit= and an ?after= cursor holding an offset """
+
+        try:
+            limit, after = page_args(request.args,
+                                     app.config['PAGE_SIZE'],
+                                     app.config['MAX_PAGE_SIZE'])
+            (offset,) = decode_cursor(after) if after else (0,)
+            if not isinstance(offset, int) or offset < 0:
+                raise ValueError
+        except ValueError:
+            abort(422)
+
+        return limit, offset
+
+    def wants_stream():
+        if request.args.get('stream') in ('1', 'true'):
+            return True
+        return request.accept_mimetypes.best_match(
+            ['application/json', 'application/x-ndjson']
+        ) == 'application/x-ndjson'
+
+    def include_args(serializer):
+        """ Parses ?include=, see database.queries.include_arg """
+
+        try:
+            return include_arg(request.args, serializer)
+        except ValueError:
+            abort(422)
+
+    def fields_args(serializer):
+        """ Parses ?fields=, see database.queries.fields_arg """
+
+        try:
+            return fields_arg(request.args, serializer)
+        except ValueError:
+            abort(422)
+
+    def stream(serializer, query, column, include=(), sort=None,
+               descending=False):
+        """ Streams every row as NDJSON, one object per line """
+
+        after = request.args.get('after')
+        if after is not None:
+            try:
+                query = keyset_after(query, column, after, sort, descending)
+            except ValueError:
+                abort(422)
+
+        batch_size = app.config['STREAM_BATCH_SIZE']
+        # yield_per fetches through a server-side cursor in batches
+        rows = query.order_by(*keyset_order(column, sort, descending)) \
+            .yield_per(batch_size)
+
+        def encode(batch):
+            return b''.join(dumps(item) + b'\n'
+                            for item in serializer.dicts(batch, include))
+
+        def generate():
+            batch = []
+            for row in rows:
+                batch.append(row)
+                if len(batch) == batch_size:
+                    yield encode(batch)
+                    batch = []
+            if batch:
+                yield encode(batch)
+
+        return Response(stream_with_context(generate()),
+                        mimetype='application/x-ndjson')
+
+    def unresolved_cast(resolution):
+        """ 422 response listing the cast entries that did not resolve """
+
+        return jsonify({
+            'success': False,
+            'error': 422,
+            'message': 'Unprocessable entity',
+            'missing': resolution.missing,
+            'ambiguous': resolution.ambiguous
+        }), 422
+
+    def bulk_items(key):
+        """ Returns the list of items under key in the request body """
+
+        request_body = request.get_json(silent=True)
+        if not isinstance(request_body, dict):
+            abort(422)
+
+        items = request_body.get(key)
+        if not isinstance(items, list) or not items \
+                or len(items) > app.config['BULK_MAX_ITEMS']:
+            abort(422)
+
+        return items
+
+    def bulk_result(index, error=None, message=None, **fields):
+        if error is None:
+            return dict(index=index, success=True, **fields)
+
+        return {
+            'index': index,
+            'success': False,
+            'error': error,
+            'message': message
+        }
+
+    def validate_bulk(items, validate, partial):
+        """
+        Validates every item, returns the per-item results list, with None
+        for valid items, and the (index, fields) pairs of the valid items
+        """
+
+        results = [None] * len(items)
+        valid = []
+        for index, item in enumerate(items):
+            try:
+                fields = validate(item, partial)
+                if partial:
+                    fields['id'] = item.get('id')
+                    if not isinstance(fields['id'], int):
+                        raise ValueError('id must be an integer')
+                valid.append((index, fields))
+            except ValueError as e:
+                results[index] = bulk_result(index, 422, str(e))
+
+        return results, valid
+
+    def drop_unknown_ids(model, results, valid):
+        """ Marks items whose id does not exist as 404 results """
+
+        ids = {fields['id'] for index, fields in valid}
+        existing = {
+            row.id for row in
+            model.query.with_entities(model.id).filter(model.id.in_(ids))
+        } if ids else set()
+
+        found = []
+        for index, fields in valid:
+            if fields['id'] in existing:
+                found.append((index, fields))
+            else:
+                results[index] = bulk_result(
+                    index, 404, 'Resource not found')
+        return found
+
+    def resolve_bulk_casts(results, valid):
+        """
+        Resolves the casts of all valid items in one query, replacing
+        each cast with actor ids; items with unresolved entries become
+        422 results
+        """
+
+        with_cast = [(index, fields) for index, fields in valid
+                     if 'cast' in fields]
+        resolutions = resolve_casts(
+            [fields['cast'] for index, fields in with_cast],
+            app.config['CAST_CASE_INSENSITIVE'])
+
+        unresolved = set()
+        for (index, fields), resolution in zip(with_cast, resolutions):
+            if resolution.missing or resolution.ambiguous:
+                results[index] = dict(
+                    bulk_result(index, 422, 'Unprocessable entity'),
+                    missing=resolution.missing,
+                    ambiguous=resolution.ambiguous)
+                unresolved.add(index)
+            else:
+                fields['cast'] = [actor.id for actor in resolution.actors]
+
+        return [(index, fields) for index, fields in valid
+                if index not in unresolved]
+
+    def bulk_response(results):
+        return jsonify({
+            'success': True,
+            'succeeded': sum(1 for result in results if result['success']),
+            'failed': sum(1 for result in results if not result['success']),
+            'results': results
+        }), 200
+
     @app.route('/movies')
     @requires_auth('get:movies')
+    @read_only
+    @conditional('movies', include={'cast': ('cast', 'actors')})
     def get_all_movies(payload):
-        movies_query = Movie.query.order_by(Movie.id).all()
-        return jsonify({
+        include = include_args(movie_serializer)
+        serializer = fields_args(movie_serializer)
+        query, sort, descending = filtered_query(serializer, movie_filters,
+                                                 MOVIE_SORTS)
+
+        if wants_stream():
+            return stream(serializer, query, Movie.id, include, sort,
+                          descending)
+
+        rows, next_cursor = paginate(query, Movie.id, sort, descending)
+        return json_response({
             'success': True,
-            'movies': [movie.format() for movie in movies_query]
-        }), 200
+            'movies': serializer.dicts(rows, include),
+            'next_cursor': next_cursor
+        })
 
     @app.route('/movies/<int:id>')
     @requires_auth('get:movies-details')
+    @read_only
+    @conditional('movies', include={'cast': ('cast', 'actors')})
     def get_movie_by_id(payload, id):
-
-        movie = Movie.query.filter(Movie.id == id).one_or_none()
-        if movie is None:
-            abort(404)
-
-        return jsonify({
+        include = include_args(movie_serializer)
+        serializer = fields_args(movie_serializer)
+
+        # only the plain, full representation is cached, tagged with the
+        # version of the table it was read at
+        version = g.table_versions['movies']
+        movie = entity_cache.get('movie', id, version) \
+            if not include else None
+        if movie is not None:
+            movie = {name: movie[name] for name in serializer.fields}
+        else:
+            row = serializer.query().filter(Movie.id == id).one_or_none()
+            if row is None:
+                abort(404)
+
+            (movie,) = serializer.dicts([row], include)
+            if not include and serializer is movie_serializer:
+                entity_cache.set('movie', id, version, movie)
+
+        return json_response({
             'success': True,
-            'movie': movie.format()
-        }), 200
+            'movie': movie
+        })
 
     @app.route('/movies', methods=['POST'])
     @requires_auth('post:movies')
@@ -69,25 +489,23 @@ def create_app(test_config=None):
                     or 'cast' not in request_body:
                 raise ValueError
 
+            resolution = resolve_cast(request_body.get('cast'),
+                                      app.config['CAST_CASE_INSENSITIVE'])
+            if resolution.missing or resolution.ambiguous:
+                return unresolved_cast(resolution)
+
             new_movie = Movie(
                 request_body.get('title'),
                 request_body.get('release_date')
             )
-
-            actors = Actor.query.filter(Actor.name.in_(
-                request_body.get('cast'))).all()
-
-            if len(request_body.get('cast')) == len(actors):
-                new_movie.cast = actors
-                new_movie.insert()
-            else:
-                abort(422)
+            new_movie.cast = resolution.actors
+            new_movie.insert()
 
         except ValueError:
             abort(422)
 
-        except Exception as e:
-            print(e)
+        except Exception:
+            app.logger.exception('Unable to create the movie')
             abort(500)
 
         return jsonify({
@@ -111,22 +529,20 @@ def create_app(test_config=None):
                 movie.title = request_body.get('title')
 
             if 'release_date' in request_body:
-                if request_body.get('release_date') == "":
-                    raise ValueError
-                movie.release_date = request_body.get('release_date')
+                movie.release_date = parse_release_date(
+                    request_body.get('release_date'))
 
             if 'cast' in request_body:
                 if len(request_body.get('cast')) == 0:
                     raise ValueError
 
-                actors = Actor.query.filter(
-                    Actor.name.in_(request_body.get('cast'))
-                ).all()
+                resolution = resolve_cast(
+                    request_body.get('cast'),
+                    app.config['CAST_CASE_INSENSITIVE'])
+                if resolution.missing or resolution.ambiguous:
+                    return unresolved_cast(resolution)
 
-                if len(actors) == len(request_body.get('cast')):
-                    movie.cast = actors
-                else:
-                    raise ValueError
+                movie.cast = resolution.actors
 
             movie.update()
 
@@ -160,27 +576,93 @@ def create_app(test_config=None):
             'movie_id': id
         }), 200
 
+    @app.route('/movies/bulk', methods=['POST'])
+    @requires_auth('post:movies')
+    def create_movies_bulk(payload):
+        items = bulk_items('movies')
+        results, valid = validate_bulk(items, movie_fields, False)
+
+        try:
+            valid = resolve_bulk_casts(results, valid)
+            ids = Movie.insert_many([fields for index, fields in valid])
+        except Exception:
+            app.logger.exception('Unable to create the movies')
+            abort(500)
+
+        for (index, fields), movie_id in zip(valid, ids):
+            results[index] = bulk_result(index, movie_id=movie_id)
+
+        return bulk_response(results)
+
+    @app.route('/movies/bulk', methods=['PATCH'])
+    @requires_auth('patch:movies')
+    def patch_movies_bulk(payload):
+        items = bulk_items('movies')
+        results, valid = validate_bulk(items, movie_fields, True)
+
+        try:
+            valid = drop_unknown_ids(Movie, results, valid)
+            valid = resolve_bulk_casts(results, valid)
+            Movie.update_many([fields for index, fields in valid])
+        except Exception:
+            app.logger.exception('Unable to update the movies')
+            abort(500)
+
+        for index, fields in valid:
+            results[index] = bulk_result(index, movie_id=fields['id'])
+
+        return bulk_response(results)
+
     @app.route('/actors')
     @requires_auth('get:actors')
+    @read_only
+    @conditional('actors', include={'movies': ('cast', 'movies')})
     def get_actors(payload):
-        actors = Actor.query.order_by(Actor.id).all()
+        include = include_args(actor_serializer)
+        serializer = fields_args(actor_serializer)
+        query, sort, descending = filtered_query(serializer, actor_filters,
+                                                 ACTOR_SORTS)
 
-        return jsonify({
+        if wants_stream():
+            return stream(serializer, query, Actor.id, include, sort,
+                          descending)
+
+        rows, next_cursor = paginate(query, Actor.id, sort, descending)
+
+        return json_response({
             'success': True,
-            'actors': [actor.format() for actor in actors]
-        }), 200
+            'actors': serializer.dicts(rows, include),
+            'next_cursor': next_cursor
+        })
 
     @app.route('/actors/<int:id>')
     @requires_auth('get:actors-details')
+    @read_only
+    @conditional('actors', include={'movies': ('cast', 'movies')})
     def get_actor_by_id(payload, id):
-        actor = Actor.query.filter(Actor.id == id).one_or_none()
-        if actor is None:
-            abort(404)
-
-        return jsonify({
+        include = include_args(actor_serializer)
+        serializer = fields_args(actor_serializer)
+
+        # only the plain, full representation is cached, tagged with the
+        # version of the table it was read at
+        version = g.table_versions['actors']
+        actor = entity_cache.get('actor', id, version) \
+            if not include else None
+        if actor is not None:
+            actor = {name: actor[name] for name in serializer.fields}
+        else:
+            row = serializer.query().filter(Actor.id == id).one_or_none()
+            if row is None:
+                abort(404)
+
+            (actor,) = serializer.dicts([row], include)
+            if not include and serializer is actor_serializer:
+                entity_cache.set('actor', id, version, actor)
+
+        return json_response({
             'success': True,
-            'actor': actor.format()
-        }), 200
+            'actor': actor
+        })
 
     @app.route('/actors', methods=['POST'])
     @requires_auth('post:actors')
@@ -268,6 +750,185 @@ def create_app(test_config=None):
             'actor_id': id
         })
 
+    @app.route('/actors/bulk', methods=['POST'])
+    @requires_auth('post:actors')
+    def create_actors_bulk(payload):
+        items = bulk_items('actors')
+        results, valid = validate_bulk(items, actor_fields, False)
+
+        try:
+            ids = Actor.insert_many([fields for index, fields in valid])
+        except Exception:
+            app.logger.exception('Unable to create the actors')
+            abort(500)
+
+        for (index, fields), actor_id in zip(valid, ids):
+            results[index] = bulk_result(index, actor_id=actor_id)
+
+        return bulk_response(results)
+
+    @app.route('/actors/bulk', methods=['PATCH'])
+    @requires_auth('patch:actors')
+    def update_actors_bulk(payload):
+        items = bulk_items('actors')
+        results, valid = validate_bulk(items, actor_fields, True)
+
+        try:
+            valid = drop_unknown_ids(Actor, results, valid)
+            Actor.update_many([fields for index, fields in valid])
+        except Exception:
+            app.logger.exception('Unable to update the actors')
+            abort(500)
+
+        for index, fields in valid:
+            results[index] = bulk_result(index, actor_id=fields['id'])
+
+        return bulk_response(results)
+
+    @app.route('/actors/<int:id>/costars')
+    @requires_auth('get:actors')
+    @read_only
+    @conditional('actors', 'cast')
+    def get_costars(payload, id):
+        limit, offset = offset_args()
+
+        # one extra co-star tells whether another page exists
+        pairs = costars(db.session, id, g.table_versions['cast'],
+                        limit + 1, offset,
+                        app.config['CAST_GRAPH'] == 'memory')
+        names = dict(db.session.query(Actor.id, Actor.name).filter(
+            Actor.id.in_([id] + [actor_id for actor_id, _ in pairs])))
+        if id not in names:
+            abort(404)
+
+        next_cursor = None
+        if len(pairs) > limit:
+            pairs = pairs[:limit]
+            next_cursor = encode_cursor([offset + limit])
+
+        return json_response({
+            'success': True,
+            'actor_id': id,
+            'costars': [{
+                'id': actor_id,
+                'name': names.get(actor_id),
+                'shared_movies': shared
+            } for actor_id, shared in pairs],
+            'next_cursor': next_cursor
+        })
+
+    @app.route('/actors/<int:id>/path/<int:other_id>')
+    @requires_auth('get:actors', 'get:movies')
+    @read_only
+    @conditional('actors', 'movies', 'cast')
+    def get_path(payload, id, other_id):
+        path = shortest_path(db.session, id, other_id,
+                             g.table_versions['cast'],
+                             app.config['CAST_GRAPH_MAX_DEGREES'],
+                             app.config['CAST_GRAPH'] == 'memory') or []
+
+        # the path alternates actors and movies, starting with an actor
+        names = dict(db.session.query(Actor.id, Actor.name).filter(
+            Actor.id.in_({id, other_id}.union(path[::2]))))
+        if id not in names or other_id not in names:
+            abort(404)
+        titles = dict(db.session.query(Movie.id, Movie.title).filter(
+            Movie.id.in_(path[1::2]))) if len(path) > 1 else {}
+
+        return json_response({
+            'success': True,
+            'degrees': len(path) // 2 if path else None,
+            'path': [
+                {'type': 'actor', 'id': node, 'name': names.get(node)}
+                if index % 2 == 0 else
+                {'type': 'movie', 'id': node, 'title': titles.get(node)}
+                for index, node in enumerate(path)
+            ] if path else None
+        })
+
+    @app.route('/stats')
+    @requires_auth('get:actors', 'get:movies')
+    @read_only
+    @conditional('actors', 'movies')
+    def get_stats(payload):
+        try:
+            top = int(request.args.get('top', app.config['STATS_TOP']))
+            if top <= 0:
+                raise ValueError
+        except ValueError:
+            abort(422)
+        top = min(top, app.config['MAX_PAGE_SIZE'])
+
+        def summary(model, counter, serializer):
+            """ Totals of a counter column and the rows it ranks first """
+
+            count, total, largest = db.session.query(
+                func.count(model.id),
+                func.coalesce(func.sum(counter), 0),
+                func.coalesce(func.max(counter), 0)).one()
+            # served by the (counter, id) index
+            empty = model.query.filter(counter == 0).count()
+            serializer = serializer.only([serializer.fields[1], counter.key])
+            rows = serializer.query() \
+                .order_by(counter.desc(), model.id).limit(top).all()
+
+            return {
+                'count': count,
+                'empty': empty,
+                'total': total,
+                'average': round(total / count, 2) if count else 0,
+                'max': largest,
+                'top': serializer.dicts(rows)
+            }
+
+        return json_response({
+            'success': True,
+            'actors': summary(Actor, Actor.movie_count, actor_serializer),
+            'movies': summary(Movie, Movie.cast_size, movie_serializer)
+        })
+
+    def search_kinds():
+        """ The kinds of results the caller may read """
+
+        return [kind for kind, permission in (('actor', 'get:actors'),
+                                              ('movie', 'get:movies'))
+                if g.principal.has_all({permission})]
+
+    @app.route('/search')
+    @requires_auth('get:actors', 'get:movies', require='any')
+    @read_only
+    @conditional('actors', 'movies', variant=search_kinds)
+    def search_all(payload):
+        query = request.args.get('q', '').strip()
+        if not query or len(query) > app.config['SEARCH_MAX_QUERY']:
+            abort(422)
+
+        limit, offset = offset_args()
+
+        # results are ranked, so pages are offsets into the ranking,
+        # bounded by SEARCH_MAX_RESULTS
+        limit = max(0, min(limit, app.config['SEARCH_MAX_RESULTS'] - offset))
+
+        # one extra result tells whether another page exists
+        results = search(db.session, query, search_kinds(), limit + 1,
+                         offset) if limit else []
+
+        next_cursor = None
+        if len(results) > limit:
+            results = results[:limit]
+            next_cursor = encode_cursor([offset + limit])
+
+        return json_response({
+            'success': True,
+            'results': [{
+                'type': kind,
+                'id': id,
+                'label': label,
+                'score': round(score, 4)
+            } for score, kind, id, label in results],
+            'next_cursor': next_cursor
+        })
+
     # Error Handlers
 
     @app.errorhandler(404)
@@ -308,10 +969,15 @@ def create_app(test_config=None):
         response.status_code = error.status_code
         return response
 
+    # times the requests of every route above
+    install_metrics(app)
+    install_profiling(app)
+
     return app
 
 
-app = create_app()
 '''
-if __name__ == '__main__':
-    APP.run(port=8080, debug=True)'''
+the app is built by the server, not at import:
+    gunicorn 'app:create_app()'
+    FLASK_APP=app.py flask run
+'''
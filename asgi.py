@@ -0,0 +1,336 @@
+import asyncio
+import hashlib
+import logging
+import os
+import time
+from contextlib import asynccontextmanager
+
+from sqlalchemy.orm import Query
+from werkzeug.datastructures import MIMEAccept
+from werkzeug.http import parse_accept_header, parse_etags, quote_etag
+
+from app import create_app
+from auth.auth import AuthError, parse_auth_header, get_principal_async, \
+    check_permissions
+from database.aio import AsyncDatabase
+from database.cache import RedisCache, entity_cache
+from database.filters import actor_filters, movie_filters, \
+    ACTOR_SORTS, MOVIE_SORTS
+from database.models import Actor, Movie, versions_statement, \
+    warm_cast_graph
+from database.pagination import page_args, keyset_query, keyset_result
+from database.queries import include_arg, fields_arg, list_query
+from database.serializers import actor_serializer, movie_serializer, dumps
+from metrics import request_seconds
+
+try:
+    from a2wsgi import WSGIMiddleware
+    from starlette.applications import Starlette
+    from starlette.requests import Request
+    from starlette.responses import Response
+    from starlette.routing import Mount, Route
+except ImportError:
+    raise RuntimeError('The ASGI app requires the starlette and a2wsgi '
+                       'packages, see README.md')
+
+logger = logging.getLogger(__name__)
+
+'''
+The ASGI variant of the API
+
+    The read routes most clients poll, GET /movies, /movies/<id>, /actors
+    and /actors/<id>, run natively on the event loop: the token is
+    verified without blocking it (auth.get_principal_async) and the
+    queries run on an async driver (database.aio). They build their SQL,
+    ETags, bodies and error envelopes with the same code as the Flask app,
+    so both answer a request alike.
+
+    Every other request, writes and NDJSON streams included, is handed to
+    the Flask app on a thread pool of ASGI_WSGI_THREADS threads.
+
+    uvicorn --factory 'asgi:create_asgi_app'
+'''
+
+MESSAGES = {
+    401: 'Unauthorized',
+    404: 'Resource not found',
+    422: 'Unprocessable entity',
+    500: 'An error has occurred, please try again'
+}
+
+# the headers of the Flask app's after_request hook
+ACCESS_CONTROL = {
+    'Access-Control-Allow-Headers': 'Content-Type, Authorization, true',
+    'Access-Control-Allow-Methods': 'GET, POST, PATCH, DELETE, OPTIONS'
+}
+
+REPRESENTATIONS = ['application/json', 'application/x-ndjson']
+
+
+class Abort(Exception):
+    def __init__(self, status):
+        self.status = status
+
+
+def json_response(data, status=200, headers=None):
+    # the same bytes as database.serializers.json_response
+    return Response(dumps(data) + b'\n', status, headers,
+                    media_type='application/json')
+
+
+def error_response(status):
+    return json_response({
+        'success': False,
+        'error': status,
+        'message': MESSAGES[status]
+    }, status)
+
+
+def accept(request):
+    return parse_accept_header(request.headers.get('Accept'), MIMEAccept)
+
+
+def wants_stream(request):
+    if request.query_params.get('stream') in ('1', 'true'):
+        return True
+    return accept(request).best_match(REPRESENTATIONS) == \
+        'application/x-ndjson'
+
+
+async def cache_call(method, *args):
+    """runs an entity_cache method, on a worker thread for Redis"""
+    if isinstance(entity_cache.backend, RedisCache):
+        return await asyncio.to_thread(method, *args)
+    return method(*args)
+
+
+'''
+Endpoint
+    An ASGI app for one native route, doing what the requires_auth,
+    read_only and conditional decorators of the Flask app do around the
+    handler.
+
+    handler: async function(request, **path params) returning the
+     response data
+    permissions: the permissions, all required
+    tables: the tables the route reads
+    include: maps ?include= values to the extra tables they read
+'''
+
+
+class Endpoint:
+    def __init__(self, api, handler, permissions, tables, include):
+        self.api = api
+        self.handler = handler
+        self.permissions = frozenset(permissions)
+        self.tables = tables
+        self.include = include
+
+    async def __call__(self, scope, receive, send):
+        request = Request(scope, receive)
+        if wants_stream(request):
+            await self.api.wsgi(scope, receive, send)
+            return
+
+        start = time.perf_counter()
+        try:
+            await self.authorize(request)
+            response = await self.conditional(request)
+        except AuthError as e:
+            response = json_response(e.error, e.status_code)
+        except Abort as e:
+            response = error_response(e.status)
+        except Exception:
+            logger.exception('%s %s', request.method, request.url.path)
+            response = error_response(500)
+
+        response.headers.update(ACCESS_CONTROL)
+        # under the endpoint names of the Flask app
+        request_seconds.labels(
+            self.handler.__name__, request.method, str(response.status_code)
+        ).observe(time.perf_counter() - start)
+        await response(scope, receive, send)
+
+    async def authorize(self, request):
+        # AuthError for a missing or malformed header, 401 otherwise
+        token = parse_auth_header(request.headers.get('Authorization'))
+        try:
+            principal = await get_principal_async(token)
+            check_permissions(self.permissions, principal)
+        except Exception as e:
+            logger.info('%s', e)
+            raise Abort(401)
+
+        request.state.principal = principal
+
+    async def conditional(self, request):
+        names = set(self.tables)
+        for name in request.query_params.get('include', '').split(','):
+            names.update(self.include.get(name, ()))
+
+        names = sorted(names)
+        versions = dict.fromkeys(names, 0)
+        versions.update(await self.api.database.fetch(
+            versions_statement(names)))
+
+        full_path = request.url.path + '?' + \
+            request.scope['query_string'].decode('utf-8', 'replace')
+        etag = hashlib.sha1('|'.join([
+            repr(sorted(versions.items())),
+            full_path,
+            accept(request).best_match(REPRESENTATIONS) or ''
+        ]).encode('utf-8')).hexdigest()
+
+        headers = {
+            'Cache-Control': self.api.config['CACHE_CONTROL'],
+            'Vary': 'Accept, Authorization',
+            'ETag': quote_etag(etag)
+        }
+
+        # handlers that depend on a table version read it here
+        request.state.table_versions = versions
+
+        if etag in parse_etags(request.headers.get('If-None-Match')):
+            return Response(status_code=304, headers=headers)
+
+        return json_response(
+            await self.handler(request, **request.path_params),
+            headers=headers)
+
+
+'''
+AsyncApi
+    The handlers of the native routes and what they share: the Flask app,
+    its config, the async database and the Flask app as an ASGI app.
+'''
+
+
+class AsyncApi:
+    def __init__(self, app, threads):
+        self.app = app
+        self.config = app.config
+        self.database = AsyncDatabase(app.config['SQLALCHEMY_DATABASE_URI'],
+                                      app.config)
+        self.wsgi = WSGIMiddleware(app, workers=threads)
+
+    def args(self, request, serializer):
+        """the include and fields arguments, see database.queries"""
+        try:
+            return include_arg(request.query_params, serializer), \
+                fields_arg(request.query_params, serializer)
+        except ValueError:
+            raise Abort(422)
+
+    async def dicts(self, serializer, rows, include):
+        items = serializer.items(rows)
+        ids = [item['id'] for item in items]
+        for name in include:
+            relation = serializer.relations[name]
+            related = relation.group(
+                await self.database.fetch(relation.statement(ids))
+            ) if ids else {}
+            serializer.attach(items, name, related)
+        return items
+
+    async def list(self, request, serializer, filters, sorts, column):
+        include, serializer = self.args(request, serializer)
+        try:
+            query, sort, descending = list_query(
+                Query(serializer.columns()), serializer,
+                request.query_params, filters, sorts)
+            limit, after = page_args(request.query_params,
+                                     self.config['PAGE_SIZE'],
+                                     self.config['MAX_PAGE_SIZE'])
+            query = keyset_query(query, column, limit, after, sort,
+                                 descending)
+        except ValueError:
+            raise Abort(422)
+
+        rows, next_cursor = keyset_result(
+            await self.database.fetch(query.statement), column, limit, sort)
+        return await self.dicts(serializer, rows, include), next_cursor
+
+    async def detail(self, request, kind, full, column, id):
+        include, serializer = self.args(request, full)
+
+        # only the plain, full representation is cached, tagged with the
+        # version of the table it was read at
+        version = request.state.table_versions[column.class_.__tablename__]
+        item = await cache_call(entity_cache.get, kind, id, version) \
+            if not include else None
+        if item is not None:
+            return {name: item[name] for name in serializer.fields}
+
+        rows = await self.database.fetch(
+            Query(serializer.columns()).filter(column == id).statement)
+        if not rows:
+            raise Abort(404)
+
+        (item,) = await self.dicts(serializer, rows[:1], include)
+        if not include and serializer is full:
+            await cache_call(entity_cache.set, kind, id, version, item)
+        return item
+
+    async def get_all_movies(self, request):
+        movies, next_cursor = await self.list(
+            request, movie_serializer, movie_filters, MOVIE_SORTS, Movie.id)
+        return {
+            'success': True,
+            'movies': movies,
+            'next_cursor': next_cursor
+        }
+
+    async def get_movie_by_id(self, request, id):
+        return {
+            'success': True,
+            'movie': await self.detail(request, 'movie', movie_serializer,
+                                       Movie.id, id)
+        }
+
+    async def get_actors(self, request):
+        actors, next_cursor = await self.list(
+            request, actor_serializer, actor_filters, ACTOR_SORTS, Actor.id)
+        return {
+            'success': True,
+            'actors': actors,
+            'next_cursor': next_cursor
+        }
+
+    async def get_actor_by_id(self, request, id):
+        return {
+            'success': True,
+            'actor': await self.detail(request, 'actor', actor_serializer,
+                                       Actor.id, id)
+        }
+
+
+def create_asgi_app(test_config=None):
+    app = create_app(test_config)
+    app.config.setdefault('ASGI_WSGI_THREADS',
+                          int(os.environ.get('ASGI_WSGI_THREADS', 10)))
+    api = AsyncApi(app, app.config['ASGI_WSGI_THREADS'])
+
+    movies = ('movies',), {'cast': ('cast', 'actors')}
+    actors = ('actors',), {'movies': ('cast', 'movies')}
+
+    def route(path, handler, permission, tables):
+        return Route(path, Endpoint(api, handler, [permission], *tables),
+                     methods=['GET'])
+
+    @asynccontextmanager
+    async def lifespan(asgi_app):
+        warm_cast_graph(app)
+        yield
+        await api.database.close()
+
+    asgi_app = Starlette(routes=[
+        route('/movies', api.get_all_movies, 'get:movies', movies),
+        route('/movies/{id:int}', api.get_movie_by_id,
+              'get:movies-details', movies),
+        route('/actors', api.get_actors, 'get:actors', actors),
+        route('/actors/{id:int}', api.get_actor_by_id,
+              'get:actors-details', actors),
+        Mount('/', app=api.wsgi)
+    ], lifespan=lifespan)
+    asgi_app.state.api = api
+    return asgi_app
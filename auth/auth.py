@@ -1,13 +1,79 @@
-import json
-from flask import request, _request_ctx_stack, abort
-from functools import wraps
+from flask import request, _request_ctx_stack, abort, g
+from collections import namedtuple
+import asyncio
+from functools import lru_cache, wraps
 from jose import jwt
-from urllib.request import urlopen
+import logging
 import os
+import time
+
+from auth.jwks import JWKSKeyStore
+from auth.token_cache import TokenCache
+from metrics import registry, auth_verify_seconds
+
+logger = logging.getLogger(__name__)
+
+'''
+auth_settings() method
+    reads the Auth0 configuration from the environment on first use,
+    so importing the app needs no configuration
+        AUTH0_DOMAIN, ALGORITHMS, API_AUDIENCE
+        JWKS_URL: may point at a local JWKS file or stand-in server for
+         testing
+'''
+
+AuthSettings = namedtuple('AuthSettings',
+                          ['domain', 'algorithms', 'audience', 'jwks_url'])
+
+
+@lru_cache(maxsize=None)
+def auth_settings():
+    domain = os.environ['AUTH0_DOMAIN']
+    return AuthSettings(
+        domain,
+        os.environ['ALGORITHMS'],
+        os.environ['API_AUDIENCE'],
+        os.environ.get('JWKS_URL',
+                       f'https://{domain}/.well-known/jwks.json')
+    )
+
+
+# created by get_jwks_store on the first token verification
+jwks_store = None
+
+
+def get_jwks_store():
+    global jwks_store
+    if jwks_store is None:
+        jwks_store = JWKSKeyStore(
+            auth_settings().jwks_url,
+            ttl=int(os.environ.get('JWKS_CACHE_TTL', 600)),
+            min_refresh_interval=int(
+                os.environ.get('JWKS_MIN_REFRESH_INTERVAL', 30))
+        )
+    return jwks_store
+
+
+# verified payloads of recently seen tokens, see requires_auth
+token_cache = TokenCache(maxsize=int(os.environ.get('TOKEN_CACHE_SIZE', 1024)))
+
+verified_seconds = auth_verify_seconds.labels('verified')
+rejected_seconds = auth_verify_seconds.labels('rejected')
+
+
+@registry.collector
+def token_cache_metrics():
+    stats = token_cache.stats()
+    return [
+        ('castu_token_cache_hits', 'counter',
+         'Tokens found in the token cache.', stats['hits']),
+        ('castu_token_cache_misses', 'counter',
+         'Tokens verified because they were not in the token cache.',
+         stats['misses']),
+        ('castu_token_cache_size', 'gauge',
+         'Tokens in the token cache.', stats['size'])
+    ]
 
-AUTH0_DOMAIN = os.environ['AUTH0_DOMAIN']
-ALGORITHMS = os.environ['ALGORITHMS']
-API_AUDIENCE = os.environ['API_AUDIENCE']
 
 # AuthError Exception
 '''
@@ -22,6 +88,48 @@ class AuthError(Exception):
         self.status_code = status_code
 
 
+# Error bodies raised by check_permissions, built once at import
+PERMISSIONS_MISSING = {
+    'code': 'invalid_claims',
+    'description': 'Permissions not included in JWT.'
+}
+
+PERMISSION_NOT_FOUND = {
+    'code': 'unauthorized',
+    'description': 'Permission not found'
+}
+
+
+'''
+Principal
+    A decoded jwt payload normalized once, when the token is first
+    verified, and cached along with it.
+
+    permissions is a frozenset, or None if the payload has no permissions
+    claim, so permission checks are set operations.
+'''
+
+
+class Principal:
+    __slots__ = ('payload', 'subject', 'permissions', 'expires_at')
+
+    def __init__(self, payload):
+        self.payload = payload
+        self.subject = payload.get('sub')
+        self.expires_at = payload.get('exp')
+
+        permissions = payload.get('permissions')
+        self.permissions = frozenset(permissions) \
+            if permissions is not None else None
+
+    def has_all(self, permissions):
+        return permissions <= self.permissions
+
+    def has_any(self, permissions):
+        return not permissions or \
+            not self.permissions.isdisjoint(permissions)
+
+
 # Auth Header
 
 '''
@@ -37,7 +145,13 @@ class AuthError(Exception):
 def get_token_auth_header():
     """Obtains the Access Token from the Authorization Header
     """
-    auth = request.headers.get('Authorization', None)
+    return parse_auth_header(request.headers.get('Authorization', None))
+
+
+def parse_auth_header(auth):
+    """Returns the token of an Authorization header value, see
+    get_token_auth_header
+    """
     if not auth:
         raise AuthError({
             'code': 'authorization_header_missing',
@@ -70,29 +184,35 @@ def get_token_auth_header():
 '''
     check_permissions(permission, payload) method
     @INPUTS
-        permission: string permission (i.e. 'post:drink')
-        payload: decoded jwt payload
+        permission: string permission (i.e. 'post:drink'), or a set of them
+        payload: decoded jwt payload or Principal
+        require_all: whether every permission is required, or any one
 
     raises an AuthError if permissions are not included in the payload
-    raises an AuthError if the requested permission string is
+    raises an AuthError if the requested permissions are
      not in the payload permissions array
     returns true otherwise
 '''
 
 
-def check_permissions(permission, payload):
+def check_permissions(permission, payload, require_all=True):
+    principal = payload if isinstance(payload, Principal) \
+        else Principal(payload)
 
-    if 'permissions' not in payload:
-        raise AuthError({
-            'code': 'invalid_claims',
-            'description': 'Permissions not included in JWT.'
-        }, 400)
+    if principal.permissions is None:
+        raise AuthError(PERMISSIONS_MISSING, 400)
 
-    if permission not in payload['permissions']:
-        raise AuthError({
-            'code': 'unauthorized',
-            'description': 'Permission not found'
-        }, 403)
+    # frozenset() returns an already frozen set unchanged
+    required = frozenset((permission,)) if isinstance(permission, str) \
+        else frozenset(permission)
+
+    if require_all:
+        allowed = principal.has_all(required)
+    else:
+        allowed = principal.has_any(required)
+
+    if not allowed:
+        raise AuthError(PERMISSION_NOT_FOUND, 403)
 
     return True
 
@@ -103,7 +223,7 @@ def check_permissions(permission, payload):
         token: a json web token (string)
 
     it should be an Auth0 token with key id (kid)
-    verifies the token using Auth0 /.well-known/jwks.json
+    verifies the token using the key cached by the jwks store for its kid
     decodes the payload from the token
     validates the claims
     returns the decoded payload
@@ -114,38 +234,27 @@ def check_permissions(permission, payload):
 
 
 def verify_decode_jwt(token):
-    jsonurl = urlopen(f'https://{AUTH0_DOMAIN}/.well-known/jwks.json')
-    jwks = json.loads(jsonurl.read())
     unverified_header = jwt.get_unverified_header(token)
 
-    rsa_key = {}
     if 'kid' not in unverified_header:
         raise AuthError({
             'code': 'invalid_header',
             'description': 'Authorization malformed.'
         }, 401)
 
-    for key in jwks['keys']:
+    rsa_key = get_jwks_store().get_key(unverified_header['kid'])
 
-        if key['kid'] == unverified_header['kid']:
-
-            rsa_key = {
-                'kty': key['kty'],
-                'kid': key['kid'],
-                'use': key['use'],
-                'n': key['n'],
-                'e': key['e']
-            }
-
-    if rsa_key:
+    if rsa_key is not None:
+        settings = auth_settings()
         try:
 
             payload = jwt.decode(
                 token,
-                rsa_key,
-                algorithms=ALGORITHMS,
-                audience=API_AUDIENCE,
-                issuer='https://' + AUTH0_DOMAIN + '/'
+                # a list, so jose uses the parsed key object as-is
+                [rsa_key],
+                algorithms=settings.algorithms,
+                audience=settings.audience,
+                issuer='https://' + settings.domain + '/'
             )
 
             return payload
@@ -175,32 +284,89 @@ def verify_decode_jwt(token):
             }, 400)
 
 
+def verify_principal(token):
+    """verifies a token missing from the token_cache, and caches its
+    Principal
+    """
+    start = time.perf_counter()
+    try:
+        principal = Principal(verify_decode_jwt(token))
+    except Exception:
+        rejected_seconds.observe(time.perf_counter() - start)
+        raise
+    verified_seconds.observe(time.perf_counter() - start)
+    token_cache.put(token, principal, principal.expires_at)
+    return principal
+
+
+'''
+    get_principal(token) method
+    @INPUTS
+        token: a json web token (string)
+
+    uses the token_cache to reuse the principal of a recently verified token
+    uses the verify_decode_jwt method to decode the jwt on a cache miss
+    returns the Principal for the token
+'''
+
+
+def get_principal(token):
+    principal = token_cache.get(token)
+    if principal is None:
+        principal = verify_principal(token)
+
+    return principal
+
+
+async def get_principal_async(token):
+    """get_principal for the event loop of the ASGI app
+
+    a cached token is resolved inline; a new one is verified on a worker
+    thread, since an unknown kid fetches the JWKS with urlopen
+    """
+    principal = token_cache.get(token)
+    if principal is None:
+        principal = await asyncio.to_thread(verify_principal, token)
+
+    return principal
+
+
 '''
-    requires_auth(permission) decorator method
+    requires_auth(*permissions, require='all') decorator method
     @INPUTS
-        permission: string permission (i.e. 'post:drink')
+        permissions: string permissions (i.e. 'post:drink')
+        require: 'all' if every permission is required, 'any' if one is
 
     uses the get_token_auth_header method to get the token
-    uses the verify_decode_jwt method to decode the jwt
+    uses the get_principal method to verify and decode the jwt
     uses the check_permissions method validate claims and check the
-    requested permission
+    requested permissions
+    stores the principal on flask.g
     returns the decorator which passes the decoded payload to the
     decorated method
 '''
 
 
-def requires_auth(permission=''):
+def requires_auth(*permissions, require='all'):
+    if require not in ('all', 'any'):
+        raise ValueError("require must be 'all' or 'any'")
+
+    required = frozenset(permission for permission in permissions
+                         if permission)
+    require_all = require == 'all'
+
     def requires_auth_decorator(f):
         @wraps(f)
         def wrapper(*args, **kwargs):
             token = get_token_auth_header()
             try:
-                payload = verify_decode_jwt(token)
-                check_permissions(permission, payload)
+                principal = get_principal(token)
+                check_permissions(required, principal, require_all)
             except Exception as e:
-                print(e)
+                logger.info('Unauthorized: %s', e)
                 abort(401)
 
-            return f(payload, *args, **kwargs)
+            g.principal = principal
+            return f(principal.payload, *args, **kwargs)
         return wrapper
     return requires_auth_decorator
@@ -0,0 +1,160 @@
+import json
+import logging
+import os
+import threading
+import time
+from urllib.parse import urlparse
+from urllib.request import urlopen
+
+from jose import jwk
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_ALGORITHM = 'RS256'
+
+
+'''
+    parse_jwks(document) method
+    @INPUTS
+        document: a decoded JWKS document (dict with a 'keys' array)
+
+    builds a ready-to-use public key object for every RSA signing key
+    skips keys that can not be used to verify signatures
+    returns a dict of key objects keyed by key id (kid)
+'''
+
+
+def parse_jwks(document):
+    keys = {}
+    for key in document.get('keys', []):
+        if key.get('kty') != 'RSA' or 'kid' not in key:
+            continue
+        if key.get('use', 'sig') != 'sig':
+            continue
+
+        try:
+            constructed = jwk.construct(
+                key, key.get('alg', DEFAULT_ALGORITHM))
+        except Exception as e:
+            logger.warning('Skipping JWKS key %s: %s', key['kid'], e)
+            continue
+
+        # jose keeps the parsed backend key on the constructed object;
+        # handing that back to jwt.decode skips re-parsing the modulus
+        # and exponent on every verification.
+        keys[key['kid']] = getattr(
+            constructed, 'prepared_key',
+            getattr(constructed, '_prepared_key', key))
+
+    return keys
+
+
+'''
+JWKSKeyStore
+    In-process cache of the signing keys published in a JWKS document.
+
+    Keys are refreshed by a daemon thread every `ttl` seconds. An unknown
+    kid triggers an on-demand fetch, at most once per
+    `min_refresh_interval` seconds, so forged tokens can not cause a fetch
+    storm. When the provider is unreachable the last good key set keeps
+    being served.
+
+    `url` may be an http(s) or file:// URL or a local path to a JWKS file.
+'''
+
+
+class JWKSKeyStore:
+    def __init__(self, url, ttl=600, min_refresh_interval=30, timeout=5):
+        self.url = url
+        self.ttl = ttl
+        self.min_refresh_interval = min_refresh_interval
+        self.timeout = timeout
+
+        self._keys = {}
+        self._fetched_at = None
+        self._attempted_at = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._refresher = None
+        self._refresher_pid = None
+
+    def get_key(self, kid):
+        """Returns the parsed key for kid, or None if it is unknown
+        """
+        self._ensure_refresher()
+
+        key = self._keys.get(kid)
+        if key is None:
+            # The provider may have rotated its keys since the last fetch.
+            self.refresh(force=False)
+            key = self._keys.get(kid)
+
+        return key
+
+    def refresh(self, force=True):
+        """Fetches the JWKS document and swaps in the new key set
+
+        Unforced refreshes are skipped when the previous attempt was less
+        than `min_refresh_interval` seconds ago. Returns True if the key
+        set was replaced.
+        """
+        with self._lock:
+            now = time.monotonic()
+            if not force and self._attempted_at is not None \
+                    and now - self._attempted_at < self.min_refresh_interval:
+                return False
+
+            self._attempted_at = now
+            try:
+                keys = parse_jwks(self._fetch())
+            except Exception as e:
+                # Keep serving the stale key set while the provider is down.
+                logger.warning('Unable to refresh JWKS from %s: %s',
+                               self.url, e)
+                return False
+
+            self._keys = keys
+            self._fetched_at = now
+            return True
+
+    def is_stale(self):
+        if self._fetched_at is None:
+            return True
+        return time.monotonic() - self._fetched_at > self.ttl
+
+    def close(self):
+        self._stop.set()
+
+    def _fetch(self):
+        if urlparse(self.url).scheme in ('http', 'https', 'file'):
+            with urlopen(self.url, timeout=self.timeout) as response:
+                return json.loads(response.read())
+
+        with open(self.url) as f:
+            return json.load(f)
+
+    def _ensure_refresher(self):
+        # Threads do not survive fork(), so a pre-forking server needs a
+        # refresher per worker process.
+        pid = os.getpid()
+        if self._refresher_pid == pid and self._refresher.is_alive():
+            return
+
+        with self._lock:
+            if self._refresher_pid == pid and self._refresher.is_alive():
+                return
+            self._stop.clear()
+            self._refresher = threading.Thread(
+                target=self._refresh_forever, name='jwks-refresh',
+                daemon=True)
+            self._refresher_pid = pid
+            self._refresher.start()
+
+    def _refresh_forever(self):
+        while True:
+            # Retry sooner while the provider is failing.
+            wait = self.ttl if not self.is_stale() \
+                else min(self.ttl, self.min_refresh_interval)
+            if self._stop.wait(wait):
+                return
+            self.refresh(force=True)
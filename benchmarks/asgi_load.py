@@ -0,0 +1,201 @@
+'''
+Load tests the Flask app under gunicorn and the ASGI app under uvicorn,
+side by side, on the same database.
+
+    python benchmarks/asgi_load.py [--actors N] [--movies N] [--workers N]
+                                   [--concurrency N] [--requests N]
+                                   [--database-url URL]
+
+Fills a temporary SQLite database (or an empty DATABASE_URL with
+--database-url), starts `gunicorn 'app:create_app()'` with sync workers and
+`uvicorn --factory asgi:create_asgi_app` with the same number of worker
+processes, and sends each the same mix of GET /actors, /actors/<id> and
+/movies?include=cast requests from --concurrency concurrent clients.
+Tokens are signed with a throwaway key whose JWKS is served from a file.
+Requires gunicorn, uvicorn, httpx and the ASGI app's packages.
+'''
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import date
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import httpx  # noqa: E402
+from cryptography.hazmat.primitives import serialization  # noqa: E402
+from cryptography.hazmat.primitives.asymmetric import rsa  # noqa: E402
+from jose import jwk, jwt  # noqa: E402
+
+from app import create_app  # noqa: E402
+from database.models import db, Actor, Movie  # noqa: E402
+
+PERMISSIONS = ['get:actors', 'get:actors-details', 'get:movies']
+
+
+def fill(database_url, actors, movies):
+    app = create_app({'SQLALCHEMY_DATABASE_URI': database_url,
+                      'ENTITY_CACHE': 'none'})
+    rng = random.Random(0)
+    with app.app_context():
+        db.create_all()
+        actor_ids = Actor.insert_many([
+            {'name': 'Actor {}'.format(i), 'age': 20 + i % 50,
+             'gender': 'F'}
+            for i in range(actors)
+        ])
+        Movie.insert_many([
+            {'title': 'Movie {}'.format(i), 'release_date': date(2000, 1, 1),
+             'cast': rng.sample(actor_ids, min(5, len(actor_ids)))}
+            for i in range(movies)
+        ])
+    return actor_ids
+
+
+def signing_key(directory):
+    """returns (token, JWKS_URL) of a throwaway key"""
+    key = rsa.generate_private_key(65537, 2048).private_bytes(
+        serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8,
+        serialization.NoEncryption())
+    public = {
+        name: value.decode() if isinstance(value, bytes) else value
+        for name, value in jwk.construct(key, 'RS256').public_key()
+        .to_dict().items()
+    }
+    public.update(kid='bench', use='sig')
+
+    path = os.path.join(directory, 'jwks.json')
+    with open(path, 'w') as f:
+        json.dump({'keys': [public]}, f)
+
+    token = jwt.encode({
+        'iss': 'https://bench.local/', 'aud': 'bench', 'sub': 'bench|load',
+        'exp': int(time.time()) + 3600, 'permissions': PERMISSIONS
+    }, key, algorithm='RS256', headers={'kid': 'bench'})
+    return token, 'file://' + path
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start(command, port, env):
+    server = subprocess.Popen(command, cwd=ROOT, env=env,
+                              stdout=subprocess.DEVNULL,
+                              stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            httpx.get('http://127.0.0.1:{}/'.format(port), timeout=1)
+            return server
+        except httpx.TransportError:
+            time.sleep(0.2)
+    server.kill()
+    raise RuntimeError('server did not start: ' + ' '.join(command))
+
+
+async def load(port, token, urls, concurrency, requests):
+    headers = {'Authorization': 'Bearer ' + token,
+               'Accept': 'application/json'}
+    latencies, errors = [], 0
+    remaining = iter(range(requests))
+
+    async with httpx.AsyncClient(
+            base_url='http://127.0.0.1:{}'.format(port), headers=headers,
+            timeout=60, limits=httpx.Limits(
+                max_connections=concurrency)) as client:
+        async def worker(rng):
+            nonlocal errors
+            for _ in remaining:
+                start = time.perf_counter()
+                try:
+                    res = await client.get(rng.choice(urls))
+                    ok = res.status_code == 200
+                except httpx.HTTPError:
+                    ok = False
+                latencies.append((time.perf_counter() - start) * 1000)
+                errors += not ok
+
+        start = time.perf_counter()
+        await asyncio.gather(*(worker(random.Random(i))
+                               for i in range(concurrency)))
+        elapsed = time.perf_counter() - start
+
+    return requests / elapsed, latencies, errors
+
+
+def percentiles(latencies):
+    latencies = sorted(latencies)
+
+    def percentile(p):
+        return latencies[min(len(latencies) - 1,
+                             int(len(latencies) * p / 100))]
+
+    return percentile(50), percentile(95), percentile(99), \
+        statistics.mean(latencies)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--actors', type=int, default=10000)
+    parser.add_argument('--movies', type=int, default=5000)
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--concurrency', type=int, default=200)
+    parser.add_argument('--requests', type=int, default=5000)
+    parser.add_argument('--database-url')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        database_url = args.database_url or \
+            'sqlite:///' + os.path.join(directory, 'load.db')
+        actor_ids = fill(database_url, args.actors, args.movies)
+        token, jwks_url = signing_key(directory)
+        env = dict(os.environ, DATABASE_URL=database_url, JWKS_URL=jwks_url,
+                   AUTH0_DOMAIN='bench.local', ALGORITHMS="['RS256']",
+                   API_AUDIENCE='bench')
+
+        rng = random.Random(1)
+        urls = ['/actors', '/movies?include=cast'] + [
+            '/actors/{}'.format(rng.choice(actor_ids)) for _ in range(50)]
+
+        servers = (
+            ('gunicorn', lambda port: [
+                sys.executable, '-m', 'gunicorn', '--workers',
+                str(args.workers), '--bind', '127.0.0.1:{}'.format(port),
+                'app:create_app()']),
+            ('uvicorn', lambda port: [
+                sys.executable, '-m', 'uvicorn', '--factory', '--workers',
+                str(args.workers), '--port', str(port), '--log-level',
+                'warning', 'asgi:create_asgi_app']),
+        )
+        for name, command in servers:
+            port = free_port()
+            server = start(command(port), port, env)
+            try:
+                # verifies the token and warms the workers up
+                asyncio.run(load(port, token, urls, args.workers * 4,
+                                 args.workers * 40))
+                throughput, latencies, errors = asyncio.run(load(
+                    port, token, urls, args.concurrency, args.requests))
+            finally:
+                server.terminate()
+                server.wait()
+
+            print('{:8} {:7.0f} req/s   p50 {:.1f} ms   p95 {:.1f} ms   '
+                  'p99 {:.1f} ms   mean {:.1f} ms   {} errors'.format(
+                      name, throughput, *percentiles(latencies), errors))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
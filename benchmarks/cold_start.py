@@ -0,0 +1,72 @@
+'''
+Measures the cold start of a worker in a fresh interpreter: the time to
+import the app module, to build the app, and to serve its first request.
+
+    python benchmarks/cold_start.py [--runs N] [--budget MS]
+
+Exits with status 1 when the median time to first request is over the
+budget (COLD_START_BUDGET_MS, default 1500). Only DATABASE_URL needs to
+be set; no connection is opened while starting.
+'''
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+PROBE = '''
+import json, time
+start = time.perf_counter()
+import app
+imported = time.perf_counter()
+application = app.create_app()
+created = time.perf_counter()
+status = application.test_client().get('/').status_code
+served = time.perf_counter()
+print(json.dumps({
+    'import_ms': (imported - start) * 1000,
+    'create_app_ms': (created - imported) * 1000,
+    'first_request_ms': (served - start) * 1000,
+    'status': status
+}))
+'''
+
+
+def probe():
+    output = subprocess.run(
+        [sys.executable, '-c', PROBE], cwd=ROOT, check=True,
+        stdout=subprocess.PIPE).stdout
+    return json.loads(output.decode().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--budget', type=float, default=float(
+        os.environ.get('COLD_START_BUDGET_MS', 1500)))
+    args = parser.parse_args()
+
+    runs = [probe() for _ in range(args.runs)]
+    for key in ('import_ms', 'create_app_ms', 'first_request_ms'):
+        values = [run[key] for run in runs]
+        print('{:<18} median {:8.1f} ms   max {:8.1f} ms'.format(
+            key, statistics.median(values), max(values)))
+
+    median = statistics.median(run['first_request_ms'] for run in runs)
+    if any(run['status'] != 200 for run in runs):
+        print('first request failed')
+        return 1
+    if median > args.budget:
+        print('over budget: {:.1f} ms > {:.1f} ms'.format(
+            median, args.budget))
+        return 1
+
+    print('within budget of {:.1f} ms'.format(args.budget))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
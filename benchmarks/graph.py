@@ -0,0 +1,131 @@
+'''
+Measures GET /actors/<a>/path/<b> and GET /actors/<id>/costars latency on
+a large cast graph.
+
+    python benchmarks/graph.py [--actors N] [--movies N] [--cast N]
+                               [--requests N] [--budget MS] [--sql]
+
+Fills a temporary SQLite database (or DATABASE_URL with --database-url)
+with movies of --cast random actors each, 1M cast rows by default, and
+times path and co-star requests between random actors. --sql measures
+the recursive CTE fallback instead of the in-memory graph, with fewer
+requests. Exits with status 1 when the in-memory path p95 is over the
+budget (GRAPH_P95_BUDGET_MS, default 50).
+'''
+import argparse
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+from datetime import date
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import create_app  # noqa: E402
+from auth import auth  # noqa: E402
+from database.models import db, Actor, Movie  # noqa: E402
+
+
+def fill(actors, movies, cast_size):
+    rng = random.Random(0)
+    actor_ids = []
+    for start in range(0, actors, 10000):
+        actor_ids += Actor.insert_many([
+            {'name': 'Actor {}'.format(i), 'age': 30, 'gender': 'F'}
+            for i in range(start, min(start + 10000, actors))
+        ])
+    for start in range(0, movies, 10000):
+        Movie.insert_many([
+            {'title': 'Movie {}'.format(i), 'release_date': date(2000, 1, 1),
+             'cast': rng.sample(actor_ids, cast_size)}
+            for i in range(start, min(start + 10000, movies))
+        ])
+    return actor_ids
+
+
+def percentiles(latencies):
+    latencies = sorted(latencies)
+
+    def percentile(p):
+        return latencies[min(len(latencies) - 1,
+                             int(len(latencies) * p / 100))]
+
+    return percentile(50), percentile(95), percentile(99), \
+        statistics.mean(latencies)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--actors', type=int, default=200000)
+    parser.add_argument('--movies', type=int, default=100000)
+    parser.add_argument('--cast', type=int, default=10)
+    parser.add_argument('--requests', type=int, default=500)
+    parser.add_argument('--sql', action='store_true')
+    parser.add_argument('--database-url')
+    parser.add_argument('--budget', type=float, default=float(
+        os.environ.get('GRAPH_P95_BUDGET_MS', 50)))
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        app = create_app({
+            'SQLALCHEMY_DATABASE_URI': args.database_url or
+            'sqlite:///' + os.path.join(directory, 'graph.db'),
+            'ENTITY_CACHE': 'none',
+            'CAST_GRAPH': 'sql' if args.sql else 'memory'
+        })
+        start = time.perf_counter()
+        with app.app_context():
+            db.create_all()
+            actor_ids = fill(args.actors, args.movies, args.cast)
+        print('{} cast rows written in {:.1f} s'.format(
+            args.movies * args.cast, time.perf_counter() - start))
+
+        principal = auth.Principal({
+            'sub': 'bench|graph', 'exp': time.time() + 3600,
+            'permissions': ['get:actors', 'get:movies']
+        })
+        auth.token_cache.put('bench-token', principal, principal.expires_at)
+        headers = {'Authorization': 'Bearer bench-token'}
+        client = app.test_client()
+        rng = random.Random(1)
+
+        def timed(url):
+            start = time.perf_counter()
+            res = client.get(url, headers=headers)
+            assert res.status_code == 200, res.status_code
+            return (time.perf_counter() - start) * 1000, res.get_json()
+
+        # the first request loads the in-memory graph
+        elapsed, _ = timed('/actors/{}/costars'.format(actor_ids[0]))
+        print('warm up: {:.0f} ms'.format(elapsed))
+
+        requests = args.requests if not args.sql else \
+            max(1, args.requests // 50)
+        paths, costars, degrees = [], [], []
+        for _ in range(requests):
+            source, target = rng.sample(actor_ids, 2)
+            elapsed, body = timed('/actors/{}/path/{}'.format(source,
+                                                              target))
+            paths.append(elapsed)
+            degrees.append(body['degrees'])
+            elapsed, _ = timed('/actors/{}/costars'.format(source))
+            costars.append(elapsed)
+
+    connected = [degree for degree in degrees if degree is not None]
+    print('{} path requests, mean degrees {:.2f}, {} unconnected'.format(
+        requests, statistics.mean(connected) if connected else 0,
+        len(degrees) - len(connected)))
+    for name, latencies in (('path', paths), ('costars', costars)):
+        print('{:8} p50 {:.1f} ms   p95 {:.1f} ms   p99 {:.1f} ms   '
+              'mean {:.1f} ms'.format(name, *percentiles(latencies)))
+
+    if not args.sql and percentiles(paths)[1] > args.budget:
+        print('over budget: path p95 > {:.0f} ms'.format(args.budget))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
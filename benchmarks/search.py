@@ -0,0 +1,127 @@
+'''
+Measures GET /search latency under concurrent load.
+
+    python benchmarks/search.py [--actors N] [--movies N] [--threads N]
+                                [--requests N] [--budget MS]
+
+Fills a temporary SQLite database (or DATABASE_URL with --database-url,
+i.e. a Postgres database after `python manage.py db upgrade`), runs
+typo'd and exact queries from several threads and prints the latency
+percentiles. Exits with status 1 when p95 is over the budget
+(SEARCH_P95_BUDGET_MS, default 100).
+'''
+import argparse
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import create_app  # noqa: E402
+from auth import auth  # noqa: E402
+from database.models import db, Actor, Movie  # noqa: E402
+
+SYLLABLES = ['ka', 'ro', 'mi', 'lan', 'ste', 'von', 'ha', 'ri', 'son',
+             'el', 'da', 'tor', 'ne', 'bel', 'ma', 'quin', 'zu', 'ar',
+             'len', 'po', 'ter', 'sa', 'vi', 'dor', 'cal', 'fe', 'go']
+QUERIES = ['emma stone', 'Stoen', 'tom hanks', 'cruela', 'dark knight',
+           'potter', 'Washingtn', 'kalan', 'ritor mason', 'velquin']
+
+
+def word(rng):
+    return ''.join(rng.choice(SYLLABLES)
+                   for _ in range(rng.randint(2, 3))).capitalize()
+
+
+def fill(actors, movies):
+    """actors with two made up names, movies with three made up words;
+    a few well known names and titles are mixed in for the queries
+    """
+    rng = random.Random(0)
+    known_actors = ['Emma Stone', 'Tom Hanks', 'Denzel Washington']
+    known_movies = ['Cruella', 'The Dark Knight', 'Harry Potter']
+
+    for start in range(0, actors, 10000):
+        Actor.insert_many([
+            {'name': known_actors[i % 3] if i % 1000 == 0
+             else word(rng) + ' ' + word(rng),
+             'age': rng.randint(18, 90), 'gender': rng.choice('FM')}
+            for i in range(start, min(start + 10000, actors))
+        ])
+    for start in range(0, movies, 10000):
+        Movie.insert_many([
+            {'title': known_movies[i % 3] if i % 1000 == 0
+             else ' '.join(word(rng) for _ in range(3)),
+             'release_date': date(2000 + i % 20, 1, 1), 'cast': []}
+            for i in range(start, min(start + 10000, movies))
+        ])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--actors', type=int, default=100000)
+    parser.add_argument('--movies', type=int, default=50000)
+    parser.add_argument('--threads', type=int, default=4)
+    parser.add_argument('--requests', type=int, default=400)
+    parser.add_argument('--database-url')
+    parser.add_argument('--budget', type=float, default=float(
+        os.environ.get('SEARCH_P95_BUDGET_MS', 100)))
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        app = create_app({
+            'SQLALCHEMY_DATABASE_URI': args.database_url or
+            'sqlite:///' + os.path.join(directory, 'search.db'),
+            'ENTITY_CACHE': 'none'
+        })
+        with app.app_context():
+            db.create_all()
+            fill(args.actors, args.movies)
+
+        principal = auth.Principal({
+            'sub': 'bench|search', 'exp': time.time() + 3600,
+            'permissions': ['get:actors', 'get:movies']
+        })
+        auth.token_cache.put('bench-token', principal, principal.expires_at)
+        headers = {'Authorization': 'Bearer bench-token'}
+
+        def request(i):
+            client = app.test_client()
+            start = time.perf_counter()
+            res = client.get('/search', headers=headers,
+                             query_string={'q': QUERIES[i % len(QUERIES)],
+                                           'limit': 20})
+            assert res.status_code == 200, res.status_code
+            return (time.perf_counter() - start) * 1000
+
+        # the first search loads the in-process index
+        print('warm up: {:.0f} ms'.format(request(0)))
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(args.threads) as pool:
+            latencies = sorted(pool.map(request, range(args.requests)))
+        elapsed = time.perf_counter() - start
+
+    def percentile(p):
+        return latencies[min(len(latencies) - 1,
+                             int(len(latencies) * p / 100))]
+
+    print('{} requests, {} threads, {:.0f} requests/s'.format(
+        args.requests, args.threads, args.requests / elapsed))
+    print('p50 {:.1f} ms   p95 {:.1f} ms   p99 {:.1f} ms   mean {:.1f} ms'
+          .format(percentile(50), percentile(95), percentile(99),
+                  statistics.mean(latencies)))
+
+    if percentile(95) > args.budget:
+        print('over budget: p95 > {:.0f} ms'.format(args.budget))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
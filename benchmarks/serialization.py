@@ -0,0 +1,92 @@
+'''
+Compares the two ways of producing a list response over a large table:
+ORM objects with format() and jsonify, and the column-tuple serializer
+with dumps (orjson when installed).
+
+    python benchmarks/serialization.py [--rows N] [--runs N]
+
+Runs against a temporary SQLite database filled with N actors (default
+100000) and prints the rows per second of each path.
+'''
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flask import jsonify  # noqa: E402
+
+from app import create_app  # noqa: E402
+from database.models import db, Actor  # noqa: E402
+from database.serializers import actor_serializer, json_response, \
+    orjson  # noqa: E402
+
+
+def orm_format():
+    actors = Actor.query.order_by(Actor.id).all()
+    response = jsonify({
+        'success': True,
+        'actors': [actor.format() for actor in actors]
+    })
+    db.session.remove()
+    return response.data
+
+
+def column_tuples():
+    rows = actor_serializer.query().order_by(Actor.id).all()
+    response = json_response({
+        'success': True,
+        'actors': actor_serializer.dicts(rows)
+    })
+    db.session.remove()
+    return response.data
+
+
+def best_of(runs, f):
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        body = f()
+        timings.append(time.perf_counter() - start)
+    return min(timings), body
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--rows', type=int, default=100000)
+    parser.add_argument('--runs', type=int, default=3)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        app = create_app({
+            'SQLALCHEMY_DATABASE_URI':
+                'sqlite:///' + os.path.join(directory, 'bench.db'),
+            'ENTITY_CACHE': 'none'
+        })
+        with app.test_request_context():
+            db.create_all()
+            Actor.insert_many([
+                {'name': 'Actor {}'.format(i), 'age': 20 + i % 60,
+                 'gender': 'F' if i % 2 else 'M'}
+                for i in range(args.rows)
+            ])
+
+            print('backend: {}'.format('orjson' if orjson else 'json'))
+            results = {}
+            for name, f in (('orm + format', orm_format),
+                            ('column tuples', column_tuples)):
+                seconds, results[name] = best_of(args.runs, f)
+                print('{:<14} {:>10.0f} rows/s  ({:.3f} s)'.format(
+                    name, args.rows / seconds, seconds))
+
+            if len(set(results.values())) != 1:
+                print('responses differ')
+                return 1
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
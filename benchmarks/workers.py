@@ -0,0 +1,77 @@
+'''
+Load tests the app under gunicorn with each worker model of
+gunicorn_conf.py.
+
+    python benchmarks/workers.py [--actors N] [--movies N] [--workers N]
+                                 [--concurrency N] [--requests N]
+                                 [--profiles cpu,mixed,io]
+                                 [--database-url URL]
+
+Fills a temporary SQLite database (or an empty DATABASE_URL with
+--database-url), starts `gunicorn -c python:gunicorn_conf` once per
+WEB_IO_PROFILE with --workers workers (default: the profile's own count)
+and reports throughput and latency percentiles of the request mix of
+benchmarks/asgi_load.py. The io profile requires gevent.
+'''
+import argparse
+import asyncio
+import os
+import random
+import sys
+import tempfile
+
+from asgi_load import fill, signing_key, free_port, start, load, \
+    percentiles
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--actors', type=int, default=10000)
+    parser.add_argument('--movies', type=int, default=5000)
+    parser.add_argument('--workers', type=int)
+    parser.add_argument('--concurrency', type=int, default=100)
+    parser.add_argument('--requests', type=int, default=5000)
+    parser.add_argument('--profiles', default='cpu,mixed,io')
+    parser.add_argument('--database-url')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        database_url = args.database_url or \
+            'sqlite:///' + os.path.join(directory, 'load.db')
+        actor_ids = fill(database_url, args.actors, args.movies)
+        token, jwks_url = signing_key(directory)
+
+        rng = random.Random(1)
+        urls = ['/actors', '/movies?include=cast'] + [
+            '/actors/{}'.format(rng.choice(actor_ids)) for _ in range(50)]
+
+        for profile in args.profiles.split(','):
+            port = free_port()
+            env = dict(os.environ, DATABASE_URL=database_url,
+                       JWKS_URL=jwks_url, AUTH0_DOMAIN='bench.local',
+                       ALGORITHMS="['RS256']", API_AUDIENCE='bench',
+                       WEB_IO_PROFILE=profile, PORT=str(port))
+            if args.workers:
+                env['WEB_CONCURRENCY'] = str(args.workers)
+
+            server = start([sys.executable, '-m', 'gunicorn', '-c',
+                            'python:gunicorn_conf', 'app:create_app()'],
+                           port, env)
+            try:
+                # verifies the token in every worker
+                asyncio.run(load(port, token, urls, 8, 200))
+                throughput, latencies, errors = asyncio.run(load(
+                    port, token, urls, args.concurrency, args.requests))
+            finally:
+                server.terminate()
+                server.wait()
+
+            print('{:6} {:7.0f} req/s   p50 {:.1f} ms   p95 {:.1f} ms   '
+                  'p99 {:.1f} ms   mean {:.1f} ms   {} errors'.format(
+                      profile, throughput, *percentiles(latencies),
+                      errors))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,178 @@
+import asyncio
+from collections import namedtuple
+from functools import lru_cache
+
+from sqlalchemy.dialects.postgresql.psycopg2 import PGCompiler_psycopg2, \
+    PGDialect_psycopg2
+from sqlalchemy.dialects.sqlite.pysqlite import SQLiteDialect_pysqlite
+from sqlalchemy.engine.url import make_url
+
+from database.engine import setting, flag
+
+
+'''
+Async database access for the ASGI app (asgi.py)
+
+    AsyncDatabase runs the SQLAlchemy Core statements built by the shared
+    query builders (database.queries, database.pagination,
+    database.serializers) on an async driver: asyncpg for Postgres,
+    aiosqlite for SQLite. Statements are compiled by the same SQLAlchemy
+    dialect as in the Flask app, and values go through the same type
+    processors, so both apps send the same SQL and read the same values.
+
+    Only reads run here; the ASGI app hands every write to the Flask app.
+'''
+
+
+class AsyncpgCompiler(PGCompiler_psycopg2):
+    """Renders $n placeholders, cast to their type
+
+    asyncpg prepares every statement, and Postgres can not infer the type
+    of a parameter in every position (i.e. $1 || '%')
+    """
+
+    def bindparam_string(self, name, **kw):
+        return super().bindparam_string(name, **kw).replace(':', '$', 1)
+
+    def visit_bindparam(self, bindparam, **kw):
+        text = super().visit_bindparam(bindparam, **kw)
+        if kw.get('literal_binds') or bindparam.type._isnull:
+            return text
+        return '{}::{}'.format(
+            text, self.dialect.type_compiler.process(bindparam.type))
+
+
+class AsyncpgDialect(PGDialect_psycopg2):
+    statement_compiler = AsyncpgCompiler
+
+
+@lru_cache(maxsize=None)
+def row_class(keys):
+    """a named tuple class for rows of the given column keys, so rows are
+    read by attribute as with SQLAlchemy result rows
+    """
+    return namedtuple('Row', keys, rename=True)
+
+
+'''
+AsyncDatabase
+    url: the database url of the Flask app, SQLALCHEMY_DATABASE_URI
+    config: the Flask app config; the pool is sized by DB_POOL_SIZE plus
+     DB_MAX_OVERFLOW, and DB_STATEMENT_TIMEOUT and DB_PGBOUNCER apply as
+     in database.engine.engine_options
+
+    connects on the first query, in the event loop that runs it
+'''
+
+
+class AsyncDatabase:
+    def __init__(self, url, config=None):
+        self.url = make_url(url)
+        self.config = config or {}
+        self.backend = self.url.get_backend_name()
+        if self.backend in ('postgresql', 'postgres'):
+            self.dialect = AsyncpgDialect(paramstyle='numeric')
+        elif self.backend == 'sqlite':
+            self.dialect = SQLiteDialect_pysqlite()
+        else:
+            raise RuntimeError(
+                'The ASGI app supports Postgres and SQLite databases')
+
+        self.size = int(setting(self.config, 'DB_POOL_SIZE', 5)) + \
+            int(setting(self.config, 'DB_MAX_OVERFLOW', 10))
+        self._pool = None
+        self._lock = asyncio.Lock()
+
+    def compile(self, statement):
+        """returns the (sql, positional parameters) of statement"""
+        compiled = statement.compile(dialect=self.dialect)
+        params = compiled.construct_params()
+        processors = compiled._bind_processors
+        return str(compiled), [
+            processors[name](params[name]) if name in processors
+            else params[name]
+            for name in compiled.positiontup
+        ]
+
+    async def fetch(self, statement):
+        """runs a select statement, returns its rows as named tuples"""
+        sql, params = self.compile(statement)
+        pool = await self._connect()
+        if self.backend == 'sqlite':
+            connection = await pool.get()
+            try:
+                async with connection.execute(sql, params) as cursor:
+                    rows = await cursor.fetchall()
+            finally:
+                pool.put_nowait(connection)
+        else:
+            rows = await pool.fetch(sql, *params)
+
+        columns = list(statement.columns)
+        processors = [column.type._cached_result_processor(self.dialect, None)
+                      for column in columns]
+        Row = row_class(tuple(column.key for column in columns))
+        return [
+            Row(*(process(value) if process else value
+                  for process, value in zip(processors, row)))
+            for row in rows
+        ]
+
+    async def _connect(self):
+        if self._pool is not None:
+            return self._pool
+
+        async with self._lock:
+            if self._pool is None:
+                self._pool = await (self._sqlite_pool()
+                                    if self.backend == 'sqlite'
+                                    else self._postgres_pool())
+        return self._pool
+
+    async def _postgres_pool(self):
+        try:
+            import asyncpg
+        except ImportError:
+            raise RuntimeError('The ASGI app requires the asyncpg package '
+                               'for Postgres')
+
+        url = make_url(str(self.url))
+        url.drivername = 'postgresql'
+        options = {}
+        statement_timeout = setting(self.config, 'DB_STATEMENT_TIMEOUT')
+        if flag(setting(self.config, 'DB_PGBOUNCER', 'false')):
+            # transaction pooling can not keep prepared statements
+            options['statement_cache_size'] = 0
+            if statement_timeout:
+                options['command_timeout'] = int(statement_timeout) / 1000
+        elif statement_timeout:
+            options['server_settings'] = {
+                'statement_timeout': str(int(statement_timeout))
+            }
+
+        return await asyncpg.create_pool(str(url), min_size=1,
+                                         max_size=self.size, **options)
+
+    async def _sqlite_pool(self):
+        try:
+            import aiosqlite
+        except ImportError:
+            raise RuntimeError('The ASGI app requires the aiosqlite package '
+                               'for SQLite')
+
+        # each aiosqlite connection runs its queries on its own thread
+        pool = asyncio.Queue()
+        for _ in range(self.size):
+            pool.put_nowait(
+                await aiosqlite.connect(self.url.database or ':memory:'))
+        return pool
+
+    async def close(self):
+        pool, self._pool = self._pool, None
+        if pool is None:
+            return
+        if self.backend == 'sqlite':
+            while not pool.empty():
+                await pool.get_nowait().close()
+        else:
+            await pool.close()
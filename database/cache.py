@@ -0,0 +1,161 @@
+import json
+import threading
+import time
+from collections import OrderedDict
+
+
+'''
+LRUCache
+    In-process cache backend: a bounded LRU whose entries also expire
+    after `ttl` seconds. Every worker process holds its own copy, which
+    the writes of other workers do not invalidate, see EntityCache.
+'''
+
+
+class LRUCache:
+    def __init__(self, maxsize=10000, ttl=30):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+
+            value, expires_at = entry
+            if expires_at <= time.monotonic():
+                del self._entries[key]
+                return None
+
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def delete(self, *keys):
+        with self._lock:
+            for key in keys:
+                self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+'''
+RedisCache
+    Cache backend shared by every worker, for any client speaking the
+    Redis get/set/delete commands (i.e. redis.Redis, or a local stand-in
+    in tests). Values are stored as JSON.
+'''
+
+
+class RedisCache:
+    def __init__(self, client, ttl=30, prefix='castu:'):
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+
+    @classmethod
+    def from_url(cls, url, **kwargs):
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError(
+                'ENTITY_CACHE=redis requires the redis package')
+
+        return cls(redis.Redis.from_url(url), **kwargs)
+
+    def get(self, key):
+        raw = self.client.get(self.prefix + key)
+        return json.loads(raw) if raw is not None else None
+
+    def set(self, key, value):
+        self.client.set(self.prefix + key, json.dumps(value), ex=self.ttl)
+
+    def delete(self, *keys):
+        if keys:
+            self.client.delete(*(self.prefix + key for key in keys))
+
+
+class NullCache:
+    def get(self, key):
+        return None
+
+    def set(self, key, value):
+        pass
+
+    def delete(self, *keys):
+        pass
+
+
+'''
+EntityCache
+    Read-through cache of the format() dicts of single actors and movies,
+    invalidated by the model update and delete methods.
+
+    Each entry is stored with the version of its table when it was read,
+    and a lookup with another version misses: a worker whose entry
+    predates the write of another worker, which could not invalidate it,
+    reloads the row as soon as the write bumped the version, instead of
+    serving the old dict under the new ETag.
+'''
+
+
+class EntityCache:
+    def __init__(self, backend=None):
+        self.backend = backend if backend is not None else LRUCache()
+
+    @staticmethod
+    def _key(kind, id):
+        return '{}:{}'.format(kind, id)
+
+    def get(self, kind, id, version):
+        entry = self.backend.get(self._key(kind, id))
+        if entry is None or entry[0] != version:
+            return None
+        return entry[1]
+
+    def set(self, kind, id, version, value):
+        self.backend.set(self._key(kind, id), [version, value])
+
+    def invalidate(self, kind, *ids):
+        self.backend.delete(*(self._key(kind, id) for id in ids))
+
+
+entity_cache = EntityCache()
+
+
+'''
+configure_cache(config)
+    selects the entity_cache backend from the app config
+        ENTITY_CACHE: 'memory' (default), 'redis' or 'none'
+        ENTITY_CACHE_URL: redis url, for 'redis'
+        ENTITY_CACHE_TTL: seconds an entry is served
+        ENTITY_CACHE_SIZE: entries kept per process, for 'memory'
+'''
+
+
+def configure_cache(config):
+    kind = config.get('ENTITY_CACHE', 'memory')
+    ttl = config.get('ENTITY_CACHE_TTL', 30)
+
+    if kind == 'memory':
+        backend = LRUCache(config.get('ENTITY_CACHE_SIZE', 10000), ttl)
+    elif kind == 'redis':
+        backend = RedisCache.from_url(config['ENTITY_CACHE_URL'], ttl=ttl)
+    elif kind == 'none':
+        backend = NullCache()
+    else:
+        raise ValueError('Unknown ENTITY_CACHE backend: ' + kind)
+
+    entity_cache.backend = backend
+    return entity_cache
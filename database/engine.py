@@ -0,0 +1,272 @@
+import logging
+import os
+import threading
+import time
+
+from flask import request
+from sqlalchemy import event
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.pool import NullPool, QueuePool
+
+from metrics import registry, request_timings
+
+logger = logging.getLogger(__name__)
+
+
+'''
+PoolWaitStats
+    Time spent waiting for a connection to be checked out of the pool,
+    the first thing to grow when workers over-subscribe the database.
+'''
+
+
+class PoolWaitStats:
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self._lock = threading.Lock()
+
+    def record(self, seconds):
+        with self._lock:
+            self.count += 1
+            self.total += seconds
+            if seconds > self.max:
+                self.max = seconds
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'count': self.count,
+                'total_seconds': self.total,
+                'max_seconds': self.max
+            }
+
+
+pool_wait = PoolWaitStats()
+
+
+@registry.collector
+def pool_wait_metrics():
+    stats = pool_wait.snapshot()
+    return [
+        ('castu_db_pool_checkouts', 'counter',
+         'Connections checked out of the pool.', stats['count']),
+        ('castu_db_pool_wait_seconds', 'counter',
+         'Time spent waiting for a pooled connection.',
+         stats['total_seconds']),
+        ('castu_db_pool_wait_max_seconds', 'gauge',
+         'Longest wait for a pooled connection.', stats['max_seconds'])
+    ]
+
+
+class TimedQueuePool(QueuePool):
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            pool_wait.record(time.perf_counter() - start)
+
+
+class TimedNullPool(NullPool):
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            pool_wait.record(time.perf_counter() - start)
+
+
+def setting(config, name, default=None):
+    """
+    reads name from the app config, then the environment
+    """
+    if config.get(name) is not None:
+        return config[name]
+    return os.environ.get(name, default)
+
+
+def flag(value):
+    if isinstance(value, str):
+        return value.lower() in ('1', 'true', 'yes', 'on')
+    return bool(value)
+
+
+'''
+engine_options(database_path, config)
+    builds SQLALCHEMY_ENGINE_OPTIONS from the app config or environment
+        DB_POOL_SIZE: connections kept open per worker (default 5)
+        DB_MAX_OVERFLOW: extra connections allowed under load (default 10)
+        DB_POOL_TIMEOUT: seconds to wait for a connection (default 30)
+        DB_POOL_RECYCLE: seconds before a connection is replaced
+         (default 1800)
+        DB_POOL_PRE_PING: test connections on checkout, so connections
+         broken by a failover are replaced (default true)
+        DB_STATEMENT_TIMEOUT: Postgres statement_timeout in milliseconds
+        DB_PGBOUNCER: no client-side pool, PgBouncer does the pooling;
+         psycopg2 never uses server-side prepared statements, so no
+         driver option is needed for transaction pooling
+'''
+
+
+def engine_options(database_path, config):
+    url = make_url(database_path)
+    if url.get_backend_name() == 'sqlite':
+        return {}
+
+    pre_ping = flag(setting(config, 'DB_POOL_PRE_PING', 'true'))
+
+    if flag(setting(config, 'DB_PGBOUNCER', 'false')):
+        return {
+            'poolclass': TimedNullPool,
+            'pool_pre_ping': pre_ping
+        }
+
+    options = {
+        'poolclass': TimedQueuePool,
+        'pool_size': int(setting(config, 'DB_POOL_SIZE', 5)),
+        'max_overflow': int(setting(config, 'DB_MAX_OVERFLOW', 10)),
+        'pool_timeout': int(setting(config, 'DB_POOL_TIMEOUT', 30)),
+        'pool_recycle': int(setting(config, 'DB_POOL_RECYCLE', 1800)),
+        'pool_pre_ping': pre_ping
+    }
+
+    statement_timeout = setting(config, 'DB_STATEMENT_TIMEOUT')
+    if statement_timeout and \
+            url.get_backend_name() in ('postgresql', 'postgres'):
+        options['connect_args'] = {
+            'options': '-c statement_timeout={}'.format(
+                int(statement_timeout))
+        }
+
+    return options
+
+
+def install_engine_hooks(engine, config):
+    """
+    PgBouncer in transaction mode rejects startup parameters and shares
+    sessions between clients, so its statement timeout is set per
+    transaction instead.
+    """
+    statement_timeout = setting(config, 'DB_STATEMENT_TIMEOUT')
+    if not statement_timeout or engine.dialect.name != 'postgresql' \
+            or not flag(setting(config, 'DB_PGBOUNCER', 'false')):
+        return
+
+    statement = 'SET LOCAL statement_timeout = {}'.format(
+        int(statement_timeout))
+
+    def set_statement_timeout(connection):
+        connection.execute(statement)
+
+    if not getattr(engine, '_castu_statement_timeout', False):
+        event.listen(engine, 'begin', set_statement_timeout)
+        engine._castu_statement_timeout = True
+
+
+class QueryBudgetExceeded(Exception):
+    pass
+
+
+# characters of the parameters written to the log
+MAX_LOGGED_PARAMETERS = 1000
+
+
+def explain(connection, statement, parameters, context):
+    """
+    returns the plan of a SELECT statement, run on the DBAPI cursor so it
+    is neither timed nor counted
+    """
+    words = statement.split(None, 1)
+    if context is None or context.executemany or not words or \
+            words[0].upper() not in ('SELECT', 'WITH'):
+        return None
+
+    prefix = 'EXPLAIN QUERY PLAN ' if connection.dialect.name == 'sqlite' \
+        else 'EXPLAIN '
+    cursor = connection.connection.cursor()
+    try:
+        cursor.execute(prefix + statement, parameters)
+        return '\n'.join(' '.join(str(value) for value in row)
+                         for row in cursor.fetchall())
+    except Exception as e:
+        return 'EXPLAIN failed: {}'.format(e)
+    finally:
+        cursor.close()
+
+
+'''
+install_query_hooks(engine, config)
+    logs slow statements and enforces a per-request query budget
+        DB_SLOW_QUERY_MS: statements slower than this are logged with
+         their parameters and route (default 500, 0 disables)
+        DB_QUERY_BUDGET: statements one request may run (default 50, 0
+         disables)
+        DB_QUERY_BUDGET_MODE: 'raise' fails the statement going over the
+         budget with QueryBudgetExceeded, 'warn' logs it once per request
+         (default 'raise' when TESTING is set, 'warn' otherwise)
+        DB_EXPLAIN: also log the plan of slow and over budget SELECTs
+         (default false)
+'''
+
+
+def install_query_hooks(engine, config):
+    if getattr(engine, '_castu_query_hooks', False):
+        return
+
+    slow = int(setting(config, 'DB_SLOW_QUERY_MS', 500)) / 1000
+    budget = int(setting(config, 'DB_QUERY_BUDGET', 50))
+    mode = setting(config, 'DB_QUERY_BUDGET_MODE') or \
+        ('raise' if config.get('TESTING') else 'warn')
+    if mode not in ('raise', 'warn'):
+        raise ValueError('Unknown DB_QUERY_BUDGET_MODE: ' + mode)
+    with_plan = flag(setting(config, 'DB_EXPLAIN', 'false'))
+
+    # the start time is kept on the execution context, which a failed
+    # statement discards with it, rather than on the pooled connection
+    def check_budget(conn, cursor, statement, parameters, context,
+                     executemany):
+        if context is not None:
+            context._castu_query_start = time.perf_counter()
+
+        timings = request_timings()
+        if not budget or timings is None:
+            return
+
+        # db_queries counts the statements that already ran
+        count = timings.db_queries + 1
+        if count <= budget:
+            return
+
+        message = 'Query budget of {} exceeded by {} {}: query {}: {}' \
+            .format(budget, request.method, request.path, count, statement)
+        if mode == 'raise':
+            raise QueryBudgetExceeded(message)
+        if count == budget + 1:
+            plan = explain(conn, statement, parameters, context) \
+                if with_plan else None
+            logger.warning('%s%s', message, '\n' + plan if plan else '')
+
+    def log_slow_query(conn, cursor, statement, parameters, context,
+                       executemany):
+        start = getattr(context, '_castu_query_start', None)
+        if start is None:
+            return
+
+        elapsed = time.perf_counter() - start
+        if not slow or elapsed < slow:
+            return
+
+        route = '{} {}'.format(request.method, request.path) \
+            if request_timings() is not None else 'no request'
+        plan = explain(conn, statement, parameters, context) \
+            if with_plan else None
+        logger.warning('Slow query (%.0f ms) on %s: %s\nparameters: %s%s',
+                       elapsed * 1000, route, statement,
+                       repr(parameters)[:MAX_LOGGED_PARAMETERS],
+                       '\n' + plan if plan else '')
+
+    event.listen(engine, 'before_cursor_execute', check_budget)
+    event.listen(engine, 'after_cursor_execute', log_slow_query)
+    engine._castu_query_hooks = True
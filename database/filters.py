@@ -0,0 +1,108 @@
+from database.models import Actor, Movie, parse_release_date
+
+
+'''
+Filters and sort orders accepted by the list endpoints
+
+    Every filter compiles to a SQL condition on an indexed column, so a
+    filtered page is an index range scan instead of a download of the
+    whole table.
+'''
+
+
+def int_arg(args, name):
+    value = args.get(name)
+    return None if value is None else int(value)
+
+
+'''
+    actor_filters(args) method
+    @INPUTS
+        args: request query arguments
+            gender: exact gender, as stored (i.e. F)
+            age_min, age_max: inclusive age bounds
+
+    raises ValueError if a bound is not an integer
+    returns the list of SQL conditions
+'''
+
+
+def actor_filters(args):
+    conditions = []
+
+    gender = args.get('gender')
+    if gender is not None:
+        conditions.append(Actor.gender == gender)
+
+    age_min = int_arg(args, 'age_min')
+    if age_min is not None:
+        conditions.append(Actor.age >= age_min)
+
+    age_max = int_arg(args, 'age_max')
+    if age_max is not None:
+        conditions.append(Actor.age <= age_max)
+
+    return conditions
+
+
+'''
+    movie_filters(args) method
+    @INPUTS
+        args: request query arguments
+            released_after, released_before: inclusive release date bounds
+            title_prefix: case-sensitive start of the title
+
+    raises ValueError if a bound is not a date
+    returns the list of SQL conditions
+'''
+
+
+def movie_filters(args):
+    conditions = []
+
+    released_after = args.get('released_after')
+    if released_after is not None:
+        conditions.append(
+            Movie.release_date >= parse_release_date(released_after))
+
+    released_before = args.get('released_before')
+    if released_before is not None:
+        conditions.append(
+            Movie.release_date <= parse_release_date(released_before))
+
+    title_prefix = args.get('title_prefix')
+    if title_prefix:
+        conditions.append(Movie.title.startswith(title_prefix,
+                                                 autoescape=True))
+
+    return conditions
+
+
+ACTOR_SORTS = {
+    'id': None,
+    'name': Actor.name,
+    'age': Actor.age,
+    'movie_count': Actor.movie_count
+}
+
+MOVIE_SORTS = {
+    'id': None,
+    'title': Movie.title,
+    'release_date': Movie.release_date,
+    'cast_size': Movie.cast_size
+}
+
+
+def sort_arg(args, sorts):
+    """Parses ?sort=column or ?sort=-column (descending)
+
+    raises ValueError for a column not in sorts
+    returns the (sort column or None for id, descending) pair
+    """
+    sort = args.get('sort', 'id')
+    descending = sort.startswith('-')
+    name = sort[1:] if descending else sort
+    if name not in sorts:
+        raise ValueError('Unknown sort column')
+
+    return sorts[name], descending
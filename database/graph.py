@@ -0,0 +1,367 @@
+import heapq
+import logging
+import threading
+from collections import Counter
+
+from sqlalchemy import text
+
+logger = logging.getLogger(__name__)
+
+
+'''
+Co-star graph queries
+
+    The cast table is a bipartite graph of actors and movies. Two actors
+    are co-stars when they share a movie, and their degree of separation
+    is the number of movies on the shortest path between them.
+
+    CastGraph keeps the adjacency of that graph in memory, tagged with the
+    'cast' table version (see database.models.table_versions) it reflects.
+    Writes of this process apply their changes to it incrementally; a
+    write of another process leaves it behind the database, in which case
+    the query runs in SQL while the graph reloads in the background.
+'''
+
+# the longest path searched, in movies
+MAX_DEGREES = 6
+
+
+class CastGraph:
+    def __init__(self):
+        self.loaded = False
+        self.version = None
+        # actor id -> movie ids, movie id -> actor ids
+        self._actors = {}
+        self._movies = {}
+        self._lock = threading.RLock()
+        self._reloader = None
+
+    def load(self, bind):
+        """replaces the graph with the cast table read through bind"""
+        with bind.connect() as connection:
+            # the version is read first: rows committed in between make
+            # the graph newer than its version, never older
+            version = connection.execute(text(
+                "SELECT version FROM table_versions WHERE name = 'cast'"
+            )).scalar() or 0
+            actors, movies = {}, {}
+            for actor_id, movie_id in connection.execute(
+                    text('SELECT actor_id, movie_id FROM "cast"')):
+                actors.setdefault(actor_id, []).append(movie_id)
+                movies.setdefault(movie_id, []).append(actor_id)
+
+        with self._lock:
+            self._actors, self._movies = actors, movies
+            self.version = version
+            self.loaded = True
+
+    def reload(self, bind):
+        """reloads the graph in a background thread, once at a time"""
+        with self._lock:
+            if self._reloader is not None and self._reloader.is_alive():
+                return
+            self._reloader = threading.Thread(
+                target=self._reload, args=(bind,), name='cast-graph-reload',
+                daemon=True)
+            self._reloader.start()
+
+    def _reload(self, bind):
+        try:
+            self.load(bind)
+        except Exception as e:
+            logger.warning('Unable to reload the cast graph: %s', e)
+
+    def wait(self, timeout=None):
+        """waits for a background reload to finish"""
+        reloader = self._reloader
+        if reloader is not None:
+            reloader.join(timeout)
+
+    def clear(self):
+        with self._lock:
+            self._actors, self._movies = {}, {}
+            self.version = None
+            self.loaded = False
+
+    def current(self, version):
+        """whether the graph reflects the given 'cast' table version"""
+        return self.loaded and self.version is not None \
+            and self.version >= version
+
+    def _applied(self, version):
+        # the graph only stays current when no other write came between
+        if self.version is not None and version == self.version + 1:
+            self.version = version
+        else:
+            self.version = None
+
+    def set_casts(self, version, casts):
+        """
+        replaces the cast of each movie in casts, a dict of movie id to
+        actor ids, an empty cast removing the movie
+        version is the 'cast' table version the change committed as
+        """
+        with self._lock:
+            if not self.loaded or version is None:
+                return
+
+            for movie_id, actor_ids in casts.items():
+                for actor_id in self._movies.pop(movie_id, ()):
+                    self._unlink(self._actors, actor_id, movie_id)
+                actor_ids = list(dict.fromkeys(actor_ids))
+                if actor_ids:
+                    self._movies[movie_id] = actor_ids
+                for actor_id in actor_ids:
+                    self._actors.setdefault(actor_id, []).append(movie_id)
+            self._applied(version)
+
+    def remove_actors(self, version, actor_ids):
+        with self._lock:
+            if not self.loaded or version is None:
+                return
+
+            for actor_id in actor_ids:
+                for movie_id in self._actors.pop(actor_id, ()):
+                    self._unlink(self._movies, movie_id, actor_id)
+            self._applied(version)
+
+    @staticmethod
+    def _unlink(adjacency, node, neighbour):
+        neighbours = adjacency.get(node)
+        if neighbours is not None and neighbour in neighbours:
+            neighbours.remove(neighbour)
+            if not neighbours:
+                del adjacency[node]
+
+    def costars(self, actor_id, limit, offset=0):
+        """returns the (actor id, shared movies) pairs, most shared first"""
+        with self._lock:
+            shared = Counter()
+            for movie_id in self._actors.get(actor_id, ()):
+                shared.update(self._movies[movie_id])
+        shared.pop(actor_id, None)
+
+        return heapq.nsmallest(offset + limit, shared.items(),
+                               key=lambda item: (-item[1], item[0]))[offset:]
+
+    def path(self, source, target, max_degrees=MAX_DEGREES):
+        """
+        returns a shortest path from source to target, alternating actor
+        and movie ids, or None when there is none within max_degrees
+        """
+        if source == target:
+            return [source]
+
+        with self._lock:
+            if source not in self._actors or target not in self._actors:
+                return None
+
+            forward = Frontier(source)
+            backward = Frontier(target)
+            # a degree is two steps, actor to movie and movie to actor
+            for _ in range(2 * max_degrees):
+                if not forward.nodes or not backward.nodes:
+                    return None
+
+                # the smaller frontier is expanded, so each side only
+                # explores about half the depth of a one sided search
+                if len(forward.nodes) <= len(backward.nodes):
+                    meet = forward.expand(self._actors, self._movies,
+                                          backward)
+                else:
+                    meet = backward.expand(self._actors, self._movies,
+                                           forward)
+                if meet is not None:
+                    return forward.trail(*meet)[::-1] \
+                        + backward.trail(*meet)[1:]
+        return None
+
+
+class Frontier:
+    """One side of the bidirectional breadth first search"""
+
+    def __init__(self, actor_id):
+        # node -> the node it was reached from
+        self.actors = {actor_id: None}
+        self.movies = {}
+        self.nodes = [actor_id]
+        self.on_actors = True
+
+    def expand(self, actors, movies, other):
+        """
+        visits the next layer; returns the first (is actor, node) already
+        visited by the other side, which completes a shortest path
+        """
+        if self.on_actors:
+            adjacency, seen, other_seen = actors, self.movies, other.movies
+        else:
+            adjacency, seen, other_seen = movies, self.actors, other.actors
+
+        meet = None
+        nodes = []
+        for node in self.nodes:
+            for neighbour in adjacency.get(node, ()):
+                if neighbour in seen:
+                    continue
+                seen[neighbour] = node
+                nodes.append(neighbour)
+                if neighbour in other_seen:
+                    meet = (not self.on_actors, neighbour)
+                    break
+            if meet is not None:
+                break
+
+        self.nodes = nodes
+        self.on_actors = not self.on_actors
+        return meet
+
+    def trail(self, is_actor, node):
+        """the nodes from node back to where this side started"""
+        trail = []
+        while node is not None:
+            trail.append(node)
+            node = (self.actors if is_actor else self.movies)[node]
+            is_actor = not is_actor
+        return trail
+
+
+cast_graph = CastGraph()
+
+
+COSTARS = text('''
+    SELECT other.actor_id, count(*) AS shared
+    FROM "cast" own
+    JOIN "cast" other ON other.movie_id = own.movie_id
+    WHERE own.actor_id = :actor_id AND other.actor_id != :actor_id
+    GROUP BY other.actor_id
+    ORDER BY shared DESC, other.actor_id
+    LIMIT :limit OFFSET :offset
+''')
+
+# reach: the least number of movies from the source to every actor within
+# max_degrees; back: the links of the shortest paths, walked back from
+# the target one degree at a time
+PATH = text('''
+    WITH RECURSIVE reach(actor_id, degrees) AS (
+        SELECT :source, 0
+        UNION
+        SELECT other.actor_id, reach.degrees + 1
+        FROM reach
+        JOIN "cast" own ON own.actor_id = reach.actor_id
+        JOIN "cast" other ON other.movie_id = own.movie_id
+            AND other.actor_id != own.actor_id
+        WHERE reach.degrees < :max_degrees
+    ),
+    distance(actor_id, degrees) AS (
+        SELECT actor_id, min(degrees) FROM reach GROUP BY actor_id
+    ),
+    back(actor_id, degrees, movie_id, next_id) AS (
+        SELECT actor_id, degrees, CAST(NULL AS INTEGER),
+            CAST(NULL AS INTEGER)
+        FROM distance WHERE actor_id = :target
+        UNION
+        SELECT distance.actor_id, distance.degrees, own.movie_id,
+            back.actor_id
+        FROM back
+        JOIN "cast" own ON own.actor_id = back.actor_id
+        JOIN "cast" other ON other.movie_id = own.movie_id
+            AND other.actor_id != own.actor_id
+        JOIN distance ON distance.actor_id = other.actor_id
+            AND distance.degrees = back.degrees - 1
+    )
+    SELECT actor_id, movie_id, next_id FROM back
+    WHERE movie_id IS NOT NULL
+    ORDER BY degrees, actor_id, movie_id, next_id
+''')
+
+
+def graph_for(session, version, enabled=True):
+    """
+    returns cast_graph when it reflects version, the 'cast' table version
+    the request read; otherwise None, after starting a background reload
+    a request never loads the graph itself, since that takes as long as
+    reading the whole cast table; until the first load, see
+    database.models.warm_cast_graph, it is answered in SQL
+    """
+    if not enabled:
+        return None
+
+    if cast_graph.current(version):
+        return cast_graph
+
+    cast_graph.reload(session.get_bind())
+    return None
+
+
+'''
+    costars(session, actor_id, version, limit, offset, in_memory) method
+    @INPUTS
+        session: the database session
+        actor_id: the actor whose co-stars are listed
+        version: the 'cast' table version the request read
+        limit: number of co-stars to return
+        offset: number of co-stars to skip
+        in_memory: whether the in-memory graph may answer
+
+    returns the (actor id, shared movies) pairs, most shared movies first
+'''
+
+
+def costars(session, actor_id, version, limit, offset=0, in_memory=True):
+    graph = graph_for(session, version, in_memory)
+    if graph is not None:
+        return graph.costars(actor_id, limit, offset)
+
+    return [tuple(row) for row in session.execute(COSTARS, {
+        'actor_id': actor_id,
+        'limit': limit,
+        'offset': offset
+    })]
+
+
+'''
+    shortest_path(session, source, target, version, max_degrees,
+                  in_memory) method
+    @INPUTS
+        session: the database session
+        source, target: the actor ids to connect
+        version: the 'cast' table version the request read
+        max_degrees: the longest path searched, in movies
+        in_memory: whether the in-memory graph may answer
+
+    returns the path as alternating actor and movie ids, from source to
+    target, or None when they are not connected within max_degrees
+'''
+
+
+def shortest_path(session, source, target, version,
+                  max_degrees=MAX_DEGREES, in_memory=True):
+    graph = graph_for(session, version, in_memory)
+    if graph is not None:
+        return graph.path(source, target, max_degrees)
+
+    if source == target:
+        return [source]
+
+    # reach revisits actors at every depth, so its cost grows steeply
+    # with max_degrees; deepening one degree at a time stops at the
+    # shortest path's length
+    links = {}
+    for degrees in range(1, max_degrees + 1):
+        for actor_id, movie_id, next_id in session.execute(PATH, {
+            'source': source,
+            'target': target,
+            'max_degrees': degrees
+        }):
+            links.setdefault(actor_id, (movie_id, next_id))
+        if source in links:
+            break
+    else:
+        return None
+
+    # every link leads one degree closer to the target
+    path = [source]
+    while path[-1] != target:
+        movie_id, next_id = links[path[-1]]
+        path += [movie_id, next_id]
+    return path
@@ -1,29 +1,84 @@
-from sqlalchemy import Column, String, Integer, Date, ForeignKey
-from flask_sqlalchemy import SQLAlchemy
+from collections import namedtuple
+from datetime import date, datetime
+from sqlalchemy import Column, String, Integer, Date, ForeignKey, Index, \
+    func, or_, select, inspect
 import os
+import re
 
-database_path = os.environ['DATABASE_URL']
+from database.cache import entity_cache
+from database.engine import engine_options, install_engine_hooks, \
+    install_query_hooks
+from database.graph import cast_graph
+from database.routing import RoutingSQLAlchemy, configure_replicas
+from database.search import search_index
 
-db = SQLAlchemy()
+db = RoutingSQLAlchemy()
 
 '''
 setup_db(app)
     binds a flask application and a SQLAlchemy service
+    the database url is the app config SQLALCHEMY_DATABASE_URI, else the
+    DATABASE_URL environment variable, read here rather than at import
+    does not touch the schema, which is managed by the migrations
+    configures the connection pool from the app config or environment,
+    see database.engine.engine_options
+    creates the read replica engines, see database.routing
 '''
 
 
-def setup_db(app, database_path=database_path):
+def setup_db(app, database_path=None):
+    if database_path is None:
+        database_path = app.config.get("SQLALCHEMY_DATABASE_URI") \
+            or os.environ.get('DATABASE_URL')
+    if not database_path:
+        raise RuntimeError('DATABASE_URL is not set')
     app.config["SQLALCHEMY_DATABASE_URI"] = database_path
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    app.config.setdefault("SQLALCHEMY_ENGINE_OPTIONS",
+                          engine_options(database_path, app.config))
     db.app = app
     db.init_app(app)
-    db.create_all()
+    install_engine_hooks(db.engine, app.config)
+    install_query_hooks(db.engine, app.config)
+    configure_replicas(app, entity_cache.backend)
+    # reloaded from this database on first use
+    search_index.clear()
+    cast_graph.clear()
+
+
+def reset_after_fork(app):
+    """
+    drops the pooled connections a worker process inherited from the
+    server's master, which preloaded the app; sharing their sockets
+    between processes corrupts the connections
+    """
+    with app.app_context():
+        db.engine.dispose()
+
+    router = app.extensions.get('replica_router')
+    if router is not None:
+        for engine in router.engines:
+            engine.dispose()
+
+
+def warm_cast_graph(app):
+    """
+    starts loading the in-memory cast graph in the background, when
+    CAST_GRAPH is 'memory', so the first co-star request of a worker is
+    not the one waiting for it
+    """
+    if app.config.get('CAST_GRAPH') != 'memory':
+        return
+
+    with app.app_context():
+        cast_graph.reload(db.engine)
 
 
 def db_drop_and_create_all():
     """
     drops the database tables and starts fresh
-    can be used to initialize a clean database
+    can be used to initialize a clean test database, deployed databases
+    are created with the migrations
     """
     db.drop_all()
     db.create_all()
@@ -32,10 +87,136 @@ def db_drop_and_create_all():
 cast = db.Table(
     'cast',
     Column('actor_id', Integer, ForeignKey('actors.id'), primary_key=True),
-    Column('movie_id', Integer, ForeignKey('movies.id'), primary_key=True)
+    Column('movie_id', Integer, ForeignKey('movies.id'), primary_key=True),
+    # the primary key serves actor to movies, this movie to actors
+    Index('ix_cast_movie_id', 'movie_id', 'actor_id')
+)
+
+
+'''
+table_versions
+    a counter per table, bumped in the same transaction as every write to
+    that table; GET endpoints derive their ETag from it
+'''
+
+table_versions = db.Table(
+    'table_versions',
+    Column('name', String, primary_key=True),
+    Column('version', Integer, nullable=False, default=0)
 )
 
 
+def bump_versions(*names):
+    """
+    increments the version of each named table, does not commit
+    """
+    for name in names:
+        result = db.session.execute(
+            table_versions.update()
+            .where(table_versions.c.name == name)
+            .values(version=table_versions.c.version + 1))
+        if result.rowcount == 0:
+            db.session.execute(
+                table_versions.insert().values(name=name, version=1))
+
+
+def versions_statement(names):
+    return select([table_versions.c.name, table_versions.c.version]) \
+        .where(table_versions.c.name.in_(names))
+
+
+def get_versions(names):
+    """
+    returns a dict of the current version of each named table
+    """
+    versions = dict.fromkeys(names, 0)
+    rows = db.session.execute(versions_statement(names))
+    versions.update((name, version) for name, version in rows)
+    return versions
+
+
+def cast_version():
+    """
+    returns the version the pending 'cast' write commits as, to tag the
+    change applied to the cast graph, or None when the graph is not loaded
+    must follow bump_versions('cast') in the same transaction
+    """
+    if not cast_graph.loaded:
+        return None
+    return get_versions(['cast'])['cast']
+
+
+'''
+    recount_cast(actor_ids, movie_ids) method
+    @INPUTS
+        actor_ids: actors whose movie_count to recompute
+        movie_ids: movies whose cast_size to recompute
+
+    flushes the pending changes, then recomputes the counters from cast
+    with one UPDATE per table; the counters are never incremented, so
+    they can not drift from cast
+    does not commit, nor bump the table versions
+'''
+
+
+def recount_cast(actor_ids=(), movie_ids=()):
+    db.session.flush()
+
+    if actor_ids:
+        actors = Actor.__table__
+        db.session.execute(
+            actors.update()
+            .where(actors.c.id.in_(set(actor_ids)))
+            .values(movie_count=select([func.count()])
+                    .where(cast.c.actor_id == actors.c.id)
+                    .as_scalar()))
+
+    if movie_ids:
+        movies = Movie.__table__
+        db.session.execute(
+            movies.update()
+            .where(movies.c.id.in_(set(movie_ids)))
+            .values(cast_size=select([func.count()])
+                    .where(cast.c.movie_id == movies.c.id)
+                    .as_scalar()))
+
+
+'''
+    parse_release_date(value) method
+    @INPUTS
+        value: an ISO date (2021-05-22), or a legacy DD-MM-YYYY date
+         (22-05-2021)
+
+    raises ValueError for any other value
+    returns the date
+'''
+
+RELEASE_DATE_FORMATS = (
+    (re.compile(r'\d{4}-\d{2}-\d{2}'), '%Y-%m-%d'),
+    (re.compile(r'\d{2}-\d{2}-\d{4}'), '%d-%m-%Y')
+)
+
+
+def parse_release_date(value):
+    if isinstance(value, date):
+        return value
+    if not isinstance(value, str):
+        raise ValueError('release_date must be a date string')
+
+    for pattern, format in RELEASE_DATE_FORMATS:
+        if pattern.fullmatch(value):
+            try:
+                return datetime.strptime(value, format).date()
+            except ValueError:
+                raise ValueError('release_date is not a valid date')
+
+    raise ValueError('release_date must be YYYY-MM-DD or DD-MM-YYYY')
+
+
+def format_date(value):
+    return value.isoformat() if value is not None else None
+
+
 '''
     Movie
 '''
@@ -46,31 +227,174 @@ class Movie(db.Model):
 
     id = Column(Integer, primary_key=True)
     title = Column(String)
-    release_date = Column(String)
+    release_date = Column(Date)
+    # the number of cast rows of the movie, see recount_cast
+    cast_size = Column(Integer, nullable=False, default=0,
+                       server_default='0')
     cast = db.relationship('Actor', secondary=cast,
                            backref=db.backref('movies', lazy=True))
 
+    # filters and sorted pages of GET /movies, see database.filters
+    __table_args__ = (
+        Index('ix_movies_release_date', release_date, id),
+        Index('ix_movies_title', title,
+              postgresql_ops={'title': 'text_pattern_ops'}),
+        Index('ix_movies_cast_size', cast_size, id),
+    )
+
     def __init__(self, title, release_date):
         self.title = title
-        self.release_date = release_date
+        self.release_date = parse_release_date(release_date)
 
     def insert(self):
+        actor_ids = [actor.id for actor in self.cast]
         db.session.add(self)
+        db.session.flush()
+        recount_cast(actor_ids, [self.id])
+        bump_versions('movies', 'cast', 'actors')
+        version = cast_version()
         db.session.commit()
+        entity_cache.invalidate('actor', *actor_ids)
+        search_index.add('movie', self.id, self.title)
+        cast_graph.set_casts(version, {self.id: actor_ids})
 
     def update(self):
+        history = inspect(self).attrs.cast.history
+        # the actors joining or leaving the cast; assigning the same cast
+        # changes nothing, so the cast ETags and graph stay valid
+        recast = {actor.id for actor in history.added} ^ \
+            {actor.id for actor in history.deleted}
+        casts, version = {}, None
+        if recast:
+            casts = {self.id: [actor.id for actor in self.cast]}
+            recount_cast(recast, [self.id])
+            bump_versions('movies', 'cast', 'actors')
+            version = cast_version()
+        else:
+            bump_versions('movies')
         db.session.commit()
+        entity_cache.invalidate('movie', self.id)
+        entity_cache.invalidate('actor', *recast)
+        search_index.add('movie', self.id, self.title)
+        cast_graph.set_casts(version, casts)
 
     def delete(self):
+        actor_ids = [actor.id for actor in self.cast]
         db.session.delete(self)
+        recount_cast(actor_ids)
+        bump_versions('movies', 'cast', 'actors')
+        version = cast_version()
+        db.session.commit()
+        entity_cache.invalidate('movie', self.id)
+        entity_cache.invalidate('actor', *actor_ids)
+        search_index.remove('movie', self.id)
+        cast_graph.set_casts(version, {self.id: []})
+
+    @classmethod
+    def insert_many(cls, rows):
+        """
+        inserts movies, and their cast rows, in a single transaction
+        each row holds title, release_date and cast, a list of actor ids
+        returns the new movie ids in row order
+        """
+        if not rows:
+            return []
+
+        ids = bulk_insert(cls, [
+            {'title': row['title'], 'release_date': row['release_date']}
+            for row in rows
+        ])
+        cast_rows = [
+            {'movie_id': movie_id, 'actor_id': actor_id}
+            for movie_id, row in zip(ids, rows)
+            for actor_id in row['cast']
+        ]
+        if cast_rows:
+            db.session.execute(cast.insert(), cast_rows)
+
+        actor_ids = {row['actor_id'] for row in cast_rows}
+        recount_cast(actor_ids, ids)
+        bump_versions('movies', 'cast', 'actors')
+        version = cast_version()
+        db.session.commit()
+        entity_cache.invalidate('actor', *actor_ids)
+        for movie_id, row in zip(ids, rows):
+            search_index.add('movie', movie_id, row['title'])
+        cast_graph.set_casts(version, {
+            movie_id: row['cast'] for movie_id, row in zip(ids, rows)
+        })
+        return ids
+
+    @classmethod
+    def update_many(cls, rows):
+        """
+        updates movies in a single transaction
+        each row holds id and the changed columns; a cast list of actor
+        ids replaces that movie's cast, when it differs from it
+        """
+        if not rows:
+            return
+
+        recast = {row['id']: row['cast'] for row in rows if 'cast' in row}
+        columns = [
+            {name: value for name, value in row.items() if name != 'cast'}
+            for row in rows
+        ]
+        columns = [row for row in columns if len(row) > 1]
+
+        if columns:
+            db.session.bulk_update_mappings(cls, columns)
+
+        stored = {}
+        if recast:
+            for movie_id, actor_id in db.session.execute(
+                    select([cast.c.movie_id, cast.c.actor_id])
+                    .where(cast.c.movie_id.in_(recast.keys()))):
+                stored.setdefault(movie_id, set()).add(actor_id)
+        recast = {
+            movie_id: actor_ids for movie_id, actor_ids in recast.items()
+            if set(actor_ids) != stored.get(movie_id, set())
+        }
+
+        # actors leaving or joining a cast change movie_count
+        recounted = set()
+        for movie_id, actor_ids in recast.items():
+            recounted.update(set(actor_ids) ^ stored.get(movie_id, set()))
+
+        version = None
+        if recast:
+            db.session.execute(
+                cast.delete().where(cast.c.movie_id.in_(recast.keys())))
+            cast_rows = [
+                {'movie_id': movie_id, 'actor_id': actor_id}
+                for movie_id, actor_ids in recast.items()
+                for actor_id in actor_ids
+            ]
+            if cast_rows:
+                db.session.execute(cast.insert(), cast_rows)
+            recount_cast(recounted, recast.keys())
+            bump_versions('movies', 'cast', 'actors')
+            version = cast_version()
+        else:
+            bump_versions('movies')
         db.session.commit()
+        entity_cache.invalidate('movie', *(row['id'] for row in rows))
+        entity_cache.invalidate('actor', *recounted)
+        for row in rows:
+            if 'title' in row:
+                search_index.add('movie', row['id'], row['title'])
+        cast_graph.set_casts(version, recast)
 
-    def format(self):
-        return {
+    def format(self, include=()):
+        movie = {
             'id': self.id,
             'title': self.title,
-            'release_date': self.release_date
+            'release_date': format_date(self.release_date),
+            'cast_size': self.cast_size
         }
+        if 'cast' in include:
+            movie['cast'] = [actor.name for actor in self.cast]
+        return movie
 
 
 '''
@@ -85,6 +409,18 @@ class Actor(db.Model):
     name = Column(String)
     age = Column(Integer)
     gender = Column(String)
+    # the number of cast rows of the actor, see recount_cast
+    movie_count = Column(Integer, nullable=False, default=0,
+                         server_default='0')
+
+    __table_args__ = (
+        Index('ix_actors_name', name),
+        Index('ix_actors_name_lower', func.lower(name)),
+        # filters and sorted pages of GET /actors, see database.filters
+        Index('ix_actors_age', age, id),
+        Index('ix_actors_gender', gender, id),
+        Index('ix_actors_movie_count', movie_count, id),
+    )
 
     def __init__(self, name, age, gender):
         self.name = name
@@ -93,19 +429,178 @@ class Actor(db.Model):
 
     def insert(self):
         db.session.add(self)
+        bump_versions('actors')
         db.session.commit()
+        search_index.add('actor', self.id, self.name)
 
     def update(self):
+        bump_versions('actors')
         db.session.commit()
+        entity_cache.invalidate('actor', self.id)
+        search_index.add('actor', self.id, self.name)
 
     def delete(self):
+        movie_ids = [movie.id for movie in self.movies]
         db.session.delete(self)
+        recount_cast(movie_ids=movie_ids)
+        bump_versions('actors', 'cast', 'movies')
+        version = cast_version()
         db.session.commit()
+        entity_cache.invalidate('actor', self.id)
+        entity_cache.invalidate('movie', *movie_ids)
+        search_index.remove('actor', self.id)
+        cast_graph.remove_actors(version, [self.id])
+
+    @classmethod
+    def insert_many(cls, rows):
+        """
+        inserts actors in a single transaction
+        returns the new actor ids in row order
+        """
+        if not rows:
+            return []
+
+        ids = bulk_insert(cls, rows)
+        bump_versions('actors')
+        db.session.commit()
+        for actor_id, row in zip(ids, rows):
+            search_index.add('actor', actor_id, row['name'])
+        return ids
+
+    @classmethod
+    def update_many(cls, rows):
+        """
+        updates actors in a single transaction
+        each row holds id and the changed columns
+        """
+        if not rows:
+            return
 
-    def format(self):
-        return {
+        db.session.bulk_update_mappings(cls, rows)
+        bump_versions('actors')
+        db.session.commit()
+        entity_cache.invalidate('actor', *(row['id'] for row in rows))
+        for row in rows:
+            if 'name' in row:
+                search_index.add('actor', row['id'], row['name'])
+
+    def format(self, include=()):
+        actor = {
             'id': self.id,
             'name': self.name,
             'age': self.age,
-            'gender': self.gender
+            'gender': self.gender,
+            'movie_count': self.movie_count
         }
+        if 'movies' in include:
+            actor['movies'] = [movie.title for movie in self.movies]
+        return actor
+
+
+'''
+    bulk_insert(model, rows) method
+    @INPUTS
+        model: the model class whose table receives the rows
+        rows: list of column dicts
+
+    inserts every row without building ORM objects, as a single
+    multi-row INSERT ... RETURNING on Postgres
+    does not commit
+    returns the new primary keys in row order
+'''
+
+
+def bulk_insert(model, rows):
+    if not rows:
+        return []
+
+    if db.session.get_bind().dialect.name == 'postgresql':
+        table = model.__table__
+        result = db.session.execute(
+            table.insert().values(rows).returning(table.c.id))
+        return [row[0] for row in result]
+
+    rows = [dict(row) for row in rows]
+    db.session.bulk_insert_mappings(model, rows, return_defaults=True)
+    return [row['id'] for row in rows]
+
+
+'''
+    resolve_casts(casts, case_insensitive) method
+    @INPUTS
+        casts: list of cast lists, each holding actor ids (int) and/or
+         actor names (string)
+        case_insensitive: match names on lower(name)
+
+    resolves every cast in the batch with one indexed query
+    raises ValueError if a cast is not a list, or an entry is neither
+     an id nor a name
+    returns a CastResolution per cast with the matched actors in entry
+    order, the entries that matched no actor and the names that matched
+    more than one actor
+'''
+
+CastResolution = namedtuple('CastResolution',
+                            ['actors', 'missing', 'ambiguous'])
+
+
+def resolve_casts(casts, case_insensitive=False):
+    ids = set()
+    names = set()
+    for entries in casts:
+        if not isinstance(entries, (list, tuple)):
+            raise ValueError
+
+        for entry in entries:
+            if isinstance(entry, bool):
+                raise ValueError
+            if isinstance(entry, int):
+                ids.add(entry)
+            elif isinstance(entry, str):
+                names.add(entry.lower() if case_insensitive else entry)
+            else:
+                raise ValueError
+
+    name_column = func.lower(Actor.name) if case_insensitive else Actor.name
+
+    conditions = []
+    if ids:
+        conditions.append(Actor.id.in_(ids))
+    if names:
+        conditions.append(name_column.in_(names))
+
+    found = Actor.query.filter(or_(*conditions)).all() if conditions else []
+
+    by_id = {actor.id: actor for actor in found}
+    by_name = {}
+    for actor in found:
+        key = actor.name.lower() if case_insensitive and actor.name \
+            else actor.name
+        by_name.setdefault(key, []).append(actor)
+
+    resolutions = []
+    for entries in casts:
+        actors, missing, ambiguous = [], [], []
+        for entry in entries:
+            if isinstance(entry, int):
+                matches = [by_id[entry]] if entry in by_id else []
+            else:
+                matches = by_name.get(
+                    entry.lower() if case_insensitive else entry, [])
+
+            if not matches:
+                missing.append(entry)
+            elif len(matches) > 1:
+                ambiguous.append(entry)
+            elif matches[0] not in actors:
+                actors.append(matches[0])
+
+        resolutions.append(CastResolution(actors, missing, ambiguous))
+
+    return resolutions
+
+
+def resolve_cast(entries, case_insensitive=False):
+    """Resolves a single cast list, see resolve_casts
+    """
+    return resolve_casts([entries], case_insensitive)[0]
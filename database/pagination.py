@@ -0,0 +1,184 @@
+import base64
+import json
+from datetime import date
+
+from sqlalchemy import Date, Integer, and_, or_
+
+'''
+Keyset (cursor) pagination
+
+    Pages are fetched with `WHERE key > :last ORDER BY key LIMIT :n`, so
+    deep pages cost the same as the first one, unlike OFFSET. The cursor
+    handed to clients is an opaque url-safe encoding of the last key.
+'''
+
+
+def encode_cursor(values):
+    raw = json.dumps(values, separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).rstrip(b'=').decode('ascii')
+
+
+def decode_cursor(cursor):
+    """Returns the list of key values in cursor
+
+    raises ValueError if the cursor is malformed
+    """
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        values = json.loads(base64.urlsafe_b64decode(padded.encode('ascii')))
+    except Exception:
+        raise ValueError('Malformed cursor')
+
+    if not isinstance(values, list) or not values:
+        raise ValueError('Malformed cursor')
+
+    return values
+
+
+def cursor_value(column, value):
+    """Returns value, a value of column in a cursor
+
+    raises ValueError if value is not of the type of column, so a crafted
+    or stale cursor never reaches the database
+    """
+    if isinstance(column.type, Date):
+        # written to the cursor in ISO format, see keyset_cursor
+        try:
+            return date.fromisoformat(value)
+        except (TypeError, ValueError):
+            raise ValueError('Malformed cursor')
+
+    if isinstance(column.type, Integer):
+        valid = isinstance(value, int) and not isinstance(value, bool)
+    else:
+        valid = isinstance(value, column.type.python_type)
+    if not valid:
+        raise ValueError('Malformed cursor')
+
+    return value
+
+
+'''
+    page_args(args, default_size, max_size) method
+    @INPUTS
+        args: request query arguments
+        default_size: page size used when no limit is given
+        max_size: hard upper bound on the page size
+
+    raises ValueError if limit is not a positive integer
+    returns the (limit, after) pair
+'''
+
+
+def page_args(args, default_size, max_size):
+    limit = args.get('limit')
+    if limit is None:
+        limit = default_size
+    else:
+        limit = int(limit)
+        if limit <= 0:
+            raise ValueError('limit must be positive')
+
+    return min(limit, max_size), args.get('after')
+
+
+'''
+Sorted pages
+
+    With a sort column the order is (sort, key) and the cursor holds
+    both values of the last row, so ties on the sort column still page
+    correctly. NULL sort values come last in either direction, and are
+    paged on the key alone.
+'''
+
+
+def keyset_order(column, sort=None, descending=False):
+    """Returns the ORDER BY clauses of a keyset page
+    """
+    if sort is None:
+        return [column.desc() if descending else column]
+
+    order = sort.desc() if descending else sort.asc()
+    return [order.nullslast(), column]
+
+
+def keyset_after(query, column, after, sort=None, descending=False):
+    """Filters query to the rows after the cursor
+
+    raises ValueError if the cursor is malformed
+    """
+    values = decode_cursor(after)
+    if sort is None:
+        (last,) = values
+        last = cursor_value(column, last)
+        return query.filter(column < last if descending else column > last)
+
+    value, last = values
+    last = cursor_value(column, last)
+    if value is not None:
+        value = cursor_value(sort, value)
+    if value is None:
+        return query.filter(sort.is_(None), column > last)
+
+    beyond = sort < value if descending else sort > value
+    return query.filter(or_(beyond,
+                            and_(sort == value, column > last),
+                            sort.is_(None)))
+
+
+def keyset_cursor(row, column, sort=None):
+    if sort is None:
+        return encode_cursor([getattr(row, column.key)])
+
+    value = getattr(row, sort.key)
+    if isinstance(value, date):
+        value = value.isoformat()
+    return encode_cursor([value, getattr(row, column.key)])
+
+
+'''
+    keyset_page(query, column, limit, after, sort, descending) method
+    @INPUTS
+        query: the query to paginate
+        column: unique, indexed column the pages are keyed on (i.e. Movie.id)
+        limit: page size
+        after: cursor returned with the previous page, or None
+        sort: optional column to order by first, with column breaking ties;
+         the query must select it
+        descending: whether the page is in descending order
+
+    raises ValueError if the cursor is malformed
+    returns the (rows, next_cursor) pair, next_cursor is None on the
+    last page
+'''
+
+
+def keyset_page(query, column, limit, after=None, sort=None,
+                descending=False):
+    rows = keyset_query(query, column, limit, after, sort, descending).all()
+    return keyset_result(rows, column, limit, sort)
+
+
+def keyset_query(query, column, limit, after=None, sort=None,
+                 descending=False):
+    """Returns the query of a page, see keyset_page
+
+    raises ValueError if the cursor is malformed
+    """
+    if after is not None:
+        query = keyset_after(query, column, after, sort, descending)
+
+    # one extra row tells whether another page exists
+    return query.order_by(*keyset_order(column, sort, descending)) \
+        .limit(limit + 1)
+
+
+def keyset_result(rows, column, limit, sort=None):
+    """Returns the (rows, next_cursor) pair of the rows of a keyset_query
+    """
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = keyset_cursor(rows[-1], column, sort)
+
+    return rows, next_cursor
@@ -0,0 +1,65 @@
+from database.filters import sort_arg
+
+
+'''
+Query builders shared by the Flask app and the ASGI app (asgi.py)
+
+    Each takes the request query arguments and raises ValueError for
+    invalid ones, which both apps answer with 422, so the two build the
+    same SQL for the same request.
+'''
+
+
+def include_arg(args, serializer):
+    """Parses ?include= into the serializer relations to add
+
+    raises ValueError for a relation serializer does not have
+    """
+    include = frozenset(
+        name for name in args.get('include', '').split(',') if name)
+    if not include <= serializer.relations.keys():
+        raise ValueError('Unknown relation')
+
+    # each relation is fetched for a whole batch of rows with one
+    # extra IN query instead of one query per row
+    return include
+
+
+def fields_arg(args, serializer):
+    """Restricts serializer to the ?fields= columns
+
+    raises ValueError for an unknown or empty field list
+    """
+    fields = args.get('fields')
+    if fields is None:
+        return serializer
+
+    # only the requested columns are selected, so both the database
+    # and the encoder skip the others
+    return serializer.only(name for name in fields.split(',') if name)
+
+
+'''
+    list_query(query, serializer, args, filters, sorts) method
+    @INPUTS
+        query: the query selecting serializer's columns
+        serializer: the Serializer of the rows
+        args: request query arguments
+        filters: function returning the SQL conditions of args, see
+         database.filters
+        sorts: the columns ?sort= accepts
+
+    raises ValueError for an invalid filter or sort
+    returns the (query, sort column, descending) triple
+'''
+
+
+def list_query(query, serializer, args, filters, sorts):
+    conditions = filters(args)
+    sort, descending = sort_arg(args, sorts)
+
+    query = query.filter(*conditions)
+    # the next cursor is read from the sort column
+    if sort is not None and sort.key not in serializer.fields:
+        query = query.add_columns(sort)
+    return query, sort, descending
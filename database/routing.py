@@ -0,0 +1,119 @@
+import random
+from functools import wraps
+
+from flask import g, current_app, has_request_context
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from sqlalchemy import create_engine, orm
+
+from database.cache import LRUCache, RedisCache
+from database.engine import engine_options, install_engine_hooks, \
+    install_query_hooks, setting
+
+
+'''
+ReplicaRouter
+    Engines for the read replicas listed in DATABASE_REPLICA_URLS, and
+    the subjects that wrote within the last DATABASE_READ_YOUR_WRITES
+    seconds; their reads stay on the primary so they see their own
+    writes despite replication lag.
+'''
+
+
+class ReplicaRouter:
+    def __init__(self, engines, recent_writes):
+        self.engines = engines
+        self.recent_writes = recent_writes
+
+    def record_write(self, subject):
+        if subject is not None:
+            self.recent_writes.set('rw:{}'.format(subject), True)
+
+    def engine_for(self, subject):
+        if subject is not None and \
+                self.recent_writes.get('rw:{}'.format(subject)):
+            return None
+        return random.choice(self.engines)
+
+
+'''
+    read_only(f) decorator method
+    marks a route as read-only, so its queries may run on a replica
+'''
+
+
+def read_only(f):
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+        g.db_read_only = True
+        return f(*args, **kwargs)
+    return wrapper
+
+
+def replica_engine():
+    """
+    returns the replica engine for the current request, or None when
+    the request must use the primary
+    """
+    if not has_request_context() or not g.get('db_read_only'):
+        return None
+
+    # one replica for the whole request
+    if 'db_replica' not in g:
+        router = current_app.extensions.get('replica_router')
+        principal = g.get('principal')
+        g.db_replica = router.engine_for(
+            principal.subject if principal is not None else None
+        ) if router is not None else None
+
+    return g.db_replica
+
+
+class RoutingSession(SignallingSession):
+    def get_bind(self, mapper=None, clause=None):
+        engine = replica_engine()
+        if engine is not None:
+            return engine
+        return super().get_bind(mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+'''
+configure_replicas(app, cache_backend)
+    creates the replica engines from the app config or environment
+        DATABASE_REPLICA_URLS: comma separated replica database urls
+        DATABASE_READ_YOUR_WRITES: seconds a writer's reads stay on the
+         primary (default 5)
+    recent writes are shared between workers when cache_backend is redis
+'''
+
+
+def configure_replicas(app, cache_backend):
+    urls = setting(app.config, 'DATABASE_REPLICA_URLS') or ''
+    if isinstance(urls, str):
+        urls = [url.strip() for url in urls.split(',') if url.strip()]
+
+    if not urls:
+        app.extensions.pop('replica_router', None)
+        return None
+
+    window = int(setting(app.config, 'DATABASE_READ_YOUR_WRITES', 5))
+    if isinstance(cache_backend, RedisCache):
+        recent_writes = RedisCache(cache_backend.client, ttl=window,
+                                   prefix=cache_backend.prefix)
+    else:
+        recent_writes = LRUCache(ttl=window)
+
+    engines = [create_engine(url, **engine_options(url, app.config))
+               for url in urls]
+    # the same per-transaction statement timeout and query hooks as the
+    # primary, see setup_db
+    for engine in engines:
+        install_engine_hooks(engine, app.config)
+        install_query_hooks(engine, app.config)
+    router = ReplicaRouter(engines, recent_writes)
+    app.extensions['replica_router'] = router
+    return router
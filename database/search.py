@@ -0,0 +1,266 @@
+import heapq
+import math
+import re
+import threading
+from collections import Counter, defaultdict
+
+from sqlalchemy import text
+
+
+'''
+Search over actor names and movie titles
+
+    A result matches when it holds every word of the query (full text),
+    or when it holds enough of the query's trigrams (typos, half
+    remembered titles), as measured by pg_trgm's word_similarity: the
+    share of the query's trigrams found in the result. Results are ranked
+    by
+        score = full text match (1 or 0) + word similarity
+    so full text matches come first, closest spellings first.
+
+    On Postgres the query runs against the GIN indexes created by the
+    search migration (to_tsvector and pg_trgm). Elsewhere, i.e. SQLite
+    and the tests, an in-process SearchIndex answers it.
+'''
+
+# minimum word similarity of a result, pg_trgm.word_similarity_threshold
+# on Postgres
+SIMILARITY_THRESHOLD = 0.5
+
+WORD = re.compile(r'\w+')
+
+KINDS = ('actor', 'movie')
+
+
+def words(value):
+    return WORD.findall(value.lower())
+
+
+def trigrams(value_words):
+    """the trigrams pg_trgm extracts from the words of a value"""
+    grams = set()
+    for word in value_words:
+        padded = '  ' + word + ' '
+        grams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return grams
+
+
+'''
+SearchIndex
+    In-process inverted index of words and trigrams, loaded from the
+    database on the first search and then kept current by the model
+    insert, update and delete methods. Each worker process holds its
+    own, so it is meant for a single process, i.e. SQLite and tests.
+'''
+
+
+class SearchIndex:
+    def __init__(self, threshold=SIMILARITY_THRESHOLD):
+        self.threshold = threshold
+        self.loaded = False
+        # postings hold small document numbers rather than (kind, id)
+        # keys, which are much slower to hash and count
+        self._numbers = {}
+        self._documents = {}
+        self._next_number = 0
+        self._kinds = defaultdict(set)
+        self._words = defaultdict(set)
+        self._trigrams = defaultdict(set)
+        self._lock = threading.RLock()
+
+    def _add(self, key, label):
+        self._discard(key)
+        number = self._next_number
+        self._next_number += 1
+
+        document_words = frozenset(words(label or ''))
+        document_trigrams = frozenset(trigrams(document_words))
+        self._numbers[key] = number
+        self._documents[number] = (key, label, document_words,
+                                   document_trigrams)
+        self._kinds[key[0]].add(number)
+        for word in document_words:
+            self._words[word].add(number)
+        for gram in document_trigrams:
+            self._trigrams[gram].add(number)
+
+    def _discard(self, key):
+        number = self._numbers.pop(key, None)
+        if number is None:
+            return
+
+        _, _, document_words, document_trigrams = \
+            self._documents.pop(number)
+        self._kinds[key[0]].discard(number)
+        for word in document_words:
+            self._words[word].discard(number)
+        for gram in document_trigrams:
+            self._trigrams[gram].discard(number)
+
+    def add(self, kind, id, label):
+        """indexes or re-indexes a document, once the index is loaded"""
+        with self._lock:
+            if self.loaded:
+                self._add((kind, id), label)
+
+    def remove(self, kind, *ids):
+        with self._lock:
+            for id in ids:
+                self._discard((kind, id))
+
+    def load(self, documents):
+        """replaces the index with documents, (kind, id, label) tuples"""
+        with self._lock:
+            self.clear()
+            for kind, id, label in documents:
+                self._add((kind, id), label)
+            self.loaded = True
+
+    def clear(self):
+        with self._lock:
+            self._numbers.clear()
+            self._documents.clear()
+            self._next_number = 0
+            self._kinds.clear()
+            self._words.clear()
+            self._trigrams.clear()
+            self.loaded = False
+
+    def search(self, query, kinds=KINDS, limit=None):
+        """returns the best limit (all by default) ranked
+        (score, kind, id, label) matches
+        """
+        query_words = set(words(query))
+        query_trigrams = trigrams(query_words)
+        if not query_trigrams:
+            return []
+
+        # fewer shared trigrams can not reach the threshold
+        needed = max(1, math.ceil(self.threshold * len(query_trigrams)))
+
+        with self._lock:
+            full_text = set.intersection(*(
+                self._words.get(word, set()) for word in query_words
+            )) if query_words else set()
+
+            # a document sharing `needed` trigrams holds at least one of
+            # the len - needed + 1 rarest, so only those postings are
+            # counted in full, the others only for their candidates
+            postings = sorted((self._trigrams.get(gram, set())
+                               for gram in query_trigrams), key=len)
+            rare = len(postings) - needed + 1
+            shared = Counter()
+            for posting in postings[:rare]:
+                shared.update(posting)
+            for posting in postings[rare:]:
+                shared.update(posting.intersection(shared))
+
+            allowed = set().union(*(self._kinds[kind] for kind in kinds)) \
+                if set(kinds) != self._kinds.keys() else None
+            if allowed is not None:
+                full_text &= allowed
+                shared = {number: shared[number]
+                          for number in shared.keys() & allowed}
+
+            # full text matches rank first; after them only documents
+            # sharing as many trigrams as the last one in the limit can
+            # make it into the results
+            cutoff = needed
+            remaining = limit - len(full_text) if limit is not None else 0
+            if limit is not None and remaining <= 0:
+                cutoff = len(query_trigrams) + 1
+            elif remaining and len(shared) > limit:
+                # the full text matches take at most len(full_text) of
+                # the top counts
+                cutoff = max(cutoff, heapq.nlargest(
+                    limit, shared.values())[-1])
+
+            candidates = full_text.union(
+                number for number, count in shared.items()
+                if count >= cutoff)
+
+            results = []
+            for number in candidates:
+                (kind, id), label, _, _ = self._documents[number]
+                similarity = shared.get(number, 0) / len(query_trigrams)
+                results.append((int(number in full_text) + similarity,
+                                kind, id, label))
+
+        def rank(result):
+            return -result[0], result[1], result[2]
+
+        if limit is None:
+            return sorted(results, key=rank)
+        return heapq.nsmallest(limit, results, key=rank)
+
+
+search_index = SearchIndex()
+
+
+POSTGRES_SEARCH = {
+    'actor': '''
+        SELECT 'actor' AS kind, id, name AS label,
+            (to_tsvector('simple', coalesce(name, ''))
+                @@ plainto_tsquery('simple', :query))::int
+            + word_similarity(:lower_query, lower(name)) AS score
+        FROM actors
+        WHERE to_tsvector('simple', coalesce(name, ''))
+                @@ plainto_tsquery('simple', :query)
+            OR :lower_query <% lower(name)
+    ''',
+    'movie': '''
+        SELECT 'movie' AS kind, id, title AS label,
+            (to_tsvector('simple', coalesce(title, ''))
+                @@ plainto_tsquery('simple', :query))::int
+            + word_similarity(:lower_query, lower(title)) AS score
+        FROM movies
+        WHERE to_tsvector('simple', coalesce(title, ''))
+                @@ plainto_tsquery('simple', :query)
+            OR :lower_query <% lower(title)
+    '''
+}
+
+
+'''
+    search(session, query, kinds, limit, offset) method
+    @INPUTS
+        session: the database session
+        query: the search string
+        kinds: the result kinds to search, 'actor' and/or 'movie'
+        limit: number of results to return
+        offset: number of results to skip
+
+    returns the ranked (score, kind, id, label) results
+'''
+
+
+def search(session, query, kinds=KINDS, limit=20, offset=0):
+    kinds = [kind for kind in KINDS if kind in kinds]
+    if not kinds:
+        return []
+
+    if session.get_bind().dialect.name == 'postgresql':
+        # <% uses the GIN trigram indexes with this threshold
+        session.execute(
+            text('SET LOCAL pg_trgm.word_similarity_threshold = {}'.format(
+                SIMILARITY_THRESHOLD)))
+        statement = text(
+            ' UNION ALL '.join(POSTGRES_SEARCH[kind] for kind in kinds)
+            + ' ORDER BY score DESC, kind, id LIMIT :limit OFFSET :offset')
+        rows = session.execute(statement, {
+            'query': query,
+            'lower_query': query.lower(),
+            'limit': limit,
+            'offset': offset
+        })
+        return [(score, kind, id, label)
+                for kind, id, label, score in rows]
+
+    if not search_index.loaded:
+        search_index.load(
+            [('actor', id, name) for id, name in session.execute(
+                'SELECT id, name FROM actors')] +
+            [('movie', id, title) for id, title in session.execute(
+                'SELECT id, title FROM movies')])
+
+    return search_index.search(query, kinds, offset + limit)[offset:]
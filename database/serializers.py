@@ -0,0 +1,171 @@
+import json
+import time
+
+from flask import current_app, jsonify
+from sqlalchemy import select
+
+from database.models import db, cast, format_date, Actor, Movie
+from metrics import record_serialization
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+'''
+dumps(data) method
+    encodes data exactly as jsonify does with the default settings:
+    sorted keys, compact separators and non-ASCII characters escaped
+    uses orjson when it is installed, and falls back to the stdlib
+    encoder for any output orjson would write differently
+    returns bytes
+'''
+
+
+def dumps(data):
+    if orjson is not None:
+        try:
+            encoded = orjson.dumps(data, option=orjson.OPT_SORT_KEYS)
+        except TypeError:
+            encoded = None
+
+        # orjson writes non-ASCII characters and DEL unescaped
+        if encoded is not None and encoded.isascii() \
+                and b'\x7f' not in encoded:
+            return encoded
+
+    return json.dumps(data, sort_keys=True, separators=(',', ':'),
+                      ensure_ascii=True).encode('ascii')
+
+
+def json_response(data, status=200):
+    """jsonify(data), encoded with dumps when the app uses the defaults
+    """
+    start = time.perf_counter()
+    config = current_app.config
+    if not config['JSON_SORT_KEYS'] or not config['JSON_AS_ASCII'] \
+            or config['JSONIFY_PRETTYPRINT_REGULAR'] or current_app.debug:
+        response = jsonify(data)
+        response.status_code = status
+    else:
+        response = current_app.response_class(
+            dumps(data) + b'\n', status=status,
+            mimetype=config['JSONIFY_MIMETYPE'])
+
+    record_serialization(time.perf_counter() - start)
+    return response
+
+
+'''
+Serializer
+    Builds the representation returned by format() straight from column
+    tuples, so list endpoints neither hydrate ORM objects nor fill the
+    session's identity map.
+
+    fields: the model columns, in format() order
+    relations: ?include= name -> RelatedValues
+    formats: column name -> function converting its values to JSON
+     types, as format() does (i.e. dates to ISO strings)
+'''
+
+
+class Serializer:
+    def __init__(self, model, fields, relations, formats=None):
+        self.model = model
+        self.fields = fields
+        self.relations = relations
+        self.formats = {
+            name: format for name, format in (formats or {}).items()
+            if name in fields
+        }
+
+    def only(self, names):
+        """returns a Serializer for the named columns, id is always kept
+
+        raises ValueError if names is empty or not all model columns
+        """
+        names = set(names)
+        if not names or not names <= set(self.fields):
+            raise ValueError('Unknown field')
+
+        return Serializer(self.model, tuple(
+            name for name in self.fields if name == 'id' or name in names
+        ), self.relations, self.formats)
+
+    def columns(self):
+        return [getattr(self.model, name) for name in self.fields]
+
+    def query(self):
+        return db.session.query(*self.columns())
+
+    def dicts(self, rows, include=()):
+        items = self.items(rows)
+        for name in include:
+            self.attach(items, name, self.relations[name](
+                [item['id'] for item in items]))
+        return items
+
+    def items(self, rows):
+        """the representations of rows, without relations"""
+        start = time.perf_counter()
+        items = [dict(zip(self.fields, row)) for row in rows]
+
+        for name, format in self.formats.items():
+            for item in items:
+                item[name] = format(item[name])
+
+        record_serialization(time.perf_counter() - start)
+        return items
+
+    @staticmethod
+    def attach(items, name, related):
+        for item in items:
+            item[name] = related.get(item['id'], [])
+
+
+class RelatedValues:
+    """A relation for Serializer: one IN query per batch of ids
+
+    statement and group are used on their own by callers that run the
+    query themselves, see database.aio
+    """
+
+    def __init__(self, key, value, join):
+        self.key = key
+        self.value = value
+        self.join = join
+
+    def statement(self, ids):
+        return select([self.key, self.value]).select_from(self.join) \
+            .where(self.key.in_(ids))
+
+    @staticmethod
+    def group(rows):
+        """returns the dict of id -> list of related values"""
+        related = {}
+        for id, item in rows:
+            related.setdefault(id, []).append(item)
+        return related
+
+    def __call__(self, ids):
+        if not ids:
+            return {}
+        return self.group(db.session.execute(self.statement(ids)))
+
+
+movie_serializer = Serializer(Movie, (
+    'id', 'title', 'release_date', 'cast_size'
+), {
+    'cast': RelatedValues(
+        cast.c.movie_id, Actor.name,
+        cast.join(Actor.__table__, cast.c.actor_id == Actor.id))
+}, {'release_date': format_date})
+
+actor_serializer = Serializer(Actor, (
+    'id', 'name', 'age', 'gender', 'movie_count'
+), {
+    'movies': RelatedValues(
+        cast.c.actor_id, Movie.title,
+        cast.join(Movie.__table__, cast.c.movie_id == Movie.id))
+})
@@ -0,0 +1,124 @@
+import os
+
+'''
+Gunicorn settings for production, see Procfile
+
+    gunicorn -c python:gunicorn_conf 'app:create_app()'
+
+The app is preloaded in the master process (GUNICORN_PRELOAD, default
+true): creating it opens no connection, and the workers share its memory
+and start serving at once. WEB_IO_PROFILE picks the worker model from how
+requests spend their time:
+    cpu: sync workers, 2 per core plus one
+    mixed (default): gthread workers, one per core plus one, with
+     WEB_THREADS threads each (default 4)
+    io: gevent workers, one per core, each serving up to
+     WEB_WORKER_CONNECTIONS requests at once (default 1000); requires
+     gevent, and psycogreen on Postgres
+
+Each worker starts loading the in-memory co-star graph once it has
+loaded the app, see database.models.warm_cast_graph.
+
+WEB_CONCURRENCY overrides the number of workers. Workers are replaced
+after GUNICORN_MAX_REQUESTS requests (default 1000), plus a random jitter
+of up to GUNICORN_MAX_REQUESTS_JITTER (default a tenth of it), so they do
+not all restart at once.
+'''
+
+PROFILES = ('cpu', 'mixed', 'io')
+
+
+def cores():
+    """the cores this process may run on, which a container may limit"""
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+'''
+    worker_profile(io_profile, cores, concurrency, threads) method
+    @INPUTS
+        io_profile: one of PROFILES
+        cores: the number of cores
+        concurrency: number of workers, overrides the default of the
+         profile
+        threads: threads per gthread worker
+
+    raises ValueError for an unknown profile
+    returns the (worker class, workers, threads) triple
+'''
+
+
+def worker_profile(io_profile, cores, concurrency=None, threads=None):
+    if io_profile == 'cpu':
+        return 'sync', concurrency or 2 * cores + 1, 1
+    if io_profile == 'mixed':
+        return 'gthread', concurrency or cores + 1, threads or 4
+    if io_profile == 'io':
+        return 'gevent', concurrency or cores, 1
+    raise ValueError('Unknown WEB_IO_PROFILE: ' + io_profile)
+
+
+def env_int(name):
+    value = os.environ.get(name)
+    return int(value) if value else None
+
+
+worker_class, workers, threads = worker_profile(
+    os.environ.get('WEB_IO_PROFILE', 'mixed'), cores(),
+    env_int('WEB_CONCURRENCY'), env_int('WEB_THREADS'))
+worker_connections = env_int('WEB_WORKER_CONNECTIONS') or 1000
+
+bind = '0.0.0.0:{}'.format(os.environ.get('PORT', 8000))
+preload_app = os.environ.get('GUNICORN_PRELOAD', 'true').lower() in \
+    ('1', 'true', 'yes', 'on')
+
+max_requests = env_int('GUNICORN_MAX_REQUESTS')
+if max_requests is None:
+    max_requests = 1000
+max_requests_jitter = env_int('GUNICORN_MAX_REQUESTS_JITTER')
+if max_requests_jitter is None:
+    max_requests_jitter = max_requests // 10
+
+timeout = env_int('GUNICORN_TIMEOUT') or 30
+graceful_timeout = timeout
+keepalive = 5
+
+# the worker heartbeat is a file touched every second; on a disk it can
+# stall behind other I/O and get a healthy worker killed
+if os.path.isdir('/dev/shm'):
+    worker_tmp_dir = '/dev/shm'
+
+# one pooled connection per thread, so a request never waits for another
+# thread's connection
+raw_env = []
+if threads > 1 and 'DB_POOL_SIZE' not in os.environ:
+    raw_env.append('DB_POOL_SIZE={}'.format(threads))
+
+if worker_class == 'gevent':
+    # before the app is preloaded, so its locks and sockets are patched
+    try:
+        from gevent import monkey
+    except ImportError:
+        raise RuntimeError('WEB_IO_PROFILE=io requires the gevent package')
+    monkey.patch_all()
+
+    if os.environ.get('DATABASE_URL', '').startswith('postgres'):
+        try:
+            from psycogreen.gevent import patch_psycopg
+        except ImportError:
+            raise RuntimeError('WEB_IO_PROFILE=io on Postgres requires the '
+                               'psycogreen package')
+        patch_psycopg()
+
+
+def post_fork(server, worker):
+    if server.cfg.preload_app:
+        from database.models import reset_after_fork
+        reset_after_fork(server.app.wsgi())
+
+
+def post_worker_init(worker):
+    from database.models import warm_cast_graph
+    warm_cast_graph(worker.wsgi)
@@ -0,0 +1,316 @@
+import hmac
+import threading
+import time
+from bisect import bisect_left
+
+from flask import Response, abort, g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+
+'''
+Request metrics, exposed on GET /metrics in the Prometheus text format
+
+    Metrics are kept per process: each gunicorn worker reports its own
+    counts, told apart by the scraper's instance labels.
+
+    Label sets are created once, the known ones when the app is created
+    and any other on first use, so recording a value allocates no metric
+    object: observe() is a bisect and two additions under a lock.
+'''
+
+# seconds
+LATENCY_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5,
+                   5, 10)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 25, 50, 100)
+
+
+'''
+Histogram
+    The bucket counts and sum of one label set of a histogram; the last
+    count is the +Inf bucket.
+'''
+
+
+class Histogram:
+    __slots__ = ('buckets', 'counts', 'sum', '_lock')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    def samples(self, name, labels):
+        with self._lock:
+            counts, total = list(self.counts), self.sum
+
+        cumulative = 0
+        for bound, count in zip(self.buckets + ('+Inf',), counts):
+            cumulative += count
+            yield name + '_bucket', labels + (('le', format_value(bound)),), \
+                cumulative
+        yield name + '_sum', labels, total
+        yield name + '_count', labels, cumulative
+
+
+class Counter:
+    __slots__ = ('value', '_lock')
+
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def samples(self, name, labels):
+        yield name + '_total', labels, self.value
+
+
+'''
+Family
+    A named metric and its label sets
+        kind: 'histogram' or 'counter'
+        labelnames: the label names, the values are passed to labels()
+'''
+
+
+class Family:
+    def __init__(self, name, documentation, kind, labelnames=(),
+                 buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.kind = kind
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._children = {}
+        self._lock = threading.Lock()
+
+    def labels(self, *values):
+        child = self._children.get(values)
+        if child is None:
+            with self._lock:
+                child = self._children.get(values)
+                if child is None:
+                    child = Histogram(self.buckets) \
+                        if self.kind == 'histogram' else Counter()
+                    self._children[values] = child
+        return child
+
+    def samples(self):
+        for values, child in sorted(self._children.items()):
+            yield from child.samples(
+                self.name, tuple(zip(self.labelnames, values)))
+
+
+'''
+Registry
+    The families and collectors rendered by /metrics. A collector is a
+    function returning (name, kind, documentation, value) tuples of the
+    counters and gauges other modules already keep, i.e. the token cache
+    and the connection pool stats.
+
+    Every counter is named without its _total suffix, which the
+    exposition format adds to the sample name only.
+'''
+
+
+class Registry:
+    def __init__(self):
+        self.families = []
+        self.collectors = []
+
+    def histogram(self, name, documentation, labelnames=(),
+                  buckets=LATENCY_BUCKETS):
+        family = Family(name, documentation, 'histogram', labelnames,
+                        buckets)
+        self.families.append(family)
+        return family
+
+    def counter(self, name, documentation, labelnames=()):
+        family = Family(name, documentation, 'counter', labelnames)
+        self.families.append(family)
+        return family
+
+    def collector(self, collect):
+        self.collectors.append(collect)
+        return collect
+
+    def render(self):
+        lines = []
+        for family in self.families:
+            lines.append('# HELP {} {}'.format(family.name,
+                                               family.documentation))
+            lines.append('# TYPE {} {}'.format(family.name, family.kind))
+            lines.extend(sample(*values) for values in family.samples())
+
+        for collect in self.collectors:
+            for name, kind, documentation, value in collect():
+                lines.append('# HELP {} {}'.format(name, documentation))
+                lines.append('# TYPE {} {}'.format(name, kind))
+                lines.append(sample(
+                    name + '_total' if kind == 'counter' else name, (),
+                    value))
+
+        return '\n'.join(lines) + '\n'
+
+
+def format_value(value):
+    return value if isinstance(value, str) else repr(value)
+
+
+def escape(value):
+    return str(value).replace('\\', r'\\').replace('\n', r'\n') \
+        .replace('"', r'\"')
+
+
+def sample(name, labels, value):
+    if labels:
+        name += '{' + ','.join('{}="{}"'.format(label, escape(label_value))
+                               for label, label_value in labels) + '}'
+    return '{} {}'.format(name, format_value(value))
+
+
+registry = Registry()
+
+request_seconds = registry.histogram(
+    'castu_request_duration_seconds', 'Time to handle a request.',
+    ('endpoint', 'method', 'status'))
+request_db_seconds = registry.histogram(
+    'castu_request_db_seconds', 'Time spent in database queries per '
+    'request.', ('endpoint',))
+request_db_queries = registry.histogram(
+    'castu_request_db_queries', 'Database queries per request.',
+    ('endpoint',), QUERY_COUNT_BUCKETS)
+request_serialization_seconds = registry.histogram(
+    'castu_request_serialization_seconds', 'Time spent encoding response '
+    'bodies per request.', ('endpoint',))
+db_query_seconds = registry.histogram(
+    'castu_db_query_duration_seconds', 'Time to run a database query.')
+auth_verify_seconds = registry.histogram(
+    'castu_auth_verify_seconds', 'Time to verify a token missing from the '
+    'token cache.', ('result',))
+errors = registry.counter(
+    'castu_unhandled_errors', 'Errors answered with a 500.', ('endpoint',))
+
+query_seconds = db_query_seconds.labels()
+
+
+'''
+RequestTimings
+    The database and serialization time of the current request, summed by
+    the query event listeners and the serializers into flask.g
+'''
+
+
+class RequestTimings:
+    __slots__ = ('start', 'db_seconds', 'db_queries', 'serialization_seconds')
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.db_seconds = 0.0
+        self.db_queries = 0
+        self.serialization_seconds = 0.0
+
+
+def request_timings():
+    """the RequestTimings of the current request, or None outside one"""
+    if not has_request_context():
+        return None
+    return g.get('request_timings')
+
+
+def record_serialization(seconds):
+    timings = request_timings()
+    if timings is not None:
+        timings.serialization_seconds += seconds
+
+
+# the start time is kept on the execution context, which a failed
+# statement discards with it, rather than on the pooled connection
+def before_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    if context is not None:
+        context._castu_metrics_start = time.perf_counter()
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context,
+                         executemany):
+    start = getattr(context, '_castu_metrics_start', None)
+    if start is None:
+        return
+
+    elapsed = time.perf_counter() - start
+    query_seconds.observe(elapsed)
+
+    timings = request_timings()
+    if timings is not None:
+        timings.db_seconds += elapsed
+        timings.db_queries += 1
+
+
+# every engine, the replicas' included
+if not event.contains(Engine, 'after_cursor_execute', after_cursor_execute):
+    event.listen(Engine, 'before_cursor_execute', before_cursor_execute)
+    event.listen(Engine, 'after_cursor_execute', after_cursor_execute)
+
+
+'''
+    install_metrics(app) method
+    @INPUTS
+        app: the Flask app, with all its routes
+
+    times every request of app, and adds GET /metrics; when METRICS_TOKEN
+    is set, /metrics requires it as a bearer token
+'''
+
+
+def install_metrics(app):
+    # the label sets of successful requests exist before the first one
+    for rule in app.url_map.iter_rules():
+        request_db_seconds.labels(rule.endpoint)
+        request_db_queries.labels(rule.endpoint)
+        request_serialization_seconds.labels(rule.endpoint)
+        for method in rule.methods - {'HEAD', 'OPTIONS'}:
+            request_seconds.labels(rule.endpoint, method, '200')
+
+    @app.before_request
+    def start_request_timer():
+        g.request_timings = RequestTimings()
+
+    @app.after_request
+    def record_request(response):
+        timings = g.get('request_timings')
+        if timings is None:
+            return response
+
+        endpoint = request.endpoint or 'none'
+        request_seconds.labels(
+            endpoint, request.method, str(response.status_code)
+        ).observe(time.perf_counter() - timings.start)
+        request_db_seconds.labels(endpoint).observe(timings.db_seconds)
+        request_db_queries.labels(endpoint).observe(timings.db_queries)
+        request_serialization_seconds.labels(endpoint).observe(
+            timings.serialization_seconds)
+        if response.status_code == 500:
+            errors.labels(endpoint).inc()
+        return response
+
+    @app.route('/metrics')
+    def get_metrics():
+        token = app.config.get('METRICS_TOKEN')
+        if token and not hmac.compare_digest(
+                request.headers.get('Authorization', ''),
+                'Bearer ' + token):
+            abort(401)
+
+        return Response(registry.render(),
+                        mimetype='text/plain; version=0.0.4')
@@ -0,0 +1,30 @@
+"""index cast movie id
+
+Revision ID: 194186f16eb2
+Revises: e63963440d3e
+Create Date: 2026-10-18 13:05:12.518302
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '194186f16eb2'
+down_revision = 'e63963440d3e'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    postgresql = op.get_bind().dialect.name == 'postgresql'
+
+    # co-star and path queries join cast on movie_id, which the
+    # (actor_id, movie_id) primary key can not serve
+    with op.get_context().autocommit_block():
+        op.create_index('ix_cast_movie_id', 'cast', ['movie_id', 'actor_id'],
+                        postgresql_concurrently=postgresql)
+
+
+def downgrade():
+    op.drop_index('ix_cast_movie_id', table_name='cast')
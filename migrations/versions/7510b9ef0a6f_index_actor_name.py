@@ -0,0 +1,34 @@
+"""index actor name
+
+Revision ID: 7510b9ef0a6f
+Revises: d0e193fb9d56
+Create Date: 2026-10-18 10:03:27.918442
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '7510b9ef0a6f'
+down_revision = 'd0e193fb9d56'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    postgresql = op.get_bind().dialect.name == 'postgresql'
+
+    # CONCURRENTLY avoids locking writes on a large actors table, and
+    # can not run inside a transaction
+    with op.get_context().autocommit_block():
+        op.create_index('ix_actors_name', 'actors', ['name'],
+                        postgresql_concurrently=postgresql)
+        op.create_index('ix_actors_name_lower', 'actors',
+                        [sa.text('lower(name)')],
+                        postgresql_concurrently=postgresql)
+
+
+def downgrade():
+    op.drop_index('ix_actors_name_lower', table_name='actors')
+    op.drop_index('ix_actors_name', table_name='actors')
@@ -0,0 +1,43 @@
+"""index list filters
+
+Revision ID: 948c6043fefd
+Revises: d7951aa58b0c
+Create Date: 2026-10-18 11:41:52.604117
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '948c6043fefd'
+down_revision = 'd7951aa58b0c'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    postgresql = op.get_bind().dialect.name == 'postgresql'
+
+    # CONCURRENTLY avoids locking writes on large tables, and can not run
+    # inside a transaction
+    with op.get_context().autocommit_block():
+        op.create_index('ix_actors_age', 'actors', ['age', 'id'],
+                        postgresql_concurrently=postgresql)
+        op.create_index('ix_actors_gender', 'actors', ['gender', 'id'],
+                        postgresql_concurrently=postgresql)
+        op.create_index('ix_movies_release_date', 'movies',
+                        ['release_date', 'id'],
+                        postgresql_concurrently=postgresql)
+        # text_pattern_ops lets LIKE 'prefix%' use the index whatever the
+        # database collation
+        op.create_index('ix_movies_title', 'movies', ['title'],
+                        postgresql_ops={'title': 'text_pattern_ops'},
+                        postgresql_concurrently=postgresql)
+
+
+def downgrade():
+    op.drop_index('ix_movies_title', table_name='movies')
+    op.drop_index('ix_movies_release_date', table_name='movies')
+    op.drop_index('ix_actors_gender', table_name='actors')
+    op.drop_index('ix_actors_age', table_name='actors')
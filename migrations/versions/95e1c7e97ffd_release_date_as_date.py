@@ -0,0 +1,140 @@
+"""release date as date
+
+Revision ID: 95e1c7e97ffd
+Revises: 948c6043fefd
+Create Date: 2026-10-18 12:02:14.381906
+
+"""
+import re
+from datetime import datetime
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '95e1c7e97ffd'
+down_revision = '948c6043fefd'
+branch_labels = None
+depends_on = None
+
+# rows converted per statement; each batch commits on its own, so no
+# lock on movies is held for the whole backfill
+BATCH_SIZE = 1000
+
+FORMATS = (
+    (re.compile(r'\d{4}-\d{2}-\d{2}'), '%Y-%m-%d'),
+    (re.compile(r'\d{2}-\d{2}-\d{4}'), '%d-%m-%Y')
+)
+
+
+def parse_date(value):
+    """the date in an ISO or DD-MM-YYYY string, None if it is neither"""
+    value = value.strip()
+    for pattern, format in FORMATS:
+        if pattern.fullmatch(value):
+            try:
+                return datetime.strptime(value, format).date()
+            except ValueError:
+                return None
+    return None
+
+
+def format_date(value):
+    return value.isoformat()
+
+
+def backfill(source, target, convert, recheck=False):
+    """
+    copies source into target, converted, in batches of BATCH_SIZE rows
+    only rows whose target is still NULL are copied, so a second call
+    catches up with rows inserted during the first; with recheck, so are
+    the rows whose target no longer matches their source, which catches
+    rows updated since they were copied too
+    """
+    movies = sa.table('movies', sa.column('id', sa.Integer), source, target)
+    update = movies.update() \
+        .where(movies.c.id == sa.bindparam('movie_id')) \
+        .values({target.name: sa.bindparam('value')})
+
+    connection = op.get_bind()
+    last = 0
+    while True:
+        query = sa.select([movies.c.id, source, target]) \
+            .where(movies.c.id > last) \
+            .where(source.isnot(None))
+        if not recheck:
+            query = query.where(target.is_(None))
+        rows = connection.execute(
+            query.order_by(movies.c.id).limit(BATCH_SIZE)).fetchall()
+        if not rows:
+            break
+
+        changed = [
+            {'movie_id': id, 'value': convert(value)}
+            for id, value, current in rows
+            if convert(value) != current
+        ]
+        if changed:
+            connection.execute(update, changed)
+        last = rows[-1][0]
+
+
+def lock_movies():
+    """
+    blocks writes to movies, not reads, until the migration's transaction
+    commits; SQLite serializes writers on its own
+    """
+    if op.get_bind().dialect.name == 'postgresql':
+        op.execute('LOCK TABLE movies IN SHARE ROW EXCLUSIVE MODE')
+
+
+def swap(column):
+    """replaces release_date with column, under a short table lock"""
+    op.drop_index('ix_movies_release_date', table_name='movies')
+    with op.batch_alter_table('movies') as batch:
+        batch.drop_column('release_date')
+        batch.alter_column(column, new_column_name='release_date')
+
+    postgresql = op.get_bind().dialect.name == 'postgresql'
+    with op.get_context().autocommit_block():
+        op.create_index('ix_movies_release_date', 'movies',
+                        ['release_date', 'id'],
+                        postgresql_concurrently=postgresql)
+
+
+def upgrade():
+    op.add_column('movies', sa.Column('release_date_new', sa.Date()))
+
+    def copy(recheck=False):
+        # unparseable strings are left NULL
+        backfill(sa.column('release_date', sa.String),
+                 sa.column('release_date_new', sa.Date),
+                 parse_date, recheck)
+
+    with op.get_context().autocommit_block():
+        for _ in range(2):
+            copy()
+
+    # the rows written since are copied in the transaction of the swap,
+    # with writes blocked, so none is left behind
+    lock_movies()
+    copy(recheck=True)
+    swap('release_date_new')
+
+
+def downgrade():
+    op.add_column('movies', sa.Column('release_date_old', sa.String()))
+
+    def copy(recheck=False):
+        backfill(sa.column('release_date', sa.Date),
+                 sa.column('release_date_old', sa.String),
+                 format_date, recheck)
+
+    with op.get_context().autocommit_block():
+        for _ in range(2):
+            copy()
+
+    lock_movies()
+    copy(recheck=True)
+    swap('release_date_old')
@@ -0,0 +1,48 @@
+"""initial schema
+
+Revision ID: d0e193fb9d56
+Revises: 
+Create Date: 2026-10-18 09:12:41.503120
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd0e193fb9d56'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'movies',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('title', sa.String(), nullable=True),
+        sa.Column('release_date', sa.String(), nullable=True),
+        sa.PrimaryKeyConstraint('id')
+    )
+    op.create_table(
+        'actors',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('name', sa.String(), nullable=True),
+        sa.Column('age', sa.Integer(), nullable=True),
+        sa.Column('gender', sa.String(), nullable=True),
+        sa.PrimaryKeyConstraint('id')
+    )
+    op.create_table(
+        'cast',
+        sa.Column('actor_id', sa.Integer(), nullable=False),
+        sa.Column('movie_id', sa.Integer(), nullable=False),
+        sa.ForeignKeyConstraint(['actor_id'], ['actors.id'], ),
+        sa.ForeignKeyConstraint(['movie_id'], ['movies.id'], ),
+        sa.PrimaryKeyConstraint('actor_id', 'movie_id')
+    )
+
+
+def downgrade():
+    op.drop_table('cast')
+    op.drop_table('actors')
+    op.drop_table('movies')
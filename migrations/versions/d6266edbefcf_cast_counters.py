@@ -0,0 +1,70 @@
+"""cast counters
+
+Revision ID: d6266edbefcf
+Revises: 194186f16eb2
+Create Date: 2026-10-18 13:48:36.104921
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd6266edbefcf'
+down_revision = '194186f16eb2'
+branch_labels = None
+depends_on = None
+
+# rows recounted per statement; each batch commits on its own, so no lock
+# on the table is held for the whole backfill
+BATCH_SIZE = 1000
+
+# (table, counter, cast column)
+COUNTERS = (
+    ('actors', 'movie_count', 'actor_id'),
+    ('movies', 'cast_size', 'movie_id'),
+)
+
+
+def backfill(table, counter, key):
+    """recounts every row of table from cast, BATCH_SIZE ids at a time"""
+    rows = sa.table(table, sa.column('id', sa.Integer),
+                    sa.column(counter, sa.Integer))
+    cast = sa.table('cast', sa.column(key, sa.Integer))
+
+    connection = op.get_bind()
+    last = connection.execute(sa.select([sa.func.max(rows.c.id)])).scalar()
+    for start in range(0, (last or 0) + 1, BATCH_SIZE):
+        connection.execute(
+            rows.update()
+            .where(rows.c.id.between(start, start + BATCH_SIZE - 1))
+            .values({counter: sa.select([sa.func.count()])
+                     .where(cast.c[key] == rows.c.id)
+                     .as_scalar()}))
+
+
+def upgrade():
+    # a constant default does not rewrite the table on Postgres 11+
+    op.add_column('actors', sa.Column('movie_count', sa.Integer(),
+                                      nullable=False, server_default='0'))
+    op.add_column('movies', sa.Column('cast_size', sa.Integer(),
+                                      nullable=False, server_default='0'))
+
+    postgresql = op.get_bind().dialect.name == 'postgresql'
+    with op.get_context().autocommit_block():
+        for table, counter, key in COUNTERS:
+            backfill(table, counter, key)
+
+        # built after the backfill, so its updates do not maintain them
+        for table, counter, key in COUNTERS:
+            op.create_index('ix_{}_{}'.format(table, counter), table,
+                            [counter, 'id'],
+                            postgresql_concurrently=postgresql)
+
+
+def downgrade():
+    for table, counter, key in reversed(COUNTERS):
+        op.drop_index('ix_{}_{}'.format(table, counter), table_name=table)
+        # native on SQLite 3.35+, where a batch copy of actors would lose
+        # the expression index on lower(name)
+        op.execute('ALTER TABLE {} DROP COLUMN {}'.format(table, counter))
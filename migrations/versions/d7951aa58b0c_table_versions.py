@@ -0,0 +1,34 @@
+"""table versions
+
+Revision ID: d7951aa58b0c
+Revises: 7510b9ef0a6f
+Create Date: 2026-10-18 11:26:05.114873
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd7951aa58b0c'
+down_revision = '7510b9ef0a6f'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    table_versions = op.create_table(
+        'table_versions',
+        sa.Column('name', sa.String(), nullable=False),
+        sa.Column('version', sa.Integer(), nullable=False),
+        sa.PrimaryKeyConstraint('name')
+    )
+    op.bulk_insert(table_versions, [
+        {'name': 'movies', 'version': 1},
+        {'name': 'actors', 'version': 1},
+        {'name': 'cast', 'version': 1}
+    ])
+
+
+def downgrade():
+    op.drop_table('table_versions')
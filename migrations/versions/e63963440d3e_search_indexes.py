@@ -0,0 +1,50 @@
+"""search indexes
+
+Revision ID: e63963440d3e
+Revises: 95e1c7e97ffd
+Create Date: 2026-10-18 12:31:47.220583
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e63963440d3e'
+down_revision = '95e1c7e97ffd'
+branch_labels = None
+depends_on = None
+
+# (index, table, expression, method), the expressions must match the
+# queries in database.search exactly for the planner to use them
+INDEXES = (
+    ('ix_actors_name_tsv', 'actors',
+     "to_tsvector('simple', coalesce(name, ''))", 'gin'),
+    ('ix_actors_name_trgm', 'actors', 'lower(name) gin_trgm_ops', 'gin'),
+    ('ix_movies_title_tsv', 'movies',
+     "to_tsvector('simple', coalesce(title, ''))", 'gin'),
+    ('ix_movies_title_trgm', 'movies', 'lower(title) gin_trgm_ops', 'gin'),
+)
+
+
+def upgrade():
+    # other databases search with the in-process index
+    if op.get_bind().dialect.name != 'postgresql':
+        return
+
+    op.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+
+    # CONCURRENTLY avoids locking writes while the indexes build
+    with op.get_context().autocommit_block():
+        for name, table, expression, method in INDEXES:
+            op.create_index(name, table, [sa.text(expression)],
+                            postgresql_using=method,
+                            postgresql_concurrently=True)
+
+
+def downgrade():
+    if op.get_bind().dialect.name != 'postgresql':
+        return
+
+    for name, table, _, _ in reversed(INDEXES):
+        op.drop_index(name, table_name=table)
@@ -0,0 +1,307 @@
+import cProfile
+import io
+import logging
+import os
+import pstats
+import sys
+import threading
+import time
+from collections import Counter
+
+from flask import Response, abort, g, request
+
+from auth.auth import check_permissions, get_principal, \
+    get_token_auth_header, requires_auth
+
+logger = logging.getLogger(__name__)
+
+'''
+Profiling of single requests, and of whole worker processes
+
+    A request with an `X-Profile` header or a `?profile=` argument, set to
+    `pstats` or `collapsed`, runs under a profiler when its token has the
+    `profile:requests` permission:
+        pstats: cProfile, the function statistics sorted by cumulative time
+        collapsed: the request thread's stacks, sampled every
+         PROFILE_REQUEST_INTERVAL seconds, in the collapsed format of
+         flamegraph.pl and speedscope
+    The output replaces the response body, or, when PROFILE_DIR is set, is
+    written there (pstats as a binary stats file) and named in the
+    X-Profile-File response header. One request per process is profiled
+    at a time; the others get an `X-Profile: busy` header.
+
+    With PROFILE_SAMPLE_INTERVAL set, every worker also samples the stacks
+    of all its threads at that interval, and writes the counts to
+    PROFILE_DIR every PROFILE_FLUSH_INTERVAL seconds. GET /profile/samples
+    merges the counts of all workers.
+'''
+
+MODES = ('pstats', 'collapsed')
+
+
+def frame_label(frame):
+    code = frame.f_code
+    return '{}:{}'.format(os.path.basename(code.co_filename), code.co_name)
+
+
+def collapse(frame):
+    """the stack of frame, outermost call first, joined with ';'"""
+    labels = []
+    while frame is not None:
+        labels.append(frame_label(frame))
+        frame = frame.f_back
+    return ';'.join(reversed(labels))
+
+
+def format_collapsed(counts):
+    return ''.join('{} {}\n'.format(stack, count)
+                   for stack, count in sorted(counts.items()))
+
+
+def parse_collapsed(text, counts):
+    """adds the counts of text, in the collapsed format, to counts"""
+    for line in text.splitlines():
+        stack, _, count = line.rpartition(' ')
+        if stack and count.isdigit():
+            counts[stack] += int(count)
+    return counts
+
+
+'''
+StackSampler
+    Counts the collapsed stacks of the threads of this process, sampled
+    every interval seconds from a daemon thread
+        thread_id: sample only this thread, or every other thread if None
+
+    The interpreter switches threads every sys.getswitchinterval() seconds
+    (5 ms by default) at most, which bounds the sampling rate while the
+    sampled threads hold the GIL.
+'''
+
+
+class StackSampler:
+    def __init__(self, interval, thread_id=None):
+        self.interval = interval
+        self.thread_id = thread_id
+        self.counts = Counter()
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True,
+                                        name='stack-sampler')
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+
+    def sample(self):
+        own = threading.get_ident()
+        frames = sys._current_frames()
+        if self.thread_id is not None:
+            frames = {self.thread_id: frames.get(self.thread_id)}
+
+        stacks = [collapse(frame) for thread_id, frame in frames.items()
+                  if thread_id != own and frame is not None]
+        with self._lock:
+            self.counts.update(stacks)
+
+    def snapshot(self):
+        with self._lock:
+            return Counter(self.counts)
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            self.sample()
+
+
+'''
+ProcessSampler
+    The StackSampler of the whole process, started on the first request of
+    each worker (threads do not survive fork()), and writing its counts to
+    PROFILE_DIR/samples-<pid>.collapsed every flush_interval seconds
+'''
+
+
+class ProcessSampler:
+    def __init__(self):
+        self.sampler = None
+        self.pid = None
+        self._lock = threading.Lock()
+
+    def ensure_started(self, interval, directory, flush_interval):
+        pid = os.getpid()
+        if self.pid == pid:
+            return
+
+        with self._lock:
+            if self.pid == pid:
+                return
+            self.sampler = StackSampler(interval).start()
+            self.pid = pid
+            if directory:
+                threading.Thread(
+                    target=self._flush, args=(directory, flush_interval),
+                    daemon=True, name='stack-sampler-flush').start()
+
+    def _flush(self, directory, flush_interval):
+        sampler, pid = self.sampler, self.pid
+        path = os.path.join(directory, 'samples-{}.collapsed'.format(pid))
+        while self.pid == pid:
+            time.sleep(flush_interval)
+            try:
+                with open(path + '.tmp', 'w') as f:
+                    f.write(format_collapsed(sampler.snapshot()))
+                os.replace(path + '.tmp', path)
+            except OSError as e:
+                logger.warning('Unable to write %s: %s', path, e)
+
+    def snapshot(self):
+        sampler = self.sampler
+        return sampler.snapshot() if sampler is not None else Counter()
+
+    def stop(self):
+        with self._lock:
+            sampler, self.sampler, self.pid = self.sampler, None, None
+        if sampler is not None:
+            sampler.stop()
+
+
+process_sampler = ProcessSampler()
+
+# a profiled request runs several times slower, so a process profiles one
+# at a time; Python 3.12+ also allows a single cProfile profiler at once
+profiling = threading.Lock()
+
+
+def merged_samples(directory):
+    """the sample counts of every worker that flushed to directory, or of
+    this process alone without a directory
+    """
+    if not directory:
+        return process_sampler.snapshot()
+
+    counts = Counter()
+    for name in os.listdir(directory):
+        if name.startswith('samples-') and name.endswith('.collapsed'):
+            with open(os.path.join(directory, name)) as f:
+                parse_collapsed(f.read(), counts)
+    return counts
+
+
+'''
+    install_profiling(app) method
+    @INPUTS
+        app: the Flask app, with all its routes
+
+    adds the X-Profile header and ?profile= argument to every route of
+    app, the process sampler and GET /profile/samples
+'''
+
+
+def install_profiling(app):
+    def profile_mode():
+        return request.headers.get('X-Profile') or \
+            request.args.get('profile')
+
+    @app.before_request
+    def start_profiler():
+        interval = app.config['PROFILE_SAMPLE_INTERVAL']
+        if interval:
+            process_sampler.ensure_started(
+                interval, app.config['PROFILE_DIR'],
+                app.config['PROFILE_FLUSH_INTERVAL'])
+
+        mode = profile_mode()
+        if not mode:
+            return
+        if mode not in MODES:
+            abort(422)
+
+        token = get_token_auth_header()
+        try:
+            check_permissions('profile:requests', get_principal(token))
+        except Exception:
+            abort(401)
+
+        if not profiling.acquire(blocking=False):
+            g.profile_busy = True
+            return
+
+        if mode == 'pstats':
+            g.profiler = cProfile.Profile()
+            g.profiler.enable()
+        else:
+            interval = app.config['PROFILE_REQUEST_INTERVAL']
+            # lets the sampler take the GIL as often as it samples
+            g.switch_interval = sys.getswitchinterval()
+            sys.setswitchinterval(min(interval, g.switch_interval))
+            g.profiler = StackSampler(interval,
+                                      threading.get_ident()).start()
+
+    def stop_profiler():
+        profiler = g.pop('profiler', None)
+        if profiler is None:
+            return None
+
+        try:
+            if isinstance(profiler, cProfile.Profile):
+                profiler.disable()
+            else:
+                profiler.stop()
+                sys.setswitchinterval(g.pop('switch_interval'))
+        finally:
+            profiling.release()
+        return profiler
+
+    @app.after_request
+    def profile_response(response):
+        if g.pop('profile_busy', False):
+            # another request of this process is being profiled
+            response.headers['X-Profile'] = 'busy'
+            return response
+
+        profiler = stop_profiler()
+        if profiler is None:
+            return response
+
+        cprofile = isinstance(profiler, cProfile.Profile)
+        directory = app.config['PROFILE_DIR']
+        if directory:
+            name = 'request-{}-{}-{}.{}'.format(
+                time.strftime('%Y%m%dT%H%M%S'), os.getpid(),
+                request.endpoint or 'none',
+                'pstats' if cprofile else 'collapsed')
+            path = os.path.join(directory, name)
+            if cprofile:
+                # for pstats.Stats(path), snakeviz and the like
+                profiler.dump_stats(path)
+            else:
+                with open(path, 'w') as f:
+                    f.write(format_collapsed(profiler.snapshot()))
+            response.headers['X-Profile-File'] = name
+            return response
+
+        if cprofile:
+            stream = io.StringIO()
+            pstats.Stats(profiler, stream=stream) \
+                .sort_stats('cumulative') \
+                .print_stats(app.config['PROFILE_TOP'])
+            output = stream.getvalue()
+        else:
+            output = format_collapsed(profiler.snapshot())
+        return Response(output, mimetype='text/plain')
+
+    @app.teardown_request
+    def release_profiler(error=None):
+        # after an error that skipped profile_response
+        stop_profiler()
+
+    @app.route('/profile/samples')
+    @requires_auth('profile:requests')
+    def get_profile_samples(payload):
+        return Response(
+            format_collapsed(merged_samples(app.config['PROFILE_DIR'])),
+            mimetype='text/plain')
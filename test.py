@@ -1,10 +1,38 @@
+import asyncio
 import os
+import subprocess
+import sys
 import unittest
 import json
-from flask_sqlalchemy import SQLAlchemy
-
+from unittest import mock
+import tempfile
+import threading
+import time
+from flask import Flask, g, jsonify
+from sqlalchemy import event
+from jose import jwk, jwt
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+
+import metrics
+import profiling
 from app import create_app
-from database.models import setup_db, Actor, Movie
+from auth import auth
+from auth.jwks import JWKSKeyStore
+from auth.token_cache import TokenCache
+from database.cache import EntityCache, LRUCache, RedisCache, entity_cache
+from database.engine import engine_options, TimedNullPool, TimedQueuePool
+from database.filters import actor_filters, movie_filters
+from database.graph import cast_graph
+from database.models import db, Actor, Movie, parse_release_date, \
+    bump_versions, get_versions, reset_after_fork, warm_cast_graph
+from database.pagination import encode_cursor, keyset_order
+from database.routing import configure_replicas
+from database.serializers import actor_serializer, movie_serializer, \
+    dumps, json_response
+
+# a request running more statements than DB_QUERY_BUDGET fails the test
+os.environ.setdefault('DB_QUERY_BUDGET_MODE', 'raise')
 
 
 class CastUTestCase(unittest.TestCase):
@@ -17,7 +45,6 @@ class CastUTestCase(unittest.TestCase):
         self.admin_token = os.environ['admin_token']
         self.app = create_app()
         self.client = self.app.test_client
-        setup_db(self.app)
 
         self.VALID_NEW_ACTOR = {
             "name": "Emma Stone",
@@ -37,7 +64,7 @@ class CastUTestCase(unittest.TestCase):
 
         self.VALID_NEW_MOVIE = {
             "title": "Cruella",
-            "release_data": "22-05-2021",
+            "release_date": "22-05-2021",
             "cast": ["Emma Stone"]
         }
 
@@ -52,12 +79,9 @@ class CastUTestCase(unittest.TestCase):
 
         self.INVALID_UPDATE_MOVIE = {}
 
-        # binds the app to the current context
+        # the app no longer creates tables at startup
         with self.app.app_context():
-            self.db = SQLAlchemy()
-            self.db.init_app(self.app)
-            # create all tables
-            self.db.create_all()
+            db.create_all()
 
     def tearDown(self):
         """Executed after reach test"""
@@ -96,7 +120,7 @@ class CastUTestCase(unittest.TestCase):
 
     def test_get_actors_by_id(self):
         """Passing Test for GET /actors/<actor_id>"""
-        res = self.client().get('/actors/1', headers={
+        res = self.client().get('/actors/1?include=movies', headers={
             'Authorization': "Bearer {}".format(self.user_token)
         })
         data = json.loads(res.data)
@@ -223,7 +247,7 @@ class CastUTestCase(unittest.TestCase):
 
     def test_get_movie_by_id(self):
         """Passing Test for GET /movies/<movie_id>"""
-        res = self.client().get('/movies/1', headers={
+        res = self.client().get('/movies/1?include=cast', headers={
             'Authorization': "Bearer {}".format(self.user_token)
         })
         data = json.loads(res.data)
@@ -280,6 +304,21 @@ class CastUTestCase(unittest.TestCase):
         self.assertFalse(data['success'])
         self.assertIn('message', data)
 
+    def test_422_create_movie_with_unknown_cast(self):
+        """Failing Test for POST /movies with unresolved cast entries"""
+        res = self.client().post('/movies', headers={
+            'Authorization': "Bearer {}".format(self.admin_token)
+        }, json={
+            "title": "Cruella",
+            "release_date": "22-05-2021",
+            "cast": ["Emma Stone", "Nobody In Particular", 100000]
+        })
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 422)
+        self.assertFalse(data['success'])
+        self.assertEqual(data['missing'], ["Nobody In Particular", 100000])
+
     def test_update_movie_info(self):
         """Passing Test for PATCH /movies/<movie_id>"""
         res = self.client().patch('/movies/1', headers={
@@ -338,6 +377,1633 @@ class CastUTestCase(unittest.TestCase):
         self.assertIn('message', data)
 
 
+class JWKSKeyStoreTestCase(unittest.TestCase):
+    """This class tests the JWKS key cache against a local JWKS file"""
+
+    def setUp(self):
+        private_key = rsa.generate_private_key(
+            public_exponent=65537, key_size=2048)
+        self.private_pem = private_key.private_bytes(
+            serialization.Encoding.PEM,
+            serialization.PrivateFormat.PKCS8,
+            serialization.NoEncryption())
+
+        public_jwk = {
+            name: value.decode() if isinstance(value, bytes) else value
+            for name, value in jwk.construct(
+                self.private_pem, 'RS256').public_key().to_dict().items()
+        }
+        public_jwk.update({'kid': 'test-key', 'use': 'sig'})
+
+        self.jwks_file = tempfile.NamedTemporaryFile(
+            'w', suffix='.json', delete=False)
+        json.dump({'keys': [public_jwk]}, self.jwks_file)
+        self.jwks_file.close()
+
+        self.store = JWKSKeyStore(
+            self.jwks_file.name, ttl=600, min_refresh_interval=30)
+
+        # the tokens are issued for these settings, whatever the
+        # environment holds
+        self.environ = mock.patch.dict(os.environ, {
+            'AUTH0_DOMAIN': 'castu.test',
+            'ALGORITHMS': 'RS256',
+            'API_AUDIENCE': 'agency',
+            'JWKS_URL': self.jwks_file.name
+        })
+        self.environ.start()
+        auth.auth_settings.cache_clear()
+
+    def tearDown(self):
+        self.environ.stop()
+        auth.auth_settings.cache_clear()
+        self.store.close()
+        if os.path.exists(self.jwks_file.name):
+            os.remove(self.jwks_file.name)
+
+    def make_token(self, kid='test-key'):
+        claims = {
+            'iss': 'https://' + auth.auth_settings().domain + '/',
+            'aud': auth.auth_settings().audience,
+            'sub': 'test|user',
+            'exp': int(time.time()) + 600,
+            'permissions': ['get:actors']
+        }
+        return jwt.encode(claims, self.private_pem, algorithm='RS256',
+                          headers={'kid': kid})
+
+    def test_get_known_key(self):
+        """Passing Test for a kid published in the JWKS file"""
+        self.assertIsNotNone(self.store.get_key('test-key'))
+
+    def test_unknown_kid_fetch_is_rate_limited(self):
+        """Unknown kids trigger at most one fetch per interval"""
+        self.assertIsNotNone(self.store.get_key('test-key'))
+        self.assertIsNone(self.store.get_key('unknown-key'))
+        self.assertFalse(self.store.refresh(force=False))
+
+    def test_serves_stale_keys_when_source_is_down(self):
+        """Passing Test for keeping the last key set on fetch failure"""
+        self.assertTrue(self.store.refresh())
+        os.remove(self.jwks_file.name)
+
+        self.assertFalse(self.store.refresh())
+        self.assertIsNotNone(self.store.get_key('test-key'))
+
+    def test_verify_decode_jwt_with_cached_key(self):
+        """Passing Test for verify_decode_jwt using the key store"""
+        original_store = auth.jwks_store
+        auth.jwks_store = self.store
+        try:
+            payload = auth.verify_decode_jwt(self.make_token())
+        finally:
+            auth.jwks_store = original_store
+
+        self.assertEqual(payload['sub'], 'test|user')
+
+    def test_async_lookups_counted_once(self):
+        """Passing Test for one token cache miss per ASGI verification"""
+        token = self.make_token()
+        before = auth.token_cache.stats()
+        original_store = auth.jwks_store
+        auth.jwks_store = self.store
+        try:
+            for attempt in range(2):
+                principal = asyncio.run(auth.get_principal_async(token))
+        finally:
+            auth.jwks_store = original_store
+            auth.token_cache.clear()
+
+        stats = auth.token_cache.stats()
+        self.assertEqual(principal.subject, 'test|user')
+        self.assertEqual(stats['misses'] - before['misses'], 1)
+        self.assertEqual(stats['hits'] - before['hits'], 1)
+
+
+class TokenCacheTestCase(unittest.TestCase):
+    """This class tests the verified-token LRU used by requires_auth"""
+
+    def setUp(self):
+        self.cache = TokenCache(maxsize=2)
+        self.payload = {'sub': 'test|user', 'exp': time.time() + 600}
+
+    def test_hit_after_put(self):
+        """Passing Test for a cached token"""
+        self.assertIsNone(self.cache.get('token'))
+        self.cache.put('token', self.payload, self.payload['exp'])
+
+        self.assertEqual(self.cache.get('token'), self.payload)
+        self.assertEqual(self.cache.stats()['hits'], 1)
+        self.assertEqual(self.cache.stats()['misses'], 1)
+
+    def test_entry_expires_at_exp(self):
+        """Failing Test for a token past its exp claim"""
+        self.cache.put('token', self.payload, time.time() - 1)
+        self.assertIsNone(self.cache.get('token'))
+
+    def test_least_recently_used_is_evicted(self):
+        """Passing Test for the size bound"""
+        self.cache.put('a', self.payload, self.payload['exp'])
+        self.cache.put('b', self.payload, self.payload['exp'])
+        self.cache.get('a')
+        self.cache.put('c', self.payload, self.payload['exp'])
+
+        self.assertIsNotNone(self.cache.get('a'))
+        self.assertIsNone(self.cache.get('b'))
+        self.assertIsNotNone(self.cache.get('c'))
+
+
+class PermissionsTestCase(unittest.TestCase):
+    """This class tests Principal permission sets and requires_auth"""
+
+    def setUp(self):
+        self.principal = auth.Principal({
+            'sub': 'test|user',
+            'exp': time.time() + 600,
+            'permissions': ['get:actors', 'get:movies']
+        })
+
+        self.app = Flask(__name__)
+        self.app.register_error_handler(
+            401, lambda error: (jsonify({'success': False}), 401))
+
+        @self.app.route('/any')
+        @auth.requires_auth('get:movies', 'post:movies', require='any')
+        def any_route(payload):
+            return jsonify({'success': True})
+
+        @self.app.route('/all')
+        @auth.requires_auth('get:movies', 'post:movies')
+        def all_route(payload):
+            return jsonify({'success': True})
+
+        auth.token_cache.put('test-token', self.principal,
+                             self.principal.expires_at)
+        self.headers = {'Authorization': 'Bearer test-token'}
+
+    def tearDown(self):
+        auth.token_cache.clear()
+
+    def test_check_permissions(self):
+        """Passing Test for a single permission"""
+        self.assertTrue(auth.check_permissions('get:actors', self.principal))
+
+    def test_check_permissions_all(self):
+        """Failing Test when one of several permissions is missing"""
+        with self.assertRaises(auth.AuthError):
+            auth.check_permissions({'get:actors', 'post:actors'},
+                                   self.principal)
+
+    def test_check_permissions_without_claim(self):
+        """Failing Test for a payload without a permissions claim"""
+        with self.assertRaises(auth.AuthError) as context:
+            auth.check_permissions('get:actors', {'sub': 'test|user'})
+
+        self.assertEqual(context.exception.status_code, 400)
+
+    def test_requires_auth_any(self):
+        """Passing Test for require='any'"""
+        res = self.app.test_client().get('/any', headers=self.headers)
+
+        self.assertEqual(res.status_code, 200)
+
+    def test_requires_auth_all(self):
+        """Failing Test for require='all' with a missing permission"""
+        res = self.app.test_client().get('/all', headers=self.headers)
+
+        self.assertEqual(res.status_code, 401)
+
+
+class FakeRedis:
+    """Local stand-in for the get/set/delete subset of a Redis client"""
+
+    def __init__(self):
+        self.values = {}
+
+    def get(self, key):
+        return self.values.get(key)
+
+    def set(self, key, value, ex=None):
+        self.values[key] = value
+
+    def delete(self, *keys):
+        for key in keys:
+            self.values.pop(key, None)
+
+
+class AppTestCase(unittest.TestCase):
+    """Base class of the tests running the app on a temporary SQLite
+    database, with the principals of their tokens in the token cache"""
+
+    # app config of every test of the class
+    config = {}
+    # token -> permissions of its principal
+    tokens = {'test-token': ['get:actors']}
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        for token, permissions in self.tokens.items():
+            principal = auth.Principal({
+                'sub': 'test|' + token,
+                'exp': time.time() + 600,
+                'permissions': permissions
+            })
+            auth.token_cache.put(token, principal, principal.expires_at)
+        self.headers = {'Authorization': 'Bearer test-token'}
+
+    def tearDown(self):
+        auth.token_cache.clear()
+        self.directory.cleanup()
+
+    def app_config(self, **config):
+        """the test database, without entity cache, then config"""
+        app_config = {
+            'SQLALCHEMY_DATABASE_URI':
+                'sqlite:///' + os.path.join(self.directory.name, 'test.db'),
+            'ENTITY_CACHE': 'none'
+        }
+        app_config.update(self.config)
+        app_config.update(config)
+        return app_config
+
+    def create_app(self, **config):
+        """the app on the test database, with its tables created"""
+        app = create_app(self.app_config(**config))
+        with app.app_context():
+            db.create_all()
+        return app
+
+
+def write_in_other_worker(app, actor_id, name):
+    """Renames an actor through a second entity cache, as another worker
+    process would, leaving the entry of this process in place"""
+    backend = entity_cache.backend
+    entity_cache.backend = LRUCache()
+    try:
+        with app.app_context():
+            actor = Actor.query.get(actor_id)
+            actor.name = name
+            actor.update()
+    finally:
+        entity_cache.backend = backend
+
+
+class ApiTestCase(AppTestCase):
+    """This class tests the actor and movie endpoints on a local database"""
+
+    tokens = {
+        'user-token': ['get:actors', 'get:actors-details', 'get:movies',
+                       'get:movies-details'],
+        'manager-token': ['get:actors', 'get:movies', 'post:actors',
+                          'patch:actors', 'patch:movies'],
+        'admin-token': ['get:actors', 'get:movies', 'post:actors',
+                        'patch:actors', 'post:movies', 'patch:movies']
+    }
+
+    def setUp(self):
+        super().setUp()
+        self.app = self.create_app()
+        self.client = self.app.test_client
+        with self.app.app_context():
+            Actor.insert_many([
+                {'name': name, 'age': age, 'gender': 'F'}
+                for name, age in (('Ann', 30), ('Ben', 40), ('Cal', 50))
+            ])
+            Movie.insert_many([
+                {'title': title, 'release_date': parse_release_date(
+                    '2021-05-28'), 'cast': cast}
+                for title, cast in (('First', [1, 2]), ('Second', [2]),
+                                    ('Third', [3]))
+            ])
+
+    def get(self, url, token='user-token', **headers):
+        headers['Authorization'] = 'Bearer ' + token
+        return self.client().get(url, headers=headers)
+
+    def send(self, method, url, body, token='manager-token'):
+        res = self.client().open(url, method=method, json=body, headers={
+            'Authorization': 'Bearer ' + token
+        })
+        return res, json.loads(res.data)
+
+    def count_queries(self, url, token='user-token'):
+        """Returns the response for url and the number of SQL statements"""
+        statements = []
+
+        def count(*args):
+            statements.append(args)
+
+        with self.app.app_context():
+            engine = db.engine
+        event.listen(engine, 'before_cursor_execute', count)
+        try:
+            res = self.get(url, token)
+        finally:
+            event.remove(engine, 'before_cursor_execute', count)
+
+        return res, len(statements)
+
+    def test_get_actors_paginated(self):
+        """Passing Test for GET /actors?limit=&after= through every page"""
+        ids, url = [], '/actors?limit=2'
+        while url:
+            res = self.get(url)
+            data = json.loads(res.data)
+            self.assertEqual(res.status_code, 200)
+
+            ids.extend(actor['id'] for actor in data['actors'])
+            url = data['next_cursor'] and \
+                '/actors?limit=2&after=' + data['next_cursor']
+
+        self.assertEqual(ids, [1, 2, 3])
+
+    def test_422_get_actors_invalid_cursor(self):
+        """Failing Test for GET /actors and /movies with a malformed or
+        crafted cursor"""
+        for after in ('not-a-cursor', encode_cursor([]),
+                      encode_cursor([{'a': 1}]), encode_cursor(['x']),
+                      encode_cursor([True]), encode_cursor([1, 2])):
+            for url in ('/actors', '/movies', '/actors?stream=1'):
+                res = self.get(url + ('&' if '?' in url else '?') +
+                               'after=' + after)
+
+                self.assertEqual(res.status_code, 422, (url, after))
+                self.assertFalse(json.loads(res.data)['success'])
+
+    def test_stream_actors(self):
+        """Passing Test for GET /actors?stream=1"""
+        res = self.get('/actors?stream=1')
+        lines = res.data.decode().splitlines()
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.mimetype, 'application/x-ndjson')
+        self.assertEqual([json.loads(line)['name'] for line in lines],
+                         ['Ann', 'Ben', 'Cal'])
+
+        res = self.get('/actors?stream=1&after=' + encode_cursor([1]))
+        self.assertEqual([json.loads(line)['name']
+                          for line in res.data.decode().splitlines()],
+                         ['Ben', 'Cal'])
+
+    def test_stream_movies_with_accept_header(self):
+        """Passing Test for GET /movies with Accept: application/x-ndjson"""
+        res = self.get('/movies', Accept='application/x-ndjson')
+        lines = res.data.decode().splitlines()
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.mimetype, 'application/x-ndjson')
+        self.assertEqual([json.loads(line)['title'] for line in lines],
+                         ['First', 'Second', 'Third'])
+
+    def test_get_actors_not_modified(self):
+        """Passing Test for GET /actors with a matching If-None-Match"""
+        res = self.get('/actors')
+        etag = res.headers['ETag']
+
+        self.assertEqual(res.status_code, 200)
+        self.assertIn('Cache-Control', res.headers)
+
+        res = self.get('/actors', **{'If-None-Match': etag})
+
+        self.assertEqual(res.status_code, 304)
+        self.assertEqual(res.data, b'')
+
+    def test_etag_changes_after_write(self):
+        """Passing Test for GET /actors after a write to actors"""
+        etag = self.get('/actors').headers['ETag']
+        self.send('PATCH', '/actors/1', {'name': 'Anne Hathaway'})
+
+        res = self.get('/actors', **{'If-None-Match': etag})
+
+        self.assertEqual(res.status_code, 200)
+        self.assertNotEqual(res.headers['ETag'], etag)
+        self.assertEqual(json.loads(res.data)['actors'][0]['name'],
+                         'Anne Hathaway')
+
+    def test_get_movies_include_cast(self):
+        """Passing Test for GET /movies?include=cast"""
+        res = self.get('/movies?include=cast')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['movies'][0]['cast'], ['Ann', 'Ben'])
+
+    def test_include_cast_query_count_is_constant(self):
+        """Passing Test for eager loading cast without N+1 queries"""
+        res, one_row = self.count_queries('/movies?include=cast&limit=1')
+        self.assertEqual(res.status_code, 200)
+
+        res, many_rows = self.count_queries('/movies?include=cast&limit=50')
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(json.loads(res.data)['movies']), 3)
+
+        # the table versions for the ETag, one query for the page and one
+        # for the cast of every movie in it
+        self.assertEqual(one_row, many_rows)
+        self.assertLessEqual(many_rows, 3)
+
+    def test_422_get_movies_unknown_include(self):
+        """Failing Test for GET /movies?include= with an unknown relation"""
+        res = self.get('/movies?include=crew')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 422)
+        self.assertFalse(data['success'])
+
+    def test_get_actors_fields(self):
+        """Passing Test for GET /actors?fields=name"""
+        res = self.get('/actors?fields=name')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['actors'][0], {'id': 1, 'name': 'Ann'})
+
+    def test_get_movie_fields(self):
+        """Passing Test for GET /movies/<movie_id>?fields=title"""
+        res = self.get('/movies/1?fields=title')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['movie'], {'id': 1, 'title': 'First'})
+
+    def test_422_get_movies_unknown_field(self):
+        """Failing Test for GET /movies?fields= with an unknown column"""
+        res = self.get('/movies?fields=budget')
+
+        self.assertEqual(res.status_code, 422)
+
+    def test_create_actors_bulk(self):
+        """Passing Test for POST /actors/bulk with per-item results"""
+        res, data = self.send('POST', '/actors/bulk', {'actors': [
+            {'name': 'Emma Stone', 'age': 32, 'gender': 'F'},
+            {'name': 'Emma Stone'}
+        ]})
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['succeeded'], 1)
+        self.assertEqual(data['failed'], 1)
+        self.assertEqual(data['results'][0]['actor_id'], 4)
+        self.assertEqual(data['results'][1]['error'], 422)
+
+    def test_create_actors_bulk_with_user_token(self):
+        """Failing Test for POST /actors/bulk"""
+        res, data = self.send('POST', '/actors/bulk', {'actors': [
+            {'name': 'Emma Stone', 'age': 32, 'gender': 'F'}
+        ]}, 'user-token')
+
+        self.assertEqual(res.status_code, 401)
+        self.assertFalse(data['success'])
+
+    def test_update_actors_bulk(self):
+        """Passing Test for PATCH /actors/bulk with an unknown id"""
+        res, data = self.send('PATCH', '/actors/bulk', {'actors': [
+            {'id': 1, 'name': 'Anne Hathaway'},
+            {'id': 100, 'name': 'Nobody'}
+        ]})
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['results'][0]['actor_id'], 1)
+        self.assertEqual(data['results'][1]['error'], 404)
+        with self.app.app_context():
+            self.assertEqual(Actor.query.get(1).name, 'Anne Hathaway')
+
+    def test_bulk_without_valid_items(self):
+        """Passing Test for bulk requests that write nothing"""
+        names = ['actors', 'movies', 'cast']
+        with self.app.app_context():
+            versions = get_versions(names)
+
+        for method, url, body in (
+                ('POST', '/actors/bulk', {'actors': [{'name': ''}]}),
+                ('PATCH', '/actors/bulk', {'actors': [{'id': 100}]}),
+                ('POST', '/movies/bulk', {'movies': [{'title': ''}]}),
+                ('PATCH', '/movies/bulk', {'movies': [{'id': 1}]})):
+            res, data = self.send(method, url, body, 'admin-token')
+
+            self.assertEqual(res.status_code, 200, url)
+            self.assertEqual(data['succeeded'], 0, url)
+
+        with self.app.app_context():
+            self.assertEqual(get_versions(names), versions)
+
+    def test_create_movies_bulk(self):
+        """Passing Test for POST /movies/bulk with an unresolved cast"""
+        movie = {'title': 'Cruella', 'release_date': '22-05-2021',
+                 'cast': ['Ann']}
+        res, data = self.send('POST', '/movies/bulk', {'movies': [
+            movie, dict(movie, cast=['Nobody In Particular'])
+        ]}, 'admin-token')
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['results'][0]['movie_id'], 4)
+        self.assertEqual(data['results'][1]['missing'],
+                         ['Nobody In Particular'])
+
+    def test_update_movies_bulk(self):
+        """Passing Test for PATCH /movies/bulk with per-item results"""
+        res, data = self.send('PATCH', '/movies/bulk', {'movies': [
+            {'id': 2, 'cast': ['Ann', 3]},
+            {'id': 3, 'title': ''}
+        ]})
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['results'][0]['movie_id'], 2)
+        self.assertEqual(data['results'][1]['error'], 422)
+        with self.app.app_context():
+            self.assertEqual([actor.name for actor in
+                              Movie.query.get(2).cast], ['Ann', 'Cal'])
+
+
+class EntityCacheTestCase(AppTestCase):
+    """This class tests the entity cache and its backends"""
+
+    tokens = {'test-token': ['get:actors-details']}
+
+    def test_lru_entry_expires(self):
+        """Failing Test for an entry older than the ttl"""
+        cache = LRUCache(maxsize=10, ttl=0)
+        cache.set('actor:1', {'id': 1})
+
+        self.assertIsNone(cache.get('actor:1'))
+
+    def test_lru_evicts_least_recently_used(self):
+        """Passing Test for the size bound"""
+        cache = LRUCache(maxsize=1, ttl=30)
+        cache.set('actor:1', {'id': 1})
+        cache.set('actor:2', {'id': 2})
+
+        self.assertIsNone(cache.get('actor:1'))
+        self.assertEqual(cache.get('actor:2'), {'id': 2})
+
+    def test_redis_backend_invalidation(self):
+        """Passing Test for invalidating an entry in the redis backend"""
+        cache = EntityCache(RedisCache(FakeRedis()))
+        cache.set('movie', 1, 3, {'id': 1, 'title': 'Cruella'})
+
+        self.assertEqual(cache.get('movie', 1, 3)['title'], 'Cruella')
+        self.assertIsNone(cache.get('movie', 1, 4))
+
+        cache.invalidate('movie', 1)
+        self.assertIsNone(cache.get('movie', 1, 3))
+
+    def test_write_of_another_worker(self):
+        """Passing Test for an entry the write did not invalidate"""
+        app = self.create_app(ENTITY_CACHE='memory')
+        with app.app_context():
+            Actor('Old Name', 30, 'F').insert()
+
+        old = app.test_client().get('/actors/1', headers=self.headers)
+        write_in_other_worker(app, 1, 'New Name')
+        res = app.test_client().get('/actors/1', headers=self.headers)
+        revalidated = app.test_client().get('/actors/1', headers=dict(
+            self.headers, **{'If-None-Match': res.headers['ETag']}))
+
+        self.assertEqual(old.get_json()['actor']['name'], 'Old Name')
+        self.assertEqual(res.get_json()['actor']['name'], 'New Name')
+        self.assertNotEqual(res.headers['ETag'], old.headers['ETag'])
+        self.assertEqual(revalidated.status_code, 304)
+
+
+class EngineOptionsTestCase(unittest.TestCase):
+    """This class tests the connection pool settings built for setup_db"""
+
+    def test_pool_settings_from_config(self):
+        """Passing Test for pool size, overflow and statement timeout"""
+        options = engine_options('postgresql://user@localhost/castu', {
+            'DB_POOL_SIZE': 3,
+            'DB_MAX_OVERFLOW': 0,
+            'DB_STATEMENT_TIMEOUT': 5000
+        })
+
+        self.assertIs(options['poolclass'], TimedQueuePool)
+        self.assertEqual(options['pool_size'], 3)
+        self.assertEqual(options['max_overflow'], 0)
+        self.assertTrue(options['pool_pre_ping'])
+        self.assertEqual(options['connect_args']['options'],
+                         '-c statement_timeout=5000')
+
+    def test_pgbouncer_mode(self):
+        """Passing Test for disabling the client-side pool"""
+        options = engine_options('postgresql://user@localhost/castu',
+                                 {'DB_PGBOUNCER': 'true'})
+
+        self.assertIs(options['poolclass'], TimedNullPool)
+        self.assertNotIn('pool_size', options)
+
+    def test_pgbouncer_statement_timeout_on_replicas(self):
+        """Passing Test for the per-transaction timeout of each replica"""
+        try:
+            import psycopg2  # noqa: F401
+        except ImportError:
+            self.skipTest('psycopg2 is not installed')
+
+        app = Flask(__name__)
+        app.config.update({
+            'DATABASE_REPLICA_URLS': 'postgresql://user@replica1/castu,'
+                                     'postgresql://user@replica2/castu',
+            'DB_PGBOUNCER': 'true',
+            'DB_STATEMENT_TIMEOUT': 5000
+        })
+        router = configure_replicas(app, LRUCache())
+
+        self.assertEqual(len(router.engines), 2)
+        for engine in router.engines:
+            self.assertEqual(len(engine.dispatch.begin), 1)
+
+
+class ReplicaRoutingTestCase(AppTestCase):
+    """This class tests read replica routing with two local SQLite files"""
+
+    tokens = {'test-token': ['get:actors', 'patch:actors']}
+
+    def setUp(self):
+        super().setUp()
+        replica = 'sqlite:///' + os.path.join(self.directory.name, 'r.db')
+        self.app = self.create_app(DATABASE_REPLICA_URLS=replica,
+                                   DATABASE_READ_YOUR_WRITES=60)
+        self.client = self.app.test_client
+
+        replica_engine = self.app.extensions['replica_router'].engines[0]
+        with self.app.app_context():
+            db.metadata.create_all(replica_engine)
+            replica_engine.execute(Actor.__table__.insert().values(
+                name='Replica Actor', age=30, gender='F'))
+            Actor('Primary Actor', 30, 'F').insert()
+
+    def test_reads_use_replica(self):
+        """Passing Test for GET /actors served by the replica"""
+        res = self.client().get('/actors', headers=self.headers)
+        data = json.loads(res.data)
+
+        self.assertEqual(data['actors'][0]['name'], 'Replica Actor')
+
+    def test_read_your_writes(self):
+        """Passing Test for reads on the primary after a write"""
+        res = self.client().patch('/actors/1', headers=self.headers,
+                                  json={'age': 31})
+        self.assertEqual(res.status_code, 200)
+
+        res = self.client().get('/actors', headers=self.headers)
+        data = json.loads(res.data)
+
+        self.assertEqual(data['actors'][0]['name'], 'Primary Actor')
+        self.assertEqual(data['actors'][0]['age'], 31)
+
+
+class SerializerTestCase(AppTestCase):
+    """This class tests the column-tuple serializers and JSON encoder"""
+
+    def setUp(self):
+        super().setUp()
+        self.app = self.create_app()
+        with self.app.app_context():
+            actor = Actor('Zo\u00eb Kravitz', 32, 'F')
+            actor.insert()
+            movie = Movie('The Batman', '2022-03-04')
+            movie.cast.append(actor)
+            movie.insert()
+
+    def test_dumps_matches_jsonify(self):
+        """Passing Test for byte-identical output to jsonify"""
+        data = {
+            'name': 'Zo\u00eb \u2603 \U0001f3ac "quoted" \\ / \x7f',
+            'controls': ''.join(chr(code) for code in range(32)),
+            'nested': {'b': [1, None, True], 'a': -2 ** 40}
+        }
+        with self.app.app_context():
+            self.assertEqual(json_response(data).data,
+                             jsonify(data).data)
+            self.assertEqual(dumps(data) + b'\n', jsonify(data).data)
+
+            # ASCII-only output is written by orjson when it is installed
+            del data['name']
+            self.assertEqual(dumps(data) + b'\n', jsonify(data).data)
+
+    def test_dicts_match_format(self):
+        """Passing Test for serializer rows equal to format()"""
+        with self.app.app_context():
+            rows = actor_serializer.query().all()
+            self.assertEqual(
+                actor_serializer.dicts(rows, {'movies'}),
+                [actor.format({'movies'}) for actor in Actor.query])
+
+            rows = movie_serializer.query().all()
+            self.assertEqual(
+                movie_serializer.dicts(rows, {'cast'}),
+                [movie.format({'cast'}) for movie in Movie.query])
+
+    def test_only_restricts_the_select(self):
+        """Passing Test for ?fields= columns pushed into the SELECT"""
+        serializer = actor_serializer.only(['name'])
+        with self.app.app_context():
+            sql = str(serializer.query())
+            self.assertEqual(serializer.dicts(serializer.query().all()),
+                             [{'id': 1, 'name': 'Zo\u00eb Kravitz'}])
+
+        self.assertIn('actors.name', sql)
+        self.assertNotIn('actors.age', sql)
+
+    def test_only_rejects_unknown_fields(self):
+        """Failing Test for a ?fields= name that is not a column"""
+        self.assertRaises(ValueError, actor_serializer.only, ['salary'])
+        self.assertRaises(ValueError, actor_serializer.only, [])
+
+    def test_rows_are_not_hydrated(self):
+        """Passing Test for list queries leaving the identity map empty"""
+        with self.app.app_context():
+            actor_serializer.dicts(actor_serializer.query().all())
+            self.assertEqual(len(db.session.identity_map), 0)
+
+
+class FilterTestCase(AppTestCase):
+    """This class tests list filters, sorted pages and their indexes"""
+
+    tokens = {'test-token': ['get:actors', 'get:movies']}
+
+    def setUp(self):
+        super().setUp()
+        self.app = self.create_app()
+        self.client = self.app.test_client
+        with self.app.app_context():
+            Actor.insert_many([
+                {'name': 'Actor {}'.format(i),
+                 'age': None if i % 5 == 0 else 20 + i % 7,
+                 'gender': 'F' if i % 2 else 'M'}
+                for i in range(30)
+            ])
+
+    def query_plan(self, query):
+        """Returns the SQLite EXPLAIN QUERY PLAN details of query"""
+        compiled = query.statement.compile(db.engine)
+        params = [compiled.params[name] for name in compiled.positiontup]
+        rows = db.engine.execute(
+            'EXPLAIN QUERY PLAN ' + str(compiled), *params)
+        return ' '.join(row[3] for row in rows)
+
+    def test_filters_use_indexes(self):
+        """Passing Test for filtered, sorted pages as index searches"""
+        with self.app.app_context():
+            plan = self.query_plan(actor_serializer.query().filter(
+                *actor_filters({'age_min': '22', 'age_max': '24'})
+            ).order_by(*keyset_order(Actor.id, Actor.age)))
+            self.assertIn('ix_actors_age', plan)
+
+            plan = self.query_plan(actor_serializer.query().filter(
+                *actor_filters({'gender': 'F'})
+            ).order_by(*keyset_order(Actor.id)))
+            self.assertIn('ix_actors_gender', plan)
+
+            plan = self.query_plan(movie_serializer.query().filter(
+                *movie_filters({'released_after': '2021-01-01'})
+            ).order_by(*keyset_order(Movie.id, Movie.release_date)))
+            self.assertIn('ix_movies_release_date', plan)
+
+    def test_sorted_pages_with_nulls(self):
+        """Passing Test for paging ?sort=-age with ties and NULL ages"""
+        with self.app.app_context():
+            actors = [(actor.id, actor.age) for actor in Actor.query]
+        expected = [id for id, age in sorted(
+            (actor for actor in actors if actor[1] is not None),
+            key=lambda actor: (-actor[1], actor[0]))]
+        expected += [id for id, age in actors if age is None]
+
+        ids, cursor = [], None
+        while True:
+            url = '/actors?sort=-age&fields=name&limit=4'
+            if cursor:
+                url += '&after=' + cursor
+            data = json.loads(
+                self.client().get(url, headers=self.headers).data)
+            ids += [actor['id'] for actor in data['actors']]
+            cursor = data['next_cursor']
+            if cursor is None:
+                break
+
+        self.assertEqual(ids, expected)
+
+    def test_filtered_list(self):
+        """Passing Test for GET /actors?gender=&age_min=&age_max="""
+        res = self.client().get('/actors?gender=F&age_min=22&age_max=24',
+                                headers=self.headers)
+        actors = json.loads(res.data)['actors']
+
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(actors)
+        for actor in actors:
+            self.assertEqual(actor['gender'], 'F')
+            self.assertTrue(22 <= actor['age'] <= 24)
+
+    def test_released_date_range(self):
+        """Passing Test for ?released_after=&released_before= on dates"""
+        with self.app.app_context():
+            Movie.insert_many([
+                {'title': 'Movie {}'.format(month),
+                 'release_date': parse_release_date(
+                     '01-{:02d}-2021'.format(month)),
+                 'cast': []}
+                for month in range(1, 13)
+            ])
+
+        res = self.client().get(
+            '/movies?released_after=2021-03-01&released_before=01-05-2021'
+            '&sort=-release_date', headers=self.headers)
+        movies = json.loads(res.data)['movies']
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([movie['release_date'] for movie in movies],
+                         ['2021-05-01', '2021-04-01', '2021-03-01'])
+
+    def test_parse_release_date(self):
+        """Passing Test for ISO and legacy DD-MM-YYYY release dates"""
+        self.assertEqual(parse_release_date('2021-05-22'),
+                         parse_release_date('22-05-2021'))
+        for value in ('2021-5-22', '31-02-2021', '22/05/2021', '', 2021):
+            self.assertRaises(ValueError, parse_release_date, value)
+
+    def test_422_stale_sort_cursor(self):
+        """Failing Test for a sorted page after a cursor of another sort"""
+        for url, after in (
+                ('/movies?sort=release_date', [5, 1]),
+                ('/movies?sort=release_date', ['2021-13-01', 1]),
+                ('/movies?sort=title', [5, 1]),
+                ('/actors?sort=age', [[1], 2]),
+                ('/actors?sort=age', ['40', 2]),
+                ('/actors?sort=age', [2])):
+            res = self.client().get(url + '&after=' + encode_cursor(after),
+                                    headers=self.headers)
+
+            self.assertEqual(res.status_code, 422, (url, after))
+
+    def test_422_unknown_sort(self):
+        """Failing Test for GET /actors?sort= with an unknown column"""
+        res = self.client().get('/actors?sort=salary', headers=self.headers)
+
+        self.assertEqual(res.status_code, 422)
+
+
+class SearchTestCase(AppTestCase):
+    """This class tests GET /search with the in-process index"""
+
+    tokens = {'test-token': ['get:actors', 'get:movies'],
+              'movies-token': ['get:movies']}
+
+    def setUp(self):
+        super().setUp()
+        self.app = self.create_app()
+        self.client = self.app.test_client
+        with self.app.app_context():
+            Actor.insert_many([
+                {'name': name, 'age': 40, 'gender': 'F'}
+                for name in ('Emma Stone', 'Sharon Stone', 'Emma Watson')
+            ])
+            Movie.insert_many([
+                {'title': title, 'release_date': parse_release_date(
+                    '2021-05-28'), 'cast': []}
+                for title in ('Cruella', 'Stoner')
+            ])
+
+    def search(self, query, token='test-token'):
+        res = self.client().get('/search', query_string={'q': query},
+                                headers={'Authorization': 'Bearer ' + token})
+        return res, json.loads(res.data)
+
+    def test_full_text_matches_rank_first(self):
+        """Passing Test for GET /search?q= ranking every word matches"""
+        res, data = self.search('emma stone')
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['results'][0]['label'], 'Emma Stone')
+        self.assertGreater(data['results'][0]['score'],
+                           data['results'][1]['score'])
+
+    def test_typos(self):
+        """Passing Test for trigram matches of misspelled queries"""
+        res, data = self.search('crulla')
+
+        self.assertEqual([result['label'] for result in data['results']],
+                         ['Cruella'])
+
+    def test_index_follows_model_changes(self):
+        """Passing Test for the index updated by insert, update, delete"""
+        self.search('stone')
+        with self.app.app_context():
+            Actor('Oliver Stone', 70, 'M').insert()
+            actor = Actor.query.filter(Actor.name == 'Sharon Stone').one()
+            actor.name = 'Sharon Rock'
+            actor.update()
+            Movie.query.filter(Movie.title == 'Stoner').one().delete()
+
+        res, data = self.search('stone')
+        self.assertEqual(
+            sorted(result['label'] for result in data['results']),
+            ['Emma Stone', 'Oliver Stone'])
+
+    def test_results_follow_permissions(self):
+        """Passing Test for searching only the kinds the token can read"""
+        res, data = self.search('stone', 'movies-token')
+
+        self.assertEqual([result['type'] for result in data['results']],
+                         ['movie'])
+
+    def test_etag_follows_permissions(self):
+        """Passing Test for an ETag that differs by the kinds searched"""
+        res, data = self.search('stone')
+        etag = res.headers['ETag']
+
+        res = self.client().get('/search', query_string={'q': 'stone'},
+                                headers={
+                                    'Authorization': 'Bearer movies-token',
+                                    'If-None-Match': etag})
+
+        self.assertEqual(res.status_code, 200)
+        self.assertNotEqual(res.headers['ETag'], etag)
+        self.assertIn('Authorization', res.headers['Vary'])
+
+    def test_paginated(self):
+        """Passing Test for following next_cursor through the ranking"""
+        labels, cursor = [], None
+        while True:
+            query = {'q': 'stone', 'limit': 1}
+            if cursor:
+                query['after'] = cursor
+            data = json.loads(self.client().get(
+                '/search', query_string=query,
+                headers={'Authorization': 'Bearer test-token'}).data)
+            labels += [result['label'] for result in data['results']]
+            cursor = data['next_cursor']
+            if cursor is None:
+                break
+
+        self.assertEqual(labels, [result['label'] for result in
+                                  self.search('stone')[1]['results']])
+
+    def test_422_empty_query(self):
+        """Failing Test for GET /search without q"""
+        res, data = self.search('  ')
+
+        self.assertEqual(res.status_code, 422)
+
+
+class GraphTestCase(AppTestCase):
+    """This class tests the co-star endpoints with the in-memory graph"""
+
+    config = {'CAST_GRAPH': 'memory'}
+    tokens = {'test-token': ['get:actors', 'get:movies', 'post:movies',
+                             'patch:movies', 'delete:actors']}
+
+    def setUp(self):
+        super().setUp()
+        self.app = self.create_app()
+        self.client = self.app.test_client
+        with self.app.app_context():
+            # Ann - Ben - Cal - Dee, Eve in no movie
+            Actor.insert_many([
+                {'name': name, 'age': 40, 'gender': 'F'}
+                for name in ('Ann', 'Ben', 'Cal', 'Dee', 'Eve')
+            ])
+            Movie.insert_many([
+                {'title': title, 'release_date': parse_release_date(
+                    '2021-05-28'), 'cast': cast}
+                for title, cast in (('First', [1, 2]), ('Second', [2, 3]),
+                                    ('Third', [3, 4]), ('Fourth', [1, 2]))
+            ])
+
+    def tearDown(self):
+        cast_graph.wait()
+        super().tearDown()
+
+    def get(self, url):
+        res = self.client().get(url, headers=self.headers)
+        return res, json.loads(res.data)
+
+    def path(self, source, target):
+        res, data = self.get('/actors/{}/path/{}'.format(source, target))
+        return data['degrees'], [
+            node.get('name', node.get('title')) for node in data['path'] or ()
+        ]
+
+    def test_costars_most_shared_first(self):
+        """Passing Test for GET /actors/<id>/costars"""
+        res, data = self.get('/actors/2/costars')
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['costars'], [
+            {'id': 1, 'name': 'Ann', 'shared_movies': 2},
+            {'id': 3, 'name': 'Cal', 'shared_movies': 1}
+        ])
+
+    def test_costars_paginated(self):
+        """Passing Test for following next_cursor through the co-stars"""
+        res, data = self.get('/actors/2/costars?limit=1')
+        res, rest = self.get('/actors/2/costars?limit=1&after='
+                             + data['next_cursor'])
+
+        self.assertEqual([costar['id'] for costar in
+                          data['costars'] + rest['costars']], [1, 3])
+        self.assertIsNone(rest['next_cursor'])
+
+    def test_shortest_path(self):
+        """Passing Test for GET /actors/<a>/path/<b>"""
+        self.assertEqual(self.path(1, 4), (3, [
+            'Ann', 'First', 'Ben', 'Second', 'Cal', 'Third', 'Dee'
+        ]))
+        self.assertEqual(self.path(4, 4), (0, ['Dee']))
+
+    def test_no_path(self):
+        """Passing Test for actors that share no chain of movies"""
+        self.assertEqual(self.path(1, 5), (None, []))
+
+    def test_graph_follows_model_changes(self):
+        """Passing Test for paths after cast inserts, updates, deletes"""
+        self.path(1, 4)
+        self.client().post('/movies', headers=self.headers, json={
+            'title': 'Fifth', 'release_date': '2021-05-28', 'cast': [1, 5]})
+        self.client().patch('/movies/3', headers=self.headers,
+                            json={'cast': [2, 4]})
+        self.client().delete('/actors/2', headers=self.headers)
+
+        self.assertEqual(self.path(1, 5), (1, ['Ann', 'Fifth', 'Eve']))
+        self.assertEqual(self.path(1, 4), (None, []))
+
+    def test_write_of_another_process(self):
+        """Passing Test for a cast change the graph did not see"""
+        self.path(1, 4)
+        with self.app.app_context():
+            db.session.execute(
+                'INSERT INTO "cast" (actor_id, movie_id) VALUES (5, 3)')
+            bump_versions('cast')
+            db.session.commit()
+
+        self.assertEqual(self.path(4, 5), (1, ['Dee', 'Third', 'Eve']))
+        cast_graph.wait()
+        self.assertEqual(self.path(4, 5), (1, ['Dee', 'Third', 'Eve']))
+
+    def test_first_request_answered_while_loading(self):
+        """Passing Test for a request not waiting for the graph load"""
+        loading = threading.Event()
+        load = cast_graph.load
+
+        def slow_load(bind):
+            loading.wait(5)
+            load(bind)
+
+        cast_graph.load = slow_load
+        try:
+            res, data = self.get('/actors/2/costars')
+            self.assertEqual(res.status_code, 200)
+            self.assertEqual(len(data['costars']), 2)
+            self.assertFalse(cast_graph.loaded)
+        finally:
+            loading.set()
+            del cast_graph.load
+
+        cast_graph.wait()
+        self.assertEqual(cast_graph.loaded,
+                         self.config['CAST_GRAPH'] == 'memory')
+
+    def test_warm_cast_graph(self):
+        """Passing Test for loading the graph when a worker starts"""
+        warm_cast_graph(self.app)
+        cast_graph.wait()
+
+        self.assertEqual(cast_graph.loaded,
+                         self.config['CAST_GRAPH'] == 'memory')
+
+    def test_404_unknown_actor(self):
+        """Failing Test for GET /actors/<a>/path/<b> with no actor b"""
+        res, data = self.get('/actors/1/path/1000')
+
+        self.assertEqual(res.status_code, 404)
+        self.assertEqual(self.get('/actors/1000/costars')[0].status_code,
+                         404)
+
+
+class GraphSQLTestCase(GraphTestCase):
+    """This class tests the co-star endpoints with the SQL queries"""
+
+    config = {'CAST_GRAPH': 'sql'}
+
+    def test_graph_not_loaded(self):
+        """Passing Test for answering without the in-memory graph"""
+        self.path(1, 4)
+
+        self.assertFalse(cast_graph.loaded)
+
+
+class CastCounterTestCase(AppTestCase):
+    """This class tests the movie_count and cast_size counters"""
+
+    config = {'ENTITY_CACHE': 'memory'}
+    tokens = {'test-token': ['get:actors', 'get:actors-details',
+                             'get:movies', 'patch:movies', 'delete:actors']}
+
+    def setUp(self):
+        super().setUp()
+        self.app = self.create_app()
+        self.client = self.app.test_client
+        with self.app.app_context():
+            Actor.insert_many([
+                {'name': name, 'age': 40, 'gender': 'F'}
+                for name in ('Ann', 'Ben', 'Cal')
+            ])
+            Movie.insert_many([
+                {'title': title, 'release_date': parse_release_date(
+                    '2021-05-28'), 'cast': cast}
+                for title, cast in (('First', [1, 2]), ('Second', [1]))
+            ])
+
+    def tearDown(self):
+        entity_cache.backend.clear()
+        super().tearDown()
+
+    def get(self, url):
+        return json.loads(self.client().get(url, headers=self.headers).data)
+
+    def test_counters_follow_cast_changes(self):
+        """Passing Test for counters after cast updates and deletes"""
+        self.assertEqual(self.get('/actors/3')['actor']['movie_count'], 0)
+        self.client().patch('/movies/2', headers=self.headers,
+                            json={'cast': [3]})
+        self.client().delete('/actors/2', headers=self.headers)
+
+        # the cached actor 3 is invalidated by the movie update
+        self.assertEqual(self.get('/actors/3')['actor']['movie_count'], 1)
+        self.assertEqual(
+            [(actor['id'], actor['movie_count'])
+             for actor in self.get('/actors')['actors']], [(1, 1), (3, 1)])
+        self.assertEqual(
+            [(movie['id'], movie['cast_size'])
+             for movie in self.get('/movies')['movies']], [(1, 1), (2, 1)])
+
+    def test_cast_version_follows_cast_changes(self):
+        """Passing Test for movie writes that leave the cast unchanged"""
+        def cast_version():
+            with self.app.app_context():
+                return get_versions(['cast'])['cast']
+
+        version = cast_version()
+        self.client().patch('/movies/1', headers=self.headers,
+                            json={'title': 'Renamed'})
+        self.client().patch('/movies/1', headers=self.headers,
+                            json={'cast': [2, 1]})
+        self.client().patch('/movies/bulk', headers=self.headers, json={
+            'movies': [{'id': 1, 'cast': [1, 2]},
+                       {'id': 2, 'release_date': '2021-06-01'}]})
+        self.assertEqual(cast_version(), version)
+
+        self.client().patch('/movies/bulk', headers=self.headers, json={
+            'movies': [{'id': 1, 'cast': [1, 2]}, {'id': 2, 'cast': [3]}]})
+        self.assertEqual(cast_version(), version + 1)
+        self.assertEqual(
+            [(actor['id'], actor['movie_count'])
+             for actor in self.get('/actors')['actors']],
+            [(1, 1), (2, 1), (3, 1)])
+
+    def test_sort_by_counter(self):
+        """Passing Test for GET /actors?sort=-movie_count"""
+        data = self.get('/actors?sort=-movie_count&fields=movie_count')
+
+        self.assertEqual([actor['id'] for actor in data['actors']],
+                         [1, 2, 3])
+
+    def test_sort_uses_index(self):
+        """Passing Test for counter sorted pages as index scans"""
+        with self.app.app_context():
+            query = movie_serializer.query().order_by(
+                *keyset_order(Movie.id, Movie.cast_size))
+            compiled = query.statement.compile(db.engine)
+            params = [compiled.params[name] for name in compiled.positiontup]
+            plan = ' '.join(row[3] for row in db.engine.execute(
+                'EXPLAIN QUERY PLAN ' + str(compiled), *params))
+
+        self.assertIn('ix_movies_cast_size', plan)
+
+    def test_stats(self):
+        """Passing Test for GET /stats"""
+        data = self.get('/stats?top=1')
+
+        self.assertEqual(data['actors']['count'], 3)
+        self.assertEqual(data['actors']['empty'], 1)
+        self.assertEqual(data['actors']['top'],
+                         [{'id': 1, 'name': 'Ann', 'movie_count': 2}])
+        self.assertEqual(data['movies']['total'], 3)
+        self.assertEqual(data['movies']['average'], 1.5)
+        self.assertEqual(data['movies']['top'],
+                         [{'id': 1, 'title': 'First', 'cast_size': 2}])
+
+    def test_422_stats_top(self):
+        """Failing Test for GET /stats with a non positive top"""
+        res = self.client().get('/stats?top=0', headers=self.headers)
+
+        self.assertEqual(res.status_code, 422)
+
+
+class AsgiTestCase(AppTestCase):
+    """This class tests that the ASGI app answers as the Flask app"""
+
+    tokens = {'test-token': ['get:actors', 'get:actors-details', 'get:movies',
+                             'get:movies-details', 'post:actors']}
+
+    def setUp(self):
+        try:
+            from starlette.testclient import TestClient
+            import aiosqlite  # noqa: F401
+        except ImportError:
+            self.skipTest('starlette and aiosqlite are not installed')
+        from asgi import create_asgi_app
+
+        super().setUp()
+        self.asgi = TestClient(create_asgi_app(self.app_config(PAGE_SIZE=2)))
+        self.app = self.create_app(PAGE_SIZE=2)
+        with self.app.app_context():
+            Actor.insert_many([
+                {'name': name, 'age': age, 'gender': 'F'}
+                for name, age in (('Ann', 30), ('Ben', 40), ('Cal', 50))
+            ])
+            Movie.insert_many([
+                {'title': 'First', 'cast': [1, 2],
+                 'release_date': parse_release_date('2021-05-28')},
+                {'title': 'Second', 'cast': [2],
+                 'release_date': parse_release_date('2020-01-02')}
+            ])
+
+        # runs the lifespan startup, once the tables exist
+        self.asgi.__enter__()
+        # the ETag depends on Accept, which only the ASGI client sends
+        self.headers['Accept'] = 'application/json'
+
+    def tearDown(self):
+        self.asgi.__exit__(None, None, None)
+        cast_graph.wait()
+        super().tearDown()
+
+    def assertSameResponse(self, url, headers=None):
+        headers = dict(self.headers, **(headers or {}))
+        flask = self.app.test_client().get(url, headers=headers)
+        asgi = self.asgi.get(url, headers=headers)
+
+        self.assertEqual(asgi.status_code, flask.status_code, url)
+        self.assertEqual(asgi.content, flask.data, url)
+        self.assertEqual(asgi.headers.get('ETag'), flask.headers.get('ETag'))
+        return asgi
+
+    def test_reads_match_flask(self):
+        """Passing Test for the same bodies and ETags as the Flask app"""
+        for url in ('/actors', '/actors?sort=-age&include=movies',
+                    '/actors?age_min=35&fields=name',
+                    '/movies?sort=release_date&include=cast',
+                    '/actors/2?include=movies', '/movies/1',
+                    '/movies/1?fields=title'):
+            res = self.assertSameResponse(url)
+            self.assertEqual(res.status_code, 200, url)
+
+        cursor = self.asgi.get('/actors', headers=self.headers) \
+            .json()['next_cursor']
+        self.assertSameResponse('/actors?after=' + cursor)
+
+    def test_not_modified(self):
+        """Passing Test for 304 on the ETag of the Flask app"""
+        etag = self.app.test_client().get(
+            '/movies', headers=self.headers).headers['ETag']
+
+        res = self.asgi.get('/movies', headers=dict(
+            self.headers, **{'If-None-Match': etag}))
+
+        self.assertEqual(res.status_code, 304)
+        self.assertEqual(res.headers['ETag'], etag)
+
+    def test_error_envelopes_match_flask(self):
+        """Passing Test for the 404, 422, 401 and AuthError envelopes"""
+        for url in ('/actors/99', '/movies?include=nope', '/actors?limit=x',
+                    '/actors?after=bad', '/movies?fields=nope'):
+            self.assertSameResponse(url)
+            self.assertIn(self.asgi.get(url, headers=self.headers)
+                          .status_code, (404, 422))
+
+        res = self.assertSameResponse('/actors', {'Authorization': ''})
+        self.assertEqual(res.status_code, 401)
+        self.assertEqual(res.json()['code'], 'authorization_header_missing')
+        res = self.assertSameResponse('/actors', {
+            'Authorization': 'Bearer other-token'})
+        self.assertEqual(res.status_code, 401)
+        self.assertFalse(res.json()['success'])
+
+    def test_other_routes_run_on_flask(self):
+        """Passing Test for writes and streams handed to the Flask app"""
+        res = self.asgi.post('/actors', headers=self.headers, json={
+            'name': 'Dee', 'age': 20, 'gender': 'F'})
+        self.assertEqual(res.status_code, 200)
+
+        res = self.asgi.get('/actors?stream=1', headers=self.headers)
+        self.assertEqual(res.headers['Content-Type'], 'application/x-ndjson')
+        self.assertEqual(len(res.content.splitlines()), 4)
+        self.assertSameResponse('/actors?fields=name')
+
+    def test_cached_detail_after_write_of_another_worker(self):
+        """Passing Test for the entity cache of the native routes"""
+        entity_cache.backend = LRUCache()
+        self.assertSameResponse('/actors/1')
+        write_in_other_worker(self.app, 1, 'Anna')
+
+        res = self.assertSameResponse('/actors/1')
+        self.assertEqual(res.json()['actor']['name'], 'Anna')
+
+
+class GunicornConfTestCase(unittest.TestCase):
+    """This class tests the production worker settings"""
+
+    def test_worker_profiles(self):
+        """Passing Test for the worker model of each I/O profile"""
+        import gunicorn_conf
+
+        self.assertEqual(gunicorn_conf.worker_profile('cpu', 4),
+                         ('sync', 9, 1))
+        self.assertEqual(gunicorn_conf.worker_profile('mixed', 4),
+                         ('gthread', 5, 4))
+        self.assertEqual(gunicorn_conf.worker_profile('io', 4),
+                         ('gevent', 4, 1))
+        self.assertEqual(gunicorn_conf.worker_profile('mixed', 4, 2, 8),
+                         ('gthread', 2, 8))
+        with self.assertRaises(ValueError):
+            gunicorn_conf.worker_profile('other', 4)
+
+    def test_reset_after_fork_replaces_the_pool(self):
+        """Passing Test for a worker not reusing inherited connections"""
+        with tempfile.TemporaryDirectory() as directory:
+            app = create_app({
+                'SQLALCHEMY_DATABASE_URI':
+                    'sqlite:///' + os.path.join(directory, 'fork.db'),
+                'ENTITY_CACHE': 'none'
+            })
+            with app.app_context():
+                db.session.execute('select 1')
+                db.session.remove()
+                pool = db.engine.pool
+
+            reset_after_fork(app)
+
+            with app.app_context():
+                self.assertIsNot(db.engine.pool, pool)
+
+
+class MetricsTestCase(AppTestCase):
+    """This class tests the /metrics endpoint"""
+
+    def setUp(self):
+        super().setUp()
+        self.app = self.create_app()
+        self.client = self.app.test_client
+        with self.app.app_context():
+            Actor.insert_many([{'name': 'Ann', 'age': 30, 'gender': 'F'}])
+
+    def samples(self, headers=None):
+        res = self.client().get('/metrics', headers=headers)
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(res.content_type.startswith('text/plain'))
+        return dict(line.rsplit(' ', 1)
+                    for line in res.data.decode().splitlines()
+                    if not line.startswith('#'))
+
+    def test_request_metrics(self):
+        """Passing Test for request, query and serialization histograms"""
+        count = 'castu_request_duration_seconds_count{endpoint="get_actors"' \
+            ',method="GET",status="200"}'
+        before = float(self.samples().get(count, 0))
+
+        for attempt in range(3):
+            self.assertEqual(self.client().get(
+                '/actors', headers=self.headers).status_code, 200)
+            self.client().get('/actors')
+            if attempt == 0:
+                children = len(metrics.request_seconds._children)
+
+        samples = self.samples()
+        self.assertEqual(float(samples[count]), before + 3)
+        self.assertIn('castu_request_duration_seconds_count{endpoint='
+                      '"get_actors",method="GET",status="401"}', samples)
+        self.assertGreater(float(samples[
+            'castu_request_db_queries_sum{endpoint="get_actors"}']), 0)
+        self.assertGreater(float(samples[
+            'castu_request_serialization_seconds_count'
+            '{endpoint="get_actors"}']), 0)
+        self.assertIn('castu_db_query_duration_seconds_count', samples)
+        self.assertIn('castu_token_cache_hits_total', samples)
+        self.assertIn('castu_db_pool_wait_seconds_total', samples)
+        self.assertEqual(samples[
+            'castu_request_duration_seconds_bucket{endpoint="get_actors",'
+            'method="GET",status="200",le="+Inf"}'], samples[count])
+        # label sets are created once, not per request
+        self.assertEqual(len(metrics.request_seconds._children), children)
+
+    def test_failed_statements(self):
+        """Passing Test for failed statements leaving no timer behind"""
+        before = sum(metrics.query_seconds.counts)
+        with self.app.app_context():
+            with db.engine.connect() as connection:
+                for attempt in range(3):
+                    with self.assertRaises(Exception):
+                        connection.execute('SELECT * FROM missing')
+                connection.execute('SELECT 1')
+
+                self.assertNotIn('query_start', connection.info)
+
+        # only the statement that ran is timed
+        self.assertEqual(sum(metrics.query_seconds.counts), before + 1)
+
+    def test_type_lines_match_samples(self):
+        """Passing Test for the sample names of every metric type"""
+        self.client().get('/actors', headers=self.headers)
+        self.client().get('/actors/1', headers=self.headers)
+
+        suffixes = {
+            'counter': ('_total',),
+            'gauge': ('',),
+            'histogram': ('_bucket', '_sum', '_count')
+        }
+        kinds, names = {}, set()
+        for line in self.client().get('/metrics').data.decode().splitlines():
+            if line.startswith('# TYPE '):
+                name, kind = line[len('# TYPE '):].split(' ')
+                self.assertFalse(name.endswith('_total'), line)
+                kinds[name] = kind
+            elif not line.startswith('#'):
+                names.add(line.split('{')[0].split(' ')[0])
+
+        self.assertEqual(kinds['castu_token_cache_hits'], 'counter')
+        self.assertIn('castu_token_cache_hits_total', names)
+        self.assertLessEqual(names, {name + suffix
+                                     for name, kind in kinds.items()
+                                     for suffix in suffixes[kind]})
+
+    def test_metrics_token(self):
+        """Passing Test for /metrics behind METRICS_TOKEN"""
+        self.app.config['METRICS_TOKEN'] = 'scraper'
+
+        self.assertEqual(self.client().get('/metrics').status_code, 401)
+        self.samples({'Authorization': 'Bearer scraper'})
+
+
+class QueryHooksTestCase(AppTestCase):
+    """This class tests the slow query log and the query budget"""
+
+    def test_budget_fails_the_request(self):
+        """Passing Test for a request over budget in raise mode"""
+        app = self.create_app(DB_QUERY_BUDGET=1,
+                              DB_QUERY_BUDGET_MODE='raise')
+
+        with self.assertLogs(app.logger, 'ERROR') as logs:
+            res = app.test_client().get('/actors', headers=self.headers)
+
+        self.assertEqual(res.status_code, 500)
+        self.assertIn('QueryBudgetExceeded', '\n'.join(logs.output))
+
+    def test_budget_warns(self):
+        """Passing Test for a request over budget in warn mode"""
+        app = self.create_app(DB_QUERY_BUDGET=1, DB_QUERY_BUDGET_MODE='warn')
+
+        with self.assertLogs('database.engine', 'WARNING') as logs:
+            res = app.test_client().get('/actors', headers=self.headers)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(logs.output), 1)
+        self.assertIn('Query budget of 1 exceeded by GET /actors: query 2',
+                      logs.output[0])
+
+    def test_failed_statements(self):
+        """Passing Test for failed statements leaving no timer behind"""
+        app = self.create_app(DB_SLOW_QUERY_MS=1000)
+
+        with app.app_context(), db.engine.connect() as connection:
+            for attempt in range(3):
+                with self.assertRaises(Exception):
+                    connection.execute('SELECT * FROM missing')
+            connection.execute('SELECT 1')
+
+            self.assertNotIn('castu_query_start', connection.info)
+
+    def test_slow_query_log(self):
+        """Passing Test for a slow query logged with its route and plan"""
+        app = self.create_app(DB_SLOW_QUERY_MS=1, DB_EXPLAIN=True)
+
+        with app.test_request_context('/slow'), \
+                self.assertLogs('database.engine', 'WARNING') as logs:
+            g.request_timings = metrics.RequestTimings()
+            db.session.execute(
+                'WITH RECURSIVE c(x) AS (SELECT 1 UNION ALL SELECT x + 1 '
+                'FROM c WHERE x < :n) SELECT count(*) FROM c', {'n': 300000})
+
+        self.assertIn('Slow query', logs.output[0])
+        self.assertIn('on GET /slow', logs.output[0])
+        self.assertIn("parameters: (300000,)", logs.output[0])
+        self.assertIn('SCAN', logs.output[0])
+
+
+class ProfilingTestCase(AppTestCase):
+    """This class tests the per-request and process profilers"""
+
+    tokens = {'admin-token': ['get:actors', 'profile:requests'],
+              'user-token': ['get:actors']}
+
+    def setUp(self):
+        super().setUp()
+        self.app = self.create_app()
+        self.client = self.app.test_client
+        with self.app.app_context():
+            Actor.insert_many([{'name': 'Ann', 'age': 30, 'gender': 'F'}])
+
+    def tearDown(self):
+        profiling.process_sampler.stop()
+        super().tearDown()
+
+    def get(self, url, token='admin-token', **headers):
+        headers['Authorization'] = 'Bearer ' + token
+        return self.client().get(url, headers=headers)
+
+    def test_pstats(self):
+        """Passing Test for the cProfile statistics of a request"""
+        res = self.get('/actors?profile=pstats')
+
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(res.content_type.startswith('text/plain'))
+        self.assertIn('function calls', res.data.decode())
+        self.assertIn('(get_actors)', res.data.decode())
+
+    def test_requires_permission(self):
+        """Failing Test for profiling without profile:requests"""
+        res = self.get('/actors', 'user-token', **{'X-Profile': 'pstats'})
+        self.assertEqual(res.status_code, 401)
+
+        res = self.get('/actors?profile=other')
+        self.assertEqual(res.status_code, 422)
+
+        res = self.get('/actors', 'user-token')
+        self.assertEqual(res.status_code, 200)
+
+    def test_collapsed_stored(self):
+        """Passing Test for collapsed stacks written to PROFILE_DIR"""
+        self.app.config['PROFILE_DIR'] = self.directory.name
+
+        res = self.get('/actors', **{'X-Profile': 'collapsed'})
+
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(res.get_json()['success'])
+        name = res.headers['X-Profile-File']
+        self.assertTrue(name.endswith('-get_actors.collapsed'))
+        with open(os.path.join(self.directory.name, name)) as f:
+            for line in f:
+                self.assertRegex(line, r'^\S.* \d+$')
+
+    def test_process_samples(self):
+        """Passing Test for the samples merged across workers"""
+        self.app.config['PROFILE_SAMPLE_INTERVAL'] = 0.001
+        self.get('/actors')
+        time.sleep(0.05)
+
+        res = self.get('/profile/samples')
+        self.assertEqual(res.status_code, 200)
+        self.assertIn('test.py:', res.data.decode())
+
+        # every worker flushes its counts to PROFILE_DIR
+        for pid, count in ((1, 2), (2, 3)):
+            with open(os.path.join(self.directory.name,
+                                   'samples-{}.collapsed'.format(pid)),
+                      'w') as f:
+                f.write('app.py:a;app.py:b {}\n'.format(count))
+        self.app.config['PROFILE_DIR'] = self.directory.name
+
+        res = self.get('/profile/samples')
+        self.assertEqual(res.data.decode(), 'app.py:a;app.py:b 5\n')
+
+
+class ColdStartTestCase(unittest.TestCase):
+    """This class tests that importing the app has no side effects"""
+
+    def test_import_without_configuration(self):
+        """Passing Test for importing app with no database or Auth0 env"""
+        env = {
+            name: value for name, value in os.environ.items()
+            if name not in ('DATABASE_URL', 'AUTH0_DOMAIN', 'ALGORITHMS',
+                            'API_AUDIENCE', 'JWKS_URL')
+        }
+        result = subprocess.run(
+            [sys.executable, '-c', 'import app'], env=env,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.PIPE)
+
+        self.assertEqual(result.returncode, 0, result.stderr.decode())
+
+    def test_create_app_does_not_create_tables(self):
+        """Passing Test for a fresh database left to the migrations"""
+        with tempfile.TemporaryDirectory() as directory:
+            app = create_app({
+                'SQLALCHEMY_DATABASE_URI':
+                    'sqlite:///' + os.path.join(directory, 'fresh.db'),
+                'ENTITY_CACHE': 'none'
+            })
+            with app.app_context():
+                self.assertEqual(db.engine.table_names(), [])
+
+
 # Make the tests conveniently executable
 if __name__ == "__main__":
     unittest.main()